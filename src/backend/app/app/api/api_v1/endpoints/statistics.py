@@ -5,6 +5,7 @@ from sqlalchemy.orm import Session
 
 from app import crud, models, schemas
 from app.api import deps
+from app.core.celery_app import celery_app
 
 router = APIRouter()
 
@@ -23,6 +24,23 @@ def read_statistics(
     return statisticss
 
 
+@router.post(
+    "/report-snapshot/{project_id}", response_model=schemas.Msg, status_code=201
+)
+def create_report_snapshot(
+    *,
+    project_id: int,
+    current_user: models.User = Depends(deps.get_current_active_user),
+) -> Any:
+    """
+    Compute the report snapshot of a project in the worker.
+    """
+    if not crud.user.is_admin(current_user):
+        raise HTTPException(status_code=400, detail="권한이 없습니다.")
+    celery_app.send_task("app.worker.compute_report_snapshot", args=[project_id])
+    return {"msg": f"Report snapshot of project {project_id} requested"}
+
+
 @router.post("/", response_model=schemas.Statistics)
 def create_statistics(
     *,
@@ -1,7 +1,11 @@
+import datetime
+
 from raven import Client
 
+from app import crud, schemas
 from app.core.celery_app import celery_app
 from app.core.config import settings
+from app.db.session import SessionLocal
 
 client_sentry = Client(settings.SENTRY_DSN)
 
@@ -9,3 +13,32 @@ client_sentry = Client(settings.SENTRY_DSN)
 @celery_app.task(acks_late=True)
 def test_celery(word: str) -> str:
     return f"test task return {word}"
+
+
+@celery_app.task(acks_late=True)
+def compute_report_snapshot(project_id: int) -> str:
+    """
+    Computes the report snapshot of a project and registers it as statistics of the
+    project. The ADaRT frontend package (src) and its working folder must be available
+    to the worker.
+    """
+    # imported in the task so that the other tasks do not depend on the frontend package
+    from src.models.report_snapshot import REPORT_SNAPSHOT_CATEGORY, create_snapshot
+
+    # a prefork worker is a daemonic process, which cannot start a process pool
+    snapshot = create_snapshot(project_id, max_workers=1)
+
+    db = SessionLocal()
+    try:
+        statistics_in = schemas.StatisticsCreate(
+            category=REPORT_SNAPSHOT_CATEGORY,
+            verbose=f"Report snapshot {snapshot.sequence}",
+            file_path=snapshot.get_filename(),
+            project_id=project_id,
+            created_at=datetime.datetime.now()
+        )
+        crud.statistics.create(db=db, obj_in=statistics_in)
+    finally:
+        db.close()
+
+    return snapshot.get_filename()
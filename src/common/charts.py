@@ -1,13 +1,14 @@
-import datetime as dt
 import os
 
 import altair as alt
-import cv2
+import numpy as np
 import pandas as pd
 import streamlit as st
 
-from src.common import constants, utils
+from src.common import constants, export, utils
 from src.common.logger import get_logger
+from src.models.file_inventory import get_file_inventory
+from src.models.image_stats import get_image_stats
 
 from PIL import Image
 
@@ -16,148 +17,162 @@ import plotly.express as px
 import plotly.offline as pyo
 import plotly.io as pio
 import plotly.subplots as sp
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
 
 logger = get_logger(__name__)
 
-@st.cache_data
-def plot_aspect_ratios_brightness(title: str, files_dict: dict):
-    if files_dict is None or len(files_dict.items()) == 0:
-        return
+DEFAULT_BINS = 50
+DEFAULT_QUANTILES = (0.05, 0.5, 0.95)
+BRIGHTNESS_RANGE = (0, 255)
+DEFAULT_PAGE_SIZE = 100
+# above this number of labels, the label dimensions are plotted as a density map with sampled points
+DENSITY_THRESHOLD = 5000
+SAMPLES_PER_CLASS = 50
+DEFAULT_DENSITY_BINS = 100
+
+
+def bin_values(values, bins: int = DEFAULT_BINS, value_range: tuple = None) -> pd.DataFrame:
+    """
+    counts the values per bin so that the size of a chart does not depend on the number of values
+    :param values: values to bin; NaN values are ignored
+    :param bins: number of bins
+    :param value_range: (min, max) of the bins; defaults to the range of the values
+    :return: one row per bin with columns bin_start, bin_end, count
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return pd.DataFrame(columns=['bin_start', 'bin_end', 'count'])
+
+    counts, edges = np.histogram(values, bins=bins, range=value_range)
+    return pd.DataFrame({'bin_start': edges[:-1], 'bin_end': edges[1:], 'count': counts})
+
+
+def get_quantiles(values, quantiles: tuple = DEFAULT_QUANTILES) -> dict:
+    """
+    :param values: values; NaN values are ignored
+    :param quantiles: quantiles to calculate between 0 and 1
+    :return: quantile -> value; empty if there are no values
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return dict()
+
+    return dict(zip(quantiles, np.quantile(values, quantiles)))
+
+
+def plot_histogram(df_bins: pd.DataFrame, quantiles: dict, title: str, x_title: str):
+    """
+    :param df_bins: bins from bin_values
+    :param quantiles: quantiles from get_quantiles, drawn as vertical lines
+    :param title: chart title
+    :param x_title: title of the binned values
+    :return: plotly bar chart of the bins
+    """
+    chart = go.Figure(data=[go.Bar(
+        x=(df_bins['bin_start'] + df_bins['bin_end']) / 2,
+        y=df_bins['count'],
+        width=df_bins['bin_end'] - df_bins['bin_start'],
+        customdata=df_bins[['bin_start', 'bin_end']],
+        hovertemplate="%{customdata[0]:.3f} - %{customdata[1]:.3f}: %{y}<extra></extra>"
+    )])
 
-    # Initialize a list to store the aspect ratios
-    aspect_ratios = {}
-    brightness_values = {}
-
-    # Loop through all the files in the folder and calculate their aspect ratios
-    for folder, files in files_dict.items():
-        for file in files:
-            image_path = os.path.join(folder, file)
-            # Read the image using opencv-python
-            img = cv2.imread(image_path)
-
-            if img is None:
-                continue
-
-            # Get the width and height of the image
-            height, width, _ = img.shape
-
-            # Calculate the aspect ratio
-            aspect_ratio = width / height
-            if aspect_ratios.get(aspect_ratio):
-                aspect_ratios[aspect_ratio] = aspect_ratios[aspect_ratio] + 1
-            else:
-                aspect_ratios[aspect_ratio] = 1
-
-            # Convert the image to grayscale
-            gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            # Calculate the average brightness of the image
-            brightness = gray_img.mean()
-            if brightness_values.get(brightness):
-                brightness_values[brightness] = brightness_values[brightness] + 1
-            else:
-                brightness_values[brightness] = 1
-
-    aspect_ratios_list = [(k, v) for k, v in aspect_ratios.items()]
-
-    # Done with the help of ChatGPT:
-    # Create a Pandas DataFrame from the aspect ratios
-    # Passing the keys and values of the dictionary directly to the Pandas DataFrame results in a problem.
-    # It is possible that the values are being coerced to a non-numeric data type,
-    # which could cause issues with the count() aggregation function.
-    #
-    # To resolve this issue, you can try converting the aspect_ratios dictionary into a list of tuples,
-    # where each tuple contains the aspect ratio value and the count of images with that aspect ratio.
-    # You can then pass this list to the Pandas DataFrame.
-    df_aspect_ratios = pd.DataFrame(aspect_ratios_list, columns=['aspect_ratio', 'count'])
-
-    # # Create a histogram of the aspect ratios using Altair
-    # chart_aspect_ratios = alt.Chart(df_aspect_ratios).mark_bar().encode(
-    #     x=alt.X('aspect_ratio'),
-    #     y=alt.Y('count:Q', title='Count'),
-    #     tooltip=['aspect_ratio', 'count:Q']
-    # ).properties(
-    #     title='Aspect Ratios of Images'
-    # )
-    # chart_aspect_ratios = chart_aspect_ratios.interactive()  # make the chart interactive
-    # chart_aspect_ratios = chart_aspect_ratios.properties(
-    #     width=600,
-    #     height=400
-    # ).add_selection(
-    #     alt.selection_interval(bind='scales', encodings=['x', 'y'])
-    # ).add_selection(
-    #     alt.selection(type='interval', bind='scales', encodings=['x', 'y'])
-    # )
-
-    # Create a histogram of the aspect ratios using Plotly
-    chart_aspect_ratios = go.Figure(data=[go.Bar(x=df_aspect_ratios['aspect_ratio'], y=df_aspect_ratios['count'])])
-
-    chart_aspect_ratios.update_layout(
-        title='Aspect Ratios of Images',
-        xaxis_title='Aspect Ratio',
+    chart.update_layout(
+        title=title,
+        xaxis_title=x_title,
         yaxis_title='Count',
         width=600,
         height=400,
         bargap=0.1
     )
+    chart.update_xaxes(rangeslider=dict(visible=True))
 
-    # Make the chart interactive
-    chart_aspect_ratios.update_xaxes(rangeselector=dict(buttons=list([
-        dict(count=1, label="1m", step="month", stepmode="backward"),
-        dict(count=6, label="6m", step="month", stepmode="backward"),
-        dict(count=1, label="YTD", step="year", stepmode="todate"),
-        dict(count=1, label="1y", step="year", stepmode="backward"),
-        dict(step="all")
-    ])), rangeslider=dict(visible=True))
+    for quantile, value in quantiles.items():
+        chart.add_vline(x=value, line_dash="dot", line_color="gray",
+                        annotation_text=f"p{int(quantile * 100)}", annotation_position="top")
 
-    # Display the plotly chart
-    #st.plotly_chart(chart_aspect_ratios)
+    return chart
 
-    brightness_values_list = [(k, v) for k, v in brightness_values.items()]
-    # Create a Pandas DataFrame from the brightness
-    df_brightness = pd.DataFrame(brightness_values_list, columns=['brightness', 'count'])
 
-    # # Create a histogram of the brightness using Altair
-    # chart_brightness = alt.Chart(df_brightness).mark_bar().encode(
-    #     x=alt.X('brightness', bin=alt.Bin(step=10)),
-    #     y=alt.Y('count:Q', title='Count'),
-    #     tooltip=['brightness', 'count:Q']
-    # ).properties(
-    #     title='Brightness of Images'
-    # )
-    # chart_brightness = chart_brightness.interactive()  # make the chart interactive
-    # chart_brightness = chart_brightness.properties(
-    #     width=600,
-    #     height=400
-    # ).add_selection(
-    #     alt.selection_interval(bind='scales', encodings=['x', 'y'])
-    # ).add_selection(
-    #     alt.selection(type='interval', bind='scales', encodings=['x', 'y'])
-    # )
+@st.cache_data
+def plot_aspect_ratios_brightness(title: str, files_dict: dict,
+                                  aspect_ratio_bins: int = DEFAULT_BINS, brightness_bins: int = DEFAULT_BINS):
+    if files_dict is None or len(files_dict.items()) == 0:
+        return
 
-    chart_brightness = px.histogram(df_brightness, x='brightness', nbins=50,
-                                    title='Brightness of Images',
-                                    labels={'brightness': 'Brightness', 'count': 'Count'},
-                                    hover_data=['brightness', 'count'])
-    
-    chart_brightness.update_xaxes(rangeselector=dict(buttons=list([
-        dict(count=1, label="1m", step="month", stepmode="backward"),
-        dict(count=6, label="6m", step="month", stepmode="backward"),
-        dict(count=1, label="YTD", step="year", stepmode="todate"),
-        dict(count=1, label="1y", step="year", stepmode="backward"),
-        dict(step="all")
-    ])), rangeslider=dict(visible=True))
+    # the dimensions and brightness are calculated once per image and cached per data folder;
+    # only the bins are sent to the charts
+    df_stats = get_image_stats(files_dict)
 
-    # Display the plot
-    #st.plotly_chart(chart_brightness)
+    df_aspect_ratios = bin_values(df_stats['aspect_ratio'], bins=aspect_ratio_bins)
+    chart_aspect_ratios = plot_histogram(df_aspect_ratios, get_quantiles(df_stats['aspect_ratio']),
+                                         'Aspect Ratios of Images', 'Aspect Ratio')
+
+    df_brightness = bin_values(df_stats['brightness'], bins=brightness_bins, value_range=BRIGHTNESS_RANGE)
+    chart_brightness = plot_histogram(df_brightness, get_quantiles(df_stats['brightness']),
+                                      'Brightness of Images', 'Brightness')
 
     #Making the tables from the charts
-    table_brightness = pd.DataFrame(df_brightness.values, columns=["brightness", "count"])
-    table_aspect_ratios = pd.DataFrame(df_aspect_ratios.values, columns=["aspect ratio", "count"])
+    table_brightness = pd.DataFrame(df_brightness.values, columns=["brightness from", "brightness to", "count"])
+    table_aspect_ratios = pd.DataFrame(df_aspect_ratios.values, columns=["aspect ratio from", "aspect ratio to", "count"])
 
     return chart_aspect_ratios, chart_brightness, table_aspect_ratios, table_brightness 
 
+
+def get_summary_bins(summary: dict) -> (pd.DataFrame, dict):
+    """
+    :param summary: histogram and quantiles of a report snapshot (report_snapshot.summarize_values)
+    :return: bins as from bin_values and quantiles as from get_quantiles
+    """
+    if not summary.get("count"):
+        return pd.DataFrame(columns=['bin_start', 'bin_end', 'count']), dict()
+
+    edges = np.asarray(summary["edges"], dtype=float)
+    df_bins = pd.DataFrame({'bin_start': edges[:-1], 'bin_end': edges[1:], 'count': summary["counts"]})
+    return df_bins, {float(quantile): value for quantile, value in summary.get("quantiles", {}).items()}
+
+
+def plot_image_summary(image_metrics: dict):
+    """
+    plots the aspect ratios and the brightness of the images from the summaries of a report snapshot
+    :param image_metrics: image metrics of a report snapshot
+    :return: the charts and tables of plot_aspect_ratios_brightness
+    """
+    if not image_metrics.get("count"):
+        return None, None, None, None
+
+    df_aspect_ratios, aspect_ratio_quantiles = get_summary_bins(image_metrics["aspect_ratio"])
+    chart_aspect_ratios = plot_histogram(df_aspect_ratios, aspect_ratio_quantiles,
+                                         'Aspect Ratios of Images', 'Aspect Ratio')
+
+    df_brightness, brightness_quantiles = get_summary_bins(image_metrics["brightness"])
+    chart_brightness = plot_histogram(df_brightness, brightness_quantiles, 'Brightness of Images', 'Brightness')
+
+    table_aspect_ratios = pd.DataFrame(df_aspect_ratios.values,
+                                       columns=["aspect ratio from", "aspect ratio to", "count"])
+    table_brightness = pd.DataFrame(df_brightness.values, columns=["brightness from", "brightness to", "count"])
+
+    return chart_aspect_ratios, chart_brightness, table_aspect_ratios, table_brightness
+
+
+def plot_file_summary(file_metrics: dict):
+    """
+    plots the number of files per creation date and the file sizes from the summaries of a report snapshot
+    :param file_metrics: file metrics of a report snapshot
+    :return: creation date chart, file size chart and the table of the creation dates
+    """
+    if not file_metrics.get("count"):
+        return None, None, None
+
+    table_ctime = pd.DataFrame(list(file_metrics["created_dates"].items()), columns=["Create Date", "Count"])
+    chart_ctime = px.bar(table_ctime, x="Create Date", y="Count", title='Created Time')
+    chart_ctime.update_layout(width=600, height=400, hovermode='closest')
+
+    df_sizes, size_quantiles = get_summary_bins(file_metrics["sizes"])
+    chart_sizes = plot_histogram(df_sizes, size_quantiles, 'File Size Distribution', 'File Size (bytes)')
+
+    return chart_ctime, chart_sizes, table_ctime
+
 @st.cache_data
 def plot_file_sizes(df_file_info: pd.DataFrame):
     df_file_info['size'] = df_file_info['size'].astype(int)
@@ -211,37 +226,57 @@ def plot_file_sizes(df_file_info: pd.DataFrame):
 
     return chart
 
-@st.cache_data
-def plot_file_info(title: str, files_dict: dict):
+def show_paged_table(df: pd.DataFrame, key: str, page_size: int = DEFAULT_PAGE_SIZE):
+    """
+    shows one page of a table at a time so that the number of rendered rows does not depend on the table size
+    :param df: table to show
+    :param key: unique key of the page selector
+    :param page_size: number of rows per page
+    """
+    page_count = max(1, (len(df) + page_size - 1) // page_size)
+    page = 1
+    if page_count > 1:
+        page = st.number_input(f"Page (1-{page_count})", min_value=1, max_value=page_count, value=1, key=key)
+
+    st.dataframe(df.iloc[(page - 1) * page_size:page * page_size], use_container_width=True)
+
+
+def show_file_tables(title: str, files_dict: dict):
+    """
+    shows the files of each folder in a paged table
+    :param title: header
+    :param files_dict: folder -> filenames
+    """
     if files_dict is None or len(files_dict.items()) == 0:
         return
 
     st.header(title)
-    file_info_dict = dict()
-    for folder, files in files_dict.items():
-        level = folder.count(os.sep)
-        indent = '-' * level
-        # st.markdown('{}📁({}) {}/'.format(indent, len(files), folder))
-        with st.expander('📁({}) {}/'.format(len(files), folder.replace(constants.ADQ_WORKING_FOLDER, ""))):
-            for file in files:
-                file_stat = os.stat(os.path.join(folder, file))
-                dt_cdatetime = dt.datetime.fromtimestamp(file_stat.st_ctime)
-                st.markdown("📄{} ({}) created: {}".format(file,
-                                                           utils.humanize_bytes(file_stat.st_size),
-                                                           dt_cdatetime.date()))
-                # st.markdown("📄{} ({}) {}".format(file,
-                #                                  utils.humanize_bytes(file_stat.st_size),
-                #                                  dt_cdatetime.date()))
-                ctime_object = dt_cdatetime.time()
-                # Append date and time to x and y data lists
-                file_info_dict[file] = (dt_cdatetime.date(), float(ctime_object.strftime('%H.%M')), file_stat.st_size)
-
-    df_ctime = pd.DataFrame.from_dict(file_info_dict, orient='index', columns=['date', 'time', 'size'])
-    df_ctime = df_ctime.assign(file=file_info_dict.keys())
-    # df_ctime = df_ctime.assign(file=file_info_dict.keys(), modified=[t[0] for t in file_info_dict.values()])
-
-    # convert the date column to a string representation
-    df_ctime['date'] = df_ctime['date'].astype(str)
+    df_files = get_file_inventory(files_dict)
+    for folder, df_folder in df_files.groupby('folder', sort=True):
+        with st.expander('📁({}) {}/'.format(len(df_folder), folder.replace(constants.ADQ_WORKING_FOLDER, ""))):
+            df_table = pd.DataFrame({
+                'file': df_folder['name'],
+                'size': df_folder['size'].map(utils.humanize_bytes),
+                'created': df_folder['ctime'],
+                'modified': df_folder['mtime']
+            })
+            show_paged_table(df_table.reset_index(drop=True), key=f"files_page_{title}_{folder}")
+
+
+# not cached by Streamlit: the file list stays the same when a file is replaced, while the inventory of a folder
+# is scanned again as soon as the folder changes
+def plot_file_info(title: str, files_dict: dict):
+    if files_dict is None or len(files_dict.items()) == 0:
+        return
+
+    df_files = get_file_inventory(files_dict)
+    df_ctime = pd.DataFrame({
+        'date': df_files['ctime'].dt.date.astype(str),
+        # hours.minutes
+        'time': df_files['ctime'].dt.hour + df_files['ctime'].dt.minute / 100,
+        'size': df_files['size'],
+        'file': df_files['name']
+    })
 
     # chart_ctime = alt.Chart(df_ctime).mark_circle().encode(
     #     x='date',
@@ -280,10 +315,6 @@ def plot_file_info(title: str, files_dict: dict):
     #st.plotly_chart(chart_ctime)
 
     chart_sizes = plot_file_sizes(df_ctime)
-    df_size = df_ctime.assign(file=file_info_dict.keys())
-
-    #if you needed size separately
-    #df_size['size'] = df_ctime['size'].astype(str)
 
     #Making the tables from the charts
     table_ctime = pd.DataFrame(df_ctime.values, columns=["Create Date", "Time", "Size", "Count"])
@@ -291,6 +322,69 @@ def plot_file_info(title: str, files_dict: dict):
 
     return chart_ctime, chart_sizes, table_ctime
 
+def sample_per_class(df: pd.DataFrame, class_column: str = 'class',
+                     samples_per_class: int = SAMPLES_PER_CLASS, random_state: int = 0) -> pd.DataFrame:
+    """
+    :param df: rows to sample from
+    :param class_column: column of the class labels
+    :param samples_per_class: maximum number of rows per class
+    :param random_state: seed so that the same rows are sampled on every rerun
+    :return: up to samples_per_class random rows of each class
+    """
+    return df.sample(frac=1, random_state=random_state).groupby(class_column, sort=False).head(samples_per_class)
+
+
+@st.cache_data
+def plot_label_dimensions(df_dimensions: pd.DataFrame, density_threshold: int = DENSITY_THRESHOLD,
+                          samples_per_class: int = SAMPLES_PER_CLASS, bins: int = DEFAULT_DENSITY_BINS):
+    """
+    plots the width and height of the labels.
+    Above density_threshold labels, the chart is a density map binned on the server
+    with sampled points per class on top so that the chart size does not depend on the number of labels.
+    :param df_dimensions: one row per label with columns filename, width, height, class, data_folder
+    :param density_threshold: maximum number of labels plotted as points
+    :param samples_per_class: number of points per class above the threshold
+    :param bins: number of density bins per axis
+    :return: chart, per-class summary table and the plotted points
+    """
+    if df_dimensions is None or df_dimensions.empty:
+        return None, None, None
+
+    df_points = df_dimensions
+    if len(df_dimensions) > density_threshold:
+        df_points = sample_per_class(df_dimensions, 'class', samples_per_class)
+
+    chart = px.scatter(df_points, x='width', y='height', color='class',
+                       hover_data=['class', 'width', 'height', 'filename'],
+                       title="Label Dimensions", render_mode='webgl')
+    chart.update_layout(width=600, height=400)
+
+    if len(df_dimensions) > density_threshold:
+        counts, width_edges, height_edges = np.histogram2d(df_dimensions['width'], df_dimensions['height'],
+                                                           bins=bins)
+        density = go.Heatmap(x=(width_edges[:-1] + width_edges[1:]) / 2,
+                             y=(height_edges[:-1] + height_edges[1:]) / 2,
+                             # empty bins are transparent
+                             z=np.where(counts > 0, counts, np.nan).T,
+                             colorscale='Greys', showscale=False, name='density',
+                             hovertemplate="width %{x:.0f}, height %{y:.0f}: %{z} labels<extra></extra>")
+        chart.add_trace(density)
+        # the density is drawn below the points
+        chart.data = (chart.data[-1],) + chart.data[:-1]
+        chart.update_layout(title=f"Label Dimensions ({len(df_points)} of {len(df_dimensions)} labels shown)")
+
+    grouped = df_dimensions.groupby('class')
+    table = pd.DataFrame({
+        'count': grouped.size(),
+        'width p50': grouped['width'].median(),
+        'height p50': grouped['height'].median(),
+        'width p95': grouped['width'].quantile(0.95),
+        'height p95': grouped['height'].quantile(0.95),
+    }).round(1).reset_index()
+
+    return chart, table, df_points
+
+
 @st.cache_data
 def plot_chart(title: str, x_label: str, y_label: str, data_dict: dict, chart_type="bar"):
     if data_dict is None or len(data_dict.items()) == 0:
@@ -509,99 +603,54 @@ def show_download_charts_button(project_id):
     #         disabled=download_disabled
     #     )
 
-    #New Download charts or table button
-    # Create a temporary file for the combined charts
-    combined_filename = f"{project_id}.combined_charts.pdf"
-    combined_full_path = os.path.join(constants.ADQ_WORKING_FOLDER, str(project_id), combined_filename)
-
-    # Create a PDF document for the combined charts
-    with PdfPages(combined_full_path) as pdf:
-        # Save each chart as a separate page in the PDF
-        for i, chart in enumerate(charts_list):
-            # Save the chart as a PNG image
-            image_path = f"{project_id}_chart_{i}.png"
-            image_full_path = os.path.join(constants.ADQ_WORKING_FOLDER, str(project_id), image_path)
-            chart.write_image(image_full_path, format='png')
-
-            # Add the image to the PDF page
-            fig = plt.figure(figsize=(8, 6))
-            img = plt.imread(image_full_path)
-            plt.imshow(img)
-            plt.axis('off')
-            pdf.savefig(fig)
-            plt.close()
-
-            # Remove the temporary image file
-            os.remove(image_full_path)
-
-    # Check if the combined charts PDF file exists
-    combined_download_disabled = not os.path.exists(combined_full_path)
-
-    # Dropdown button to select the download option
+    # the artifacts are written into memory and built again only when the charts or tables changed
     download_option = st.selectbox(
         "Download Chart Data:",
         options=["Combined Charts (PDF)", "Chart Data as CSV", "Chart Data as Excel"]
     )
 
     if download_option == "Combined Charts (PDF)":
-        # Add download button for the combined charts
-        with open(combined_full_path, 'rb') as f:
-            file_bytes = f.read()
-            st.download_button(
-                label='Download combined chart',
-                data=file_bytes,
-                file_name=combined_filename,
-                mime='application/pdf',
-                disabled=combined_download_disabled
-            )
+        combined_filename = f"{project_id}.combined_charts.pdf"
+        file_bytes = export.get_artifact(combined_filename, export.get_fingerprint(charts_list),
+                                         lambda output: export.write_charts_pdf(charts_list, output))
+        st.download_button(
+            label='Download combined chart',
+            data=file_bytes,
+            file_name=combined_filename,
+            mime=export.PDF_MIME,
+            disabled=not file_bytes
+        )
     elif download_option == "Chart Data as CSV":
         # Check if tables_list contains any tables
         if tables_list:
-            # Iterate through each table and save it as a separate CSV file
-            for i, (table_name, table) in enumerate(tables.items()):
+            for table_name, table in tables.items():
                 # Check if table is a DataFrame and has data
                 if isinstance(table, pd.DataFrame) and not table.empty:
                     csv_filename = f"{project_id}_data_{table_name}.csv"
-                    csv_full_path = os.path.join(constants.ADQ_WORKING_FOLDER, str(project_id), csv_filename)
-
-                    if os.path.exists(csv_full_path):
-                        os.remove(csv_full_path)  # Remove the existing file
-
-                    table.to_csv(csv_full_path, index=False)
-                    with open(csv_full_path, 'rb') as f:
-                        file_bytes = f.read()
-                        st.download_button(
-                            label=f'Download {table_name} as CSV',
-                            data=file_bytes,
-                            file_name=csv_filename,
-                            mime='text/csv'
-                        )
+                    file_bytes = export.get_artifact(csv_filename, export.get_fingerprint(table),
+                                                     lambda output, table=table: export.write_csv(table, output))
+                    st.download_button(
+                        label=f'Download {table_name} as CSV',
+                        data=file_bytes,
+                        file_name=csv_filename,
+                        mime=export.CSV_MIME
+                    )
                 else:
                     st.text(f"No data available to save as CSV for table {table_name}.")
         else:
             st.text("No table available to save as CSV.")
     elif download_option == "Chart Data as Excel":
         if tables_list:
-            table = tables_list  # Assuming you want to save the first table
             excel_filename = f"{project_id}_data.xlsx"
-            excel_full_path = os.path.join(constants.ADQ_WORKING_FOLDER, str(project_id), excel_filename)
-
-            # Create a new Excel writer object
-            with pd.ExcelWriter(excel_full_path, engine='openpyxl') as writer:
-                # Iterate through each table and save it as a separate sheet
-                for i, table in enumerate(tables_list):
-                    # Check if table is a DataFrame
-                    if isinstance(table, pd.DataFrame):
-                        sheet_name = f"Table_{i + 1}"
-                        table.to_excel(writer, sheet_name=sheet_name, index=False)
-
-            with open(excel_full_path, 'rb') as f:
-                file_bytes = f.read()
-                st.download_button(
-                    label='Download data as Excel',
-                    data=file_bytes,
-                    file_name=excel_filename,
-                    mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-                )
+            # one sheet per table
+            sheets = {f"Table_{i + 1}": table for i, table in enumerate(tables_list) if isinstance(table, pd.DataFrame)}
+            file_bytes = export.get_artifact(excel_filename, export.get_fingerprint(sheets),
+                                             lambda output: export.write_excel(sheets, output))
+            st.download_button(
+                label='Download data as Excel',
+                data=file_bytes,
+                file_name=excel_filename,
+                mime=export.EXCEL_MIME
+            )
         else:
             st.text("No table available to save as Excel.")
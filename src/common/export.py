@@ -0,0 +1,118 @@
+import hashlib
+import io
+import tempfile
+from collections import OrderedDict
+
+import pandas as pd
+from PIL import Image
+
+from src.common.logger import get_logger
+
+logger = get_logger(__name__)
+
+"""
+.. module:: export
+   :synopsis: CSV, Excel and PDF artifacts of the reports written into memory instead of temporary files
+    An artifact is built again only if the fingerprint of its inputs changed;
+    the latest artifacts are kept in memory so that reruns of a page do not rebuild them.
+    Chart images of the PDF are rendered one after the other since kaleido serializes the renders.
+"""
+
+CSV_MIME = "text/csv"
+EXCEL_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+PDF_MIME = "application/pdf"
+
+# number of artifacts kept in memory
+MAX_CACHED_ARTIFACTS = 16
+# artifacts larger than this are spooled to a temporary file while they are written
+SPOOL_MAX_SIZE = 32 * 1024 * 1024
+# resolution of the chart images in the PDF
+PDF_RESOLUTION = 100.0
+
+# (artifact name, fingerprint) -> bytes
+_artifacts = OrderedDict()
+
+
+def get_fingerprint(*inputs) -> str:
+    """
+    :param inputs: DataFrames, plotly figures or any values with a stable repr
+    :return: hash of the inputs
+    """
+    digest = hashlib.sha1()
+    for value in inputs:
+        if isinstance(value, pd.DataFrame):
+            digest.update(str(list(value.columns)).encode())
+            digest.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+        elif hasattr(value, "to_plotly_json"):
+            digest.update(value.to_json().encode())
+        elif isinstance(value, (list, tuple)):
+            digest.update(get_fingerprint(*value).encode())
+        elif isinstance(value, dict):
+            digest.update(get_fingerprint(*value.keys(), *value.values()).encode())
+        else:
+            digest.update(repr(value).encode())
+
+    return digest.hexdigest()
+
+
+def get_artifact(name: str, fingerprint: str, build) -> bytes:
+    """
+    :param name: name of the artifact (e.g., the download filename)
+    :param fingerprint: fingerprint of the inputs of the artifact
+    :param build: function writing the artifact into a binary file object
+    :return: bytes of the artifact, built only if it is not cached for the fingerprint
+    """
+    key = (name, fingerprint)
+    if key in _artifacts:
+        _artifacts.move_to_end(key)
+        return _artifacts[key]
+
+    logger.info(f"Building {name}")
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as artifact_file:
+        build(artifact_file)
+        artifact_file.seek(0)
+        artifact = artifact_file.read()
+
+    _artifacts[key] = artifact
+    while len(_artifacts) > MAX_CACHED_ARTIFACTS:
+        _artifacts.popitem(last=False)
+
+    return artifact
+
+
+def write_csv(table: pd.DataFrame, output):
+    """
+    :param table: table to write
+    :param output: binary file object
+    """
+    output.write(table.to_csv(index=False).encode("utf-8"))
+
+
+def write_excel(tables: dict, output):
+    """
+    :param tables: sheet name -> table
+    :param output: binary file object
+    """
+    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        for sheet_name, table in tables.items():
+            table.to_excel(writer, sheet_name=sheet_name, index=False)
+
+
+def render_chart_images(charts: list) -> list:
+    """
+    renders the charts one after the other; kaleido serializes the renders, so threads would not add parallelism
+    :param charts: plotly figures
+    :return: PIL images of the charts in the same order
+    """
+    return [Image.open(io.BytesIO(chart.to_image(format="png"))).convert("RGB") for chart in charts]
+
+
+def write_charts_pdf(charts: list, output):
+    """
+    writes one chart per page
+    :param charts: plotly figures
+    :param output: binary file object
+    """
+    images = render_chart_images(charts)
+    if images:
+        images[0].save(output, format="PDF", save_all=True, append_images=images[1:], resolution=PDF_RESOLUTION)
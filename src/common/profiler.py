@@ -0,0 +1,140 @@
+import datetime
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+from src.common.logger import get_log_path, get_logger
+
+logger = get_logger(__name__)
+
+"""
+.. module:: profiler
+   :synopsis: opt-in timing of the stages of a rerun (e.g., label loading, image decode, resize, saving)
+    Each finished rerun is appended as one JSON line to the timings file so that the records of many
+    sessions can be aggregated into p50/p95 per stage:
+        python -m src.common.profiler [timings file]
+    Profiling is enabled by setting the ADART_PROFILE environment variable or from the viewer sidebar.
+"""
+
+PROFILE_ENV = "ADART_PROFILE"
+TIMINGS_FILENAME = "viewer-timings.jsonl"
+
+
+def is_profiling_enabled() -> bool:
+    return os.environ.get(PROFILE_ENV, "").lower() in ("1", "true", "yes")
+
+
+def get_timings_filename() -> str:
+    return get_log_path() + TIMINGS_FILENAME
+
+
+class RerunProfiler:
+    """RerunProfiler
+    Collects the time spent per stage until the rerun is finished.
+    Stages timed more than once (e.g., saving twice) are summed up.
+
+    Args:
+        name(str): name of what is profiled (e.g., viewer)
+        enabled(bool): if False, nothing is timed or recorded
+    """
+
+    def __init__(self, name: str, enabled: bool = True):
+        self.name = name
+        self.enabled = enabled
+        self._stages = dict()
+
+    @contextmanager
+    def stage(self, stage_name: str):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self._stages[stage_name] = self._stages.get(stage_name, 0.0) + elapsed_ms
+
+    def get_stages(self) -> dict:
+        """
+        :return: stage name -> milliseconds of the current rerun
+        """
+        return dict(self._stages)
+
+    def finish(self, timings_filename: str = None, **context) -> dict:
+        """
+        appends the timings of the rerun to the timings file and starts over
+        :param timings_filename: JSON lines file to append to; defaults to the log folder
+        :param context: additional fields to record (e.g., task id, image name)
+        :return: the recorded stages
+        """
+        stages = self.get_stages()
+        self._stages = dict()
+        if not self.enabled or not stages:
+            return stages
+
+        record = {
+            "timestamp": datetime.datetime.now().isoformat(),
+            "name": self.name,
+            "stages": stages,
+            "total": sum(stages.values()),
+            **context
+        }
+        try:
+            with open(timings_filename or get_timings_filename(), "a", encoding="utf-8") as timings_file:
+                timings_file.write(json.dumps(record, default=str) + "\n")
+        except OSError as e:
+            logger.warning(f"Cannot record timings: {e}")
+
+        return stages
+
+
+# used when profiling is disabled so that callers do not need to check
+NULL_PROFILER = RerunProfiler("null", enabled=False)
+
+
+def load_timings(timings_filename: str = None) -> pd.DataFrame:
+    """
+    :param timings_filename: JSON lines file written by RerunProfiler.finish
+    :return: one row per stage of each rerun with columns name, timestamp, stage, ms
+    """
+    timings_filename = timings_filename or get_timings_filename()
+    rows = []
+    if os.path.exists(timings_filename):
+        with open(timings_filename, "r", encoding="utf-8") as timings_file:
+            for line in timings_file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                for stage_name, ms in record["stages"].items():
+                    rows.append((record["name"], record["timestamp"], stage_name, ms))
+                rows.append((record["name"], record["timestamp"], "total", record["total"]))
+
+    return pd.DataFrame(rows, columns=["name", "timestamp", "stage", "ms"])
+
+
+def summarize_timings(timings_filename: str = None) -> pd.DataFrame:
+    """
+    :param timings_filename: JSON lines file written by RerunProfiler.finish
+    :return: count, mean, p50 and p95 in milliseconds per stage
+    """
+    df_timings = load_timings(timings_filename)
+    if df_timings.empty:
+        return pd.DataFrame(columns=["name", "stage", "count", "mean", "p50", "p95"])
+
+    grouped = df_timings.groupby(["name", "stage"])["ms"]
+    return pd.DataFrame({
+        "count": grouped.count(),
+        "mean": grouped.mean(),
+        "p50": grouped.quantile(0.5),
+        "p95": grouped.quantile(0.95),
+    }).round(1).reset_index()
+
+
+if __name__ == '__main__':
+    print(summarize_timings(sys.argv[1] if len(sys.argv) > 1 else None).to_string(index=False))
@@ -5,8 +5,6 @@ import zipfile
 from pathlib import Path
 
 import cv2
-import streamlit as st
-import streamlit_javascript as st_js
 from PIL import Image
 
 from .constants import SUPPORTED_IMAGE_FILE_EXTENSIONS
@@ -56,6 +54,9 @@ def glob_files(folder_path, patterns=SUPPORTED_IMAGE_FILE_EXTENSIONS):
 
 
 def generate_file_tree(folder_path, patterns):
+    # imported here so that the models using utils do not depend on streamlit
+    import streamlit as st
+
     file_tree_to_return = {}
     for root, dirs, files in os.walk(folder_path):
         level = root.replace(folder_path, '').count(os.sep)
@@ -116,6 +117,45 @@ def get_dimension(filename: str) -> (int, int):
     return width, height
 
 
+def get_crop_box(rectangle: list, width: int, height: int, min_size: int = 1) -> tuple:
+    """
+    :param rectangle: xtl, ytl, xbr, ybr in image coordinates
+    :param width: image width
+    :param height: image height
+    :param min_size: minimum width and height of the crop (e.g., for keypoints)
+    :return: xtl, ytl, xbr, ybr clipped to the image or None if the rectangle is outside of the image
+    """
+    xtl, ytl, xbr, ybr = [int(value) for value in rectangle]
+    if xbr - xtl < min_size:
+        center = (xtl + xbr) // 2
+        xtl, xbr = center - min_size // 2, center + (min_size + 1) // 2
+    if ybr - ytl < min_size:
+        center = (ytl + ybr) // 2
+        ytl, ybr = center - min_size // 2, center + (min_size + 1) // 2
+
+    xtl, ytl = max(xtl, 0), max(ytl, 0)
+    xbr, ybr = min(xbr, width), min(ybr, height)
+    if xbr <= xtl or ybr <= ytl:
+        return None
+
+    return xtl, ytl, xbr, ybr
+
+
+def crop_image(image: Image, rectangle: list, min_size: int = 1) -> Image:
+    """
+    crops the rectangle out of the image without copying the rest of the image
+    :param image: PIL image
+    :param rectangle: xtl, ytl, xbr, ybr in image coordinates
+    :param min_size: minimum width and height of the crop (e.g., for keypoints)
+    :return: cropped PIL image or None if the rectangle is outside of the image
+    """
+    crop_box = get_crop_box(rectangle, image.width, image.height, min_size)
+    if crop_box is None:
+        return None
+
+    return image.crop(crop_box)
+
+
 def from_text_file(text_file):
     return Path(text_file).read_text()
     # if ext.lower() == '.jpg':
@@ -147,6 +187,8 @@ def load_images(data_files, size: tuple = (100, 100)):
 
 
 def get_window_size():
+    import streamlit_javascript as st_js
+
     window_width = st_js.st_javascript("window.outerWidth")
     window_height = st_js.st_javascript("window.outerHeight")
     return window_width, window_height
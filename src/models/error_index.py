@@ -0,0 +1,156 @@
+import json
+import os
+
+import attr
+
+import src.common.utils as utils
+from src.common.logger import get_logger
+from src.models.data_labels import DataLabels
+
+logger = get_logger(__name__)
+
+"""
+.. module:: error_index
+   :synopsis: index of the images with verification results (errors) in a label file
+    The index is built in a single pass over the label file and cached next to it (<label file>.errors.json).
+    It is valid as long as the modification time of the label file matches;
+    the viewer updates the entry of an image when it saves the image.
+"""
+
+ERROR_INDEX_EXT = ".errors.json"
+
+
+@attr.s(slots=True, frozen=False)
+class ErrorIndex:
+    anno_file_name = attr.ib(validator=attr.validators.instance_of(str))
+    # modification time of the label file the index was built from
+    mtime = attr.ib(default=None)
+    # image_index -> {"name": image name, "errors": [[error_code, label, count]...]}
+    # only the images with at least one verification result are kept
+    entries = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
+
+    def to_json(self):
+        return {
+            "anno_file_name": self.anno_file_name,
+            "mtime": self.mtime,
+            "entries": self.entries
+        }
+
+    def save(self):
+        utils.to_file(json.dumps(self.to_json(), ensure_ascii=False),
+                      ErrorIndex.get_index_filename(self.anno_file_name))
+
+    def is_valid(self) -> bool:
+        return os.path.exists(self.anno_file_name) and self.mtime == os.path.getmtime(self.anno_file_name)
+
+    def update_image(self, image_index: int, image: DataLabels.Image):
+        """
+        updates the entry of an image after its verification results changed
+        :param image_index: index of the image in the label file
+        :param image: saved label image
+        """
+        errors = ErrorIndex._count_errors([(obj.label, obj.verification_result) for obj in image.objects])
+        if errors:
+            self.entries[image_index] = {"name": image.name, "errors": errors}
+        else:
+            self.entries.pop(image_index, None)
+
+        if os.path.exists(self.anno_file_name):
+            self.mtime = os.path.getmtime(self.anno_file_name)
+
+    def get_error_codes(self) -> list:
+        return sorted({error[0] for entry in self.entries.values() for error in entry["errors"]})
+
+    def get_labels(self) -> list:
+        return sorted({error[1] for entry in self.entries.values() for error in entry["errors"]})
+
+    def get_image_indices(self, error_code: str = None, label: str = None) -> list:
+        """
+        :param error_code: error code to filter by; None for all
+        :param label: class label to filter by; None for all
+        :return: sorted indices of the images having an error matching both filters
+        """
+        return sorted(image_index for image_index, entry in self.entries.items()
+                      if any((error_code is None or error_code == error[0]) and
+                             (label is None or label == error[1]) for error in entry["errors"]))
+
+    def find_image(self, current_index: int, error_code: str = None, label: str = None, reverse=False) -> int:
+        """
+        :param current_index: index of the image currently shown
+        :param error_code: error code to filter by; None for all
+        :param label: class label to filter by; None for all
+        :param reverse: find the previous image instead of the next one
+        :return: index of the next (or previous) image matching the filters or None if there is none
+        """
+        image_indices = self.get_image_indices(error_code, label)
+        if reverse:
+            previous_indices = [image_index for image_index in image_indices if image_index < current_index]
+            return previous_indices[-1] if previous_indices else None
+
+        next_indices = [image_index for image_index in image_indices if image_index > current_index]
+        return next_indices[0] if next_indices else None
+
+    @staticmethod
+    def _count_errors(label_results: list) -> list:
+        """
+        :param label_results: list of (label, verification_result) of the objects in an image
+        :return: list of [error_code, label, count]
+        """
+        counts = dict()
+        for label, verification_result in label_results:
+            if verification_result and verification_result.get("error_code"):
+                key = (verification_result["error_code"], label)
+                counts[key] = counts.get(key, 0) + 1
+
+        return [[error_code, label, count] for (error_code, label), count in counts.items()]
+
+    @staticmethod
+    def get_index_filename(anno_file_name: str) -> str:
+        return f"{anno_file_name}{ERROR_INDEX_EXT}"
+
+    @staticmethod
+    def build(anno_file_name: str) -> 'ErrorIndex':
+        """
+        builds the index in one pass over the label file without creating label objects
+        :param anno_file_name: label filename
+        :return: ErrorIndex
+        """
+        mtime = os.path.getmtime(anno_file_name) if os.path.exists(anno_file_name) else None
+        error_index = ErrorIndex(anno_file_name=anno_file_name, mtime=mtime)
+
+        json_labels = utils.from_file(anno_file_name)
+        for image_index, json_image in enumerate(json_labels.get("images", [])):
+            errors = ErrorIndex._count_errors([(json_obj.get("label"), json_obj.get("verification_result"))
+                                               for json_obj in json_image.get("objects", [])])
+            if errors:
+                error_index.entries[image_index] = {"name": json_image.get("name"), "errors": errors}
+
+        return error_index
+
+    @staticmethod
+    def load(anno_file_name: str) -> 'ErrorIndex':
+        """
+        loads the cached index or builds (and caches) it if the label file changed
+        :param anno_file_name: label filename
+        :return: ErrorIndex
+        """
+        index_filename = ErrorIndex.get_index_filename(anno_file_name)
+        json_index = utils.from_file(index_filename)
+        if json_index:
+            error_index = ErrorIndex.from_json(json_index)
+            if error_index.anno_file_name == anno_file_name and error_index.is_valid():
+                return error_index
+
+        logger.info(f"Building the error index of {anno_file_name}")
+        error_index = ErrorIndex.build(anno_file_name)
+        error_index.save()
+        return error_index
+
+    @staticmethod
+    def from_json(json_dict) -> 'ErrorIndex':
+        return ErrorIndex(
+            anno_file_name=json_dict["anno_file_name"],
+            mtime=json_dict.get("mtime"),
+            # json keys are always strings
+            entries={int(image_index): entry for image_index, entry in json_dict.get("entries", {}).items()}
+        )
@@ -0,0 +1,254 @@
+import csv
+import json
+import os
+
+import attr
+import numpy as np
+import pandas as pd
+
+from src.common.constants import ADQ_WORKING_FOLDER
+from src.common.logger import get_logger
+from src.models.features import (
+    FEATURE_DIM,
+    FEATURES_FOLDER,
+    calculate_all_array_features,
+    calculate_all_file_features
+)
+
+logger = get_logger(__name__)
+
+"""
+.. module:: feature_store
+   :synopsis: persistent per-project store of feature vectors (per image, per label object)
+    The features are rows of a memory-mapped matrix (<name>.features) with an id index (<name>.index.csv)
+    holding the id, the modification time of the source and the row of each feature vector.
+    New or changed sources are appended to both files, so that filling the store again costs only the delta;
+    replaced rows are reclaimed by compact().
+    Clustering, anomaly scoring and similarity search read the features from the store.
+"""
+
+FEATURES_EXT = ".features"
+INDEX_EXT = ".index.csv"
+META_EXT = ".meta.json"
+INDEX_COLUMNS = ['id', 'mtime_ns', 'row']
+# the store is compacted when more than this share of its rows were replaced
+MAX_GARBAGE_RATIO = 0.5
+SEARCH_CHUNK_SIZE = 65536
+
+
+@attr.s(slots=True, frozen=False)
+class FeatureStore:
+    project_id = attr.ib(validator=attr.validators.instance_of(int))
+    # kind of the features (e.g., images, labels)
+    name = attr.ib(validator=attr.validators.instance_of(str))
+    dim = attr.ib(default=FEATURE_DIM, validator=attr.validators.instance_of(int))
+    dtype = attr.ib(default="float32", converter=lambda dtype: np.dtype(dtype).name)
+    # id -> (modification time, row)
+    index = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
+
+    def get_filename(self, ext: str) -> str:
+        return os.path.join(ADQ_WORKING_FOLDER, str(self.project_id), FEATURES_FOLDER, self.name + ext)
+
+    @property
+    def row_bytes(self) -> int:
+        return self.dim * np.dtype(self.dtype).itemsize
+
+    def get_row_count(self) -> int:
+        """
+        :return: number of rows in the features file, including the replaced ones
+        """
+        features_filename = self.get_filename(FEATURES_EXT)
+        return os.path.getsize(features_filename) // self.row_bytes if os.path.exists(features_filename) else 0
+
+    def get_matrix(self) -> np.ndarray:
+        """
+        :return: read-only memory-mapped (rows, dim) matrix of all rows
+        """
+        row_count = self.get_row_count()
+        if row_count == 0:
+            return np.empty((0, self.dim), dtype=self.dtype)
+
+        return np.memmap(self.get_filename(FEATURES_EXT), dtype=self.dtype, mode="r", shape=(row_count, self.dim))
+
+    def get_stale_ids(self, mtimes: dict) -> list:
+        """
+        :param mtimes: id -> modification time (ns) of its source
+        :return: ids that are not in the store or whose source changed
+        """
+        return [source_id for source_id, mtime in mtimes.items()
+                if source_id not in self.index or self.index[source_id][0] != mtime]
+
+    def get_features(self, ids: list) -> np.ndarray:
+        """
+        :param ids: ids in the store
+        :return: (len(ids), dim) features; the memory-mapped matrix itself if the ids are all its rows in order
+        """
+        rows = np.array([self.index[source_id][1] for source_id in ids], dtype=np.int64)
+        matrix = self.get_matrix()
+        if len(rows) == len(matrix) and np.array_equal(rows, np.arange(len(rows))):
+            return matrix
+
+        return np.asarray(matrix[rows])
+
+    def append(self, ids: list, mtimes: list, features: np.ndarray):
+        """
+        appends the features of new or changed sources; the rows they replace are kept until compact()
+        :param ids: ids of the rows
+        :param mtimes: modification times (ns) of the sources
+        :param features: (len(ids), dim) features
+        """
+        if not ids:
+            return
+
+        features = np.ascontiguousarray(features, dtype=self.dtype).reshape(len(ids), self.dim)
+        os.makedirs(os.path.dirname(self.get_filename(FEATURES_EXT)), exist_ok=True)
+        self._save_meta()
+
+        # the rows are written before the index so that an interrupted append leaves only unused rows
+        first_row = self.get_row_count()
+        with open(self.get_filename(FEATURES_EXT), "ab") as features_file:
+            features_file.truncate(first_row * self.row_bytes)
+            features_file.write(features.tobytes())
+
+        index_filename = self.get_filename(INDEX_EXT)
+        is_new_index = not os.path.exists(index_filename)
+        with open(index_filename, "a", newline="", encoding="utf-8") as index_file:
+            writer = csv.writer(index_file)
+            if is_new_index:
+                writer.writerow(INDEX_COLUMNS)
+            for offset, (source_id, mtime) in enumerate(zip(ids, mtimes)):
+                writer.writerow([source_id, int(mtime), first_row + offset])
+                self.index[source_id] = (int(mtime), first_row + offset)
+
+        if self.get_row_count() - len(self.index) > MAX_GARBAGE_RATIO * self.get_row_count():
+            self.compact()
+
+    def update(self, sources: dict, max_workers: int = None, calculate_all=calculate_all_file_features) -> list:
+        """
+        computes and appends the features of the new or changed image files
+        :param sources: id -> image filename
+        :param max_workers: number of processes
+        :param calculate_all: function that returns the features (or None) of a list of image files
+            (e.g., calculate_all_file_features, calculate_all_file_hashes)
+        :return: ids of the sources with features in the order of sources
+        """
+        mtimes = dict()
+        for source_id, image_path in sources.items():
+            try:
+                mtimes[source_id] = os.stat(image_path).st_mtime_ns
+            except OSError as e:
+                logger.error(f"Cannot stat {image_path}: {e}")
+
+        stale_ids = self.get_stale_ids(mtimes)
+        if stale_ids:
+            logger.info(f"Calculating the features of {len(stale_ids)} {self.name} of project {self.project_id}")
+            calculated = calculate_all([sources[source_id] for source_id in stale_ids], max_workers)
+            readable = [(source_id, features) for source_id, features in zip(stale_ids, calculated)
+                        if features is not None]
+            self.append([source_id for source_id, _ in readable],
+                        [mtimes[source_id] for source_id, _ in readable],
+                        np.array([features for _, features in readable], dtype=self.dtype))
+
+        return [source_id for source_id in mtimes if source_id in self.index and
+                self.index[source_id][0] == mtimes[source_id]]
+
+    def update_array(self, array_filename: str, ids: list, max_workers: int = None) -> list:
+        """
+        computes and appends the features of the images packed in an array file (e.g., label crops);
+        the features of all its rows are stale when the array file changed
+        :param array_filename: .npy file of (len(ids), height, width, 3) uint8 images
+        :param ids: id of each row of the array
+        :param max_workers: number of processes
+        :return: ids
+        """
+        mtime = os.stat(array_filename).st_mtime_ns
+        stale_ids = set(self.get_stale_ids({source_id: mtime for source_id in ids}))
+        if stale_ids:
+            logger.info(f"Calculating the features of {len(stale_ids)} {self.name} of project {self.project_id}")
+            stale_rows = [row for row, source_id in enumerate(ids) if source_id in stale_ids]
+            self.append([ids[row] for row in stale_rows], [mtime] * len(stale_rows),
+                        calculate_all_array_features(array_filename, stale_rows, max_workers))
+
+        return list(ids)
+
+    def compact(self, ids: list = None):
+        """
+        rewrites the store with only the current rows (in the order of ids)
+        :param ids: ids to keep; defaults to all the ids in the store
+        """
+        ids = list(self.index.keys()) if ids is None else [source_id for source_id in ids if source_id in self.index]
+        features = self.get_features(ids) if ids else np.empty((0, self.dim), dtype=self.dtype)
+        mtimes = [self.index[source_id][0] for source_id in ids]
+        logger.info(f"Compacting the {self.name} features of project {self.project_id} to {len(ids)} rows")
+
+        features_filename, index_filename = self.get_filename(FEATURES_EXT), self.get_filename(INDEX_EXT)
+        with open(features_filename + ".tmp", "wb") as features_file:
+            features_file.write(np.ascontiguousarray(features, dtype=self.dtype).tobytes())
+        # the memory map of the features file has to be closed before it is replaced
+        del features
+        pd.DataFrame({'id': ids, 'mtime_ns': mtimes, 'row': np.arange(len(ids))}).to_csv(index_filename + ".tmp",
+                                                                                     index=False)
+        os.replace(features_filename + ".tmp", features_filename)
+        os.replace(index_filename + ".tmp", index_filename)
+        self.index = {source_id: (mtime, row) for row, (source_id, mtime) in enumerate(zip(ids, mtimes))}
+
+    def find_nearest(self, query: np.ndarray, ids: list = None, k: int = 10) -> list:
+        """
+        brute-force similarity search over the memory-mapped rows, chunk by chunk
+        :param query: (dim,) features
+        :param ids: ids to search; defaults to all the ids in the store
+        :param k: number of neighbors
+        :return: (id, euclidean distance) of the k nearest rows
+        """
+        ids = list(self.index.keys()) if ids is None else ids
+        rows = np.array([self.index[source_id][1] for source_id in ids], dtype=np.int64)
+        matrix = self.get_matrix()
+        query = np.asarray(query, dtype=np.float32)
+
+        distances = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), SEARCH_CHUNK_SIZE):
+            chunk = np.asarray(matrix[rows[start:start + SEARCH_CHUNK_SIZE]], dtype=np.float32)
+            distances[start:start + len(chunk)] = np.linalg.norm(chunk - query, axis=1)
+
+        nearest = np.argsort(distances)[:k]
+        return [(ids[row], float(distances[row])) for row in nearest]
+
+    def _save_meta(self):
+        meta_filename = self.get_filename(META_EXT)
+        if not os.path.exists(meta_filename):
+            with open(meta_filename, "w", encoding="utf-8") as meta_file:
+                json.dump({"dim": self.dim, "dtype": self.dtype}, meta_file)
+
+    @staticmethod
+    def open(project_id: int, name: str, dim: int = FEATURE_DIM, dtype="float32") -> 'FeatureStore':
+        """
+        :param project_id: project id
+        :param name: kind of the features (e.g., images, labels)
+        :param dim: number of features per row
+        :param dtype: type of the stored features (e.g., float32, float16)
+        :return: the store of the project; a store with another dim or dtype is emptied
+        """
+        store = FeatureStore(project_id=project_id, name=name, dim=dim, dtype=dtype)
+        meta_filename, index_filename = store.get_filename(META_EXT), store.get_filename(INDEX_EXT)
+        meta = dict()
+        if os.path.exists(meta_filename):
+            with open(meta_filename, encoding="utf-8") as meta_file:
+                meta = json.load(meta_file)
+
+        if meta != {"dim": store.dim, "dtype": store.dtype}:
+            if meta:
+                logger.warning(f"Emptying the {name} features of project {project_id}: {meta}")
+            for ext in (FEATURES_EXT, INDEX_EXT, META_EXT):
+                if os.path.exists(store.get_filename(ext)):
+                    os.remove(store.get_filename(ext))
+            return store
+
+        if os.path.exists(index_filename):
+            df_index = pd.read_csv(index_filename, dtype={'id': str})
+            # rows beyond the features file were not written completely
+            df_index = df_index[df_index['row'] < store.get_row_count()]
+            # the last row of an id is its current row
+            store.index = {source_id: (int(mtime), int(row))
+                           for source_id, mtime, row in df_index[INDEX_COLUMNS].itertuples(index=False, name=None)}
+
+        return store
@@ -0,0 +1,133 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from src.common.constants import ADQ_WORKING_FOLDER
+from src.common.logger import get_logger
+
+logger = get_logger(__name__)
+
+"""
+.. module:: features
+   :synopsis: compact feature vectors of images and label crops for clustering and anomaly detection
+    Instead of the raw pixels, an image is described by a color histogram, a downsampled grayscale image
+    and a histogram of oriented gradients (HOG) of a 32x32 version of it (FEATURE_DIM float32 values).
+    The features are computed in a process pool and persisted per project in the feature store,
+    so that only new or changed images are computed again.
+"""
+
+FEATURE_IMAGE_SIZE = (32, 32)
+COLOR_BINS = 8
+GRAY_SIZE = (8, 8)
+HOG_CELL_SIZE = 8
+HOG_BINS = 9
+FEATURE_DIM = (3 * COLOR_BINS + GRAY_SIZE[0] * GRAY_SIZE[1] +
+               (FEATURE_IMAGE_SIZE[0] // HOG_CELL_SIZE) * (FEATURE_IMAGE_SIZE[1] // HOG_CELL_SIZE) * HOG_BINS)
+# with fewer images, starting the process pool takes longer than computing the features
+MIN_PARALLEL_IMAGES = 64
+FEATURES_FOLDER = "features"
+CLUSTERS_EXT = ".clusters.pkl"
+
+
+def get_clusters_filename(project_id: int, name: str) -> str:
+    """
+    :return: cached cluster assignments of the features of a project
+    """
+    return os.path.join(ADQ_WORKING_FOLDER, str(project_id), FEATURES_FOLDER, name + CLUSTERS_EXT)
+
+
+def calculate_hog(gray: np.ndarray) -> np.ndarray:
+    """
+    :param gray: grayscale image (FEATURE_IMAGE_SIZE) as floats
+    :return: L2-normalized histogram of unsigned gradient orientations per cell
+    """
+    gy, gx = np.gradient(gray)
+    magnitudes = np.hypot(gx, gy)
+    bins = ((np.rad2deg(np.arctan2(gy, gx)) % 180) / (180 / HOG_BINS)).astype(int) % HOG_BINS
+
+    rows, cols = gray.shape[0] // HOG_CELL_SIZE, gray.shape[1] // HOG_CELL_SIZE
+    cell_indices = ((np.arange(gray.shape[0]) // HOG_CELL_SIZE)[:, None] * cols +
+                    (np.arange(gray.shape[1]) // HOG_CELL_SIZE)[None, :])
+    hog = np.bincount((cell_indices * HOG_BINS + bins).ravel(), weights=magnitudes.ravel(),
+                      minlength=rows * cols * HOG_BINS)
+    norm = np.linalg.norm(hog)
+    return hog / norm if norm > 0 else hog
+
+
+def calculate_image_features(image: np.ndarray) -> np.ndarray:
+    """
+    :param image: RGB image (height, width, 3) as uint8
+    :return: FEATURE_DIM float32 features
+    """
+    image = np.asarray(Image.fromarray(image).resize(FEATURE_IMAGE_SIZE, Image.BILINEAR), dtype=np.float32)
+    color_histogram = np.concatenate([np.histogram(image[:, :, channel], bins=COLOR_BINS, range=(0, 256))[0]
+                                      for channel in range(3)]) / (image.shape[0] * image.shape[1])
+    gray = image @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    downsampled = np.asarray(Image.fromarray(gray).resize(GRAY_SIZE, Image.BILINEAR)).ravel() / 255
+
+    return np.concatenate([color_histogram, downsampled, calculate_hog(gray)]).astype(np.float32)
+
+
+def calculate_file_features(image_path: str) -> np.ndarray:
+    """
+    :param image_path: image filename
+    :return: FEATURE_DIM float32 features or None if the image cannot be read
+    """
+    try:
+        with Image.open(image_path) as image:
+            # JPEG images are decoded at a reduced scale
+            image.draft("RGB", (FEATURE_IMAGE_SIZE[0] * 2, FEATURE_IMAGE_SIZE[1] * 2))
+            return calculate_image_features(np.asarray(image.convert("RGB")))
+    except Exception as e:
+        logger.error(f"Cannot read {image_path}: {e}")
+        return None
+
+
+def calculate_all_file_features(image_paths: list, max_workers: int = None) -> list:
+    """
+    :param image_paths: image filenames
+    :param max_workers: number of processes; defaults to the number of CPUs
+    :return: features or None of each image in the order of image_paths
+    """
+    if len(image_paths) < MIN_PARALLEL_IMAGES:
+        return [calculate_file_features(image_path) for image_path in image_paths]
+
+    max_workers = max_workers or os.cpu_count() or 1
+    chunksize = max(1, len(image_paths) // (max_workers * 4))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(calculate_file_features, image_paths, chunksize=chunksize))
+
+
+def calculate_array_features(array_filename: str, rows: np.ndarray) -> np.ndarray:
+    """
+    :param array_filename: .npy file of packed (N, height, width, 3) uint8 images (e.g., label crops)
+    :param rows: rows of the images
+    :return: (len(rows), FEATURE_DIM) float32 features
+    """
+    images = np.load(array_filename, mmap_mode="r")
+    features = np.empty((len(rows), FEATURE_DIM), dtype=np.float32)
+    for idx, row in enumerate(rows):
+        features[idx] = calculate_image_features(np.asarray(images[row]))
+
+    return features
+
+
+def calculate_all_array_features(array_filename: str, rows: list, max_workers: int = None) -> np.ndarray:
+    """
+    :param array_filename: .npy file of packed (N, height, width, 3) uint8 images
+    :param rows: rows of the images
+    :param max_workers: number of processes; defaults to the number of CPUs
+    :return: (len(rows), FEATURE_DIM) float32 features in the order of rows
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(rows) < MIN_PARALLEL_IMAGES:
+        return calculate_array_features(array_filename, rows)
+
+    # the workers read their rows from the memory-mapped file instead of receiving the pixels
+    max_workers = max_workers or os.cpu_count() or 1
+    row_chunks = np.array_split(rows, min(len(rows), max_workers * 4))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return np.concatenate(list(executor.map(calculate_array_features, [array_filename] * len(row_chunks),
+                                                row_chunks)))
@@ -0,0 +1,82 @@
+import datetime as dt
+import os
+
+import pandas as pd
+
+from src.common.constants import SUPPORTED_IMAGE_FILE_EXTENSIONS
+from src.common.logger import get_logger
+
+logger = get_logger(__name__)
+
+"""
+.. module:: file_inventory
+   :synopsis: name, size and times of the files in the data folders from a single os.scandir pass per folder
+    The inventory of a folder is cached in memory until the modification time of the folder changes,
+    i.e., until a file is added, removed or renamed.
+"""
+
+INVENTORY_COLUMNS = ['name', 'size', 'ctime', 'mtime']
+
+# (folder, extensions) -> (folder mtime_ns, inventory)
+_inventories = dict()
+
+
+def scan_folder(folder: str, patterns=SUPPORTED_IMAGE_FILE_EXTENSIONS) -> pd.DataFrame:
+    """
+    :param folder: folder to scan (not recursively)
+    :param patterns: file extensions to include; None for all files
+    :return: one row per file (INVENTORY_COLUMNS) sorted by name; ctime and mtime are local datetimes.
+        The frame is shared by the callers until the folder changes; copy it before modifying it
+    """
+    try:
+        folder_mtime = os.stat(folder).st_mtime_ns
+    except OSError as e:
+        logger.error(f"Cannot scan {folder}: {e}")
+        return pd.DataFrame(columns=INVENTORY_COLUMNS)
+
+    extensions = tuple('.' + pattern for pattern in patterns) if patterns else None
+    cached = _inventories.get((folder, extensions))
+    if cached and cached[0] == folder_mtime:
+        return cached[1]
+
+    rows = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.is_file() or (extensions and not entry.name.endswith(extensions)):
+                continue
+            try:
+                # DirEntry caches the result of stat (no system call on Windows)
+                file_stat = entry.stat()
+            except OSError as e:
+                logger.error(f"Cannot stat {entry.path}: {e}")
+                continue
+            rows.append((entry.name, file_stat.st_size,
+                         dt.datetime.fromtimestamp(file_stat.st_ctime), dt.datetime.fromtimestamp(file_stat.st_mtime)))
+
+    df_inventory = pd.DataFrame(rows, columns=INVENTORY_COLUMNS).sort_values('name', ignore_index=True)
+    _inventories[(folder, extensions)] = (folder_mtime, df_inventory)
+    return df_inventory
+
+
+def get_file_inventory(files_dict: dict) -> pd.DataFrame:
+    """
+    :param files_dict: folder -> filenames (relative to the folder or full paths)
+    :return: one row per listed file (INVENTORY_COLUMNS) with the folder and the full path of the file
+    """
+    folder_files = dict()
+    for folder, files in files_dict.items():
+        for file in files:
+            full_path = os.path.join(folder, file)
+            folder_files.setdefault(os.path.dirname(full_path), set()).add(os.path.basename(full_path))
+
+    df_folders = []
+    for folder, filenames in folder_files.items():
+        df_inventory = scan_folder(folder, patterns=None)
+        df_inventory = df_inventory[df_inventory['name'].isin(filenames)]
+        df_folders.append(df_inventory.assign(folder=folder,
+                                              path=[os.path.join(folder, name) for name in df_inventory['name']]))
+
+    if not df_folders:
+        return pd.DataFrame(columns=INVENTORY_COLUMNS + ['folder', 'path'])
+
+    return pd.concat(df_folders, ignore_index=True)
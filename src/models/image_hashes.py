@@ -0,0 +1,206 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from scipy import fft
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from src.common.logger import get_logger
+from src.models.thumbnails import scan_image_mtimes
+
+logger = get_logger(__name__)
+
+"""
+.. module:: image_hashes
+   :synopsis: perceptual hashes of images and groups of duplicate and near-duplicate images
+    Each image gets a 64-bit pHash (signs of the low frequencies of the DCT) and a 64-bit dHash (signs of the
+    horizontal gradients), HASH_BYTES uint8 values that are kept in the feature store ("hashes").
+    They are computed from the thumbnails in a process pool.
+    Near-duplicates are found by multi-index hashing: the 128 bits are split into more than max distance chunks,
+    so that two hashes within the max distance have at least one equal chunk (pigeonhole principle).
+    Only the pairs that share a chunk are compared, which makes the search sub-linear per image.
+        python -m src.models.image_hashes <image folder>... [--distance N]
+"""
+
+HASH_SIZE = 8
+HASH_BYTES = 2 * HASH_SIZE * HASH_SIZE // 8
+PHASH_IMAGE_SIZE = 32
+# maximum number of different bits of the hashes (pHash and dHash) of near-duplicate images
+DUPLICATE_DISTANCE = 7
+# with fewer images, starting the process pool takes longer than computing the hashes
+MIN_PARALLEL_IMAGES = 64
+
+
+def calculate_hashes(gray: Image) -> np.ndarray:
+    """
+    :param gray: grayscale PIL image
+    :return: HASH_BYTES uint8 values; the pHash followed by the dHash
+    """
+    pixels = np.asarray(gray.resize((PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE), Image.BILINEAR), dtype=np.float32)
+    low_frequencies = fft.dctn(pixels, norm="ortho")[:HASH_SIZE, :HASH_SIZE].ravel()
+    # the DC coefficient is the mean brightness and does not describe the structure
+    phash = low_frequencies > np.median(low_frequencies[1:])
+
+    pixels = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    dhash = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+
+    return np.packbits(np.concatenate([phash, dhash]))
+
+
+def calculate_file_hashes(image_path: str) -> np.ndarray:
+    """
+    :param image_path: image filename (e.g., a thumbnail)
+    :return: HASH_BYTES uint8 values or None if the image cannot be read
+    """
+    try:
+        with Image.open(image_path) as image:
+            image.draft("L", (PHASH_IMAGE_SIZE * 2, PHASH_IMAGE_SIZE * 2))
+            return calculate_hashes(image.convert("L"))
+    except Exception as e:
+        logger.error(f"Cannot read {image_path}: {e}")
+        return None
+
+
+def calculate_all_file_hashes(image_paths: list, max_workers: int = None) -> list:
+    """
+    :param image_paths: image filenames
+    :param max_workers: number of processes; defaults to the number of CPUs
+    :return: hashes or None of each image in the order of image_paths
+    """
+    if len(image_paths) < MIN_PARALLEL_IMAGES:
+        return [calculate_file_hashes(image_path) for image_path in image_paths]
+
+    max_workers = max_workers or os.cpu_count() or 1
+    chunksize = max(1, len(image_paths) // (max_workers * 4))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(calculate_file_hashes, image_paths, chunksize=chunksize))
+
+
+def count_bits(values: np.ndarray) -> np.ndarray:
+    """
+    :param values: uint64 values
+    :return: number of set bits of each value (SWAR popcount)
+    """
+    with np.errstate(over="ignore"):
+        values = values - ((values >> np.uint64(1)) & np.uint64(0x5555555555555555))
+        values = (values & np.uint64(0x3333333333333333)) + ((values >> np.uint64(2)) & np.uint64(0x3333333333333333))
+        values = (values + (values >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+        return (values * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def to_words(hashes: np.ndarray) -> np.ndarray:
+    """
+    :param hashes: (n, HASH_BYTES) uint8 hashes
+    :return: (n, 2) uint64 pHashes and dHashes
+    """
+    return np.ascontiguousarray(hashes, dtype=np.uint8).view(">u8").astype(np.uint64)
+
+
+def get_distances(left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """
+    :return: number of different bits of each pair of (n, 2) uint64 hashes
+    """
+    return (count_bits(left[:, 0] ^ right[:, 0]) + count_bits(left[:, 1] ^ right[:, 1])).astype(np.int64)
+
+
+def get_chunk_keys(words: np.ndarray, max_distance: int) -> list:
+    """
+    :param words: (n, 2) uint64 hashes
+    :param max_distance: maximum number of different bits
+    :return: one key array per chunk; equal-sized chunks, at least max_distance + 1 of them.
+        Up to 7, the chunks have 16 bits or more; above 7, the 8-bit chunks make many more rows share a chunk
+    """
+    chunk_count = next((count for count in (2, 4, 8, 16) if count > max_distance), None)
+    if chunk_count is None:
+        raise ValueError(f"The maximum distance {max_distance} is above 15")
+
+    chunk_bits = 2 * HASH_SIZE * HASH_SIZE // chunk_count
+    mask = np.uint64((1 << chunk_bits) - 1) if chunk_bits < 64 else np.uint64(0xFFFFFFFFFFFFFFFF)
+    return [(words[:, word] >> np.uint64(shift)) & mask
+            for word in range(2) for shift in range(0, HASH_SIZE * HASH_SIZE, chunk_bits)]
+
+
+def find_near_duplicate_pairs(words: np.ndarray, max_distance: int = DUPLICATE_DISTANCE) -> (np.ndarray, np.ndarray):
+    """
+    multi-index hashing: the rows sharing a chunk value are compared with a sweep over the rows sorted by the chunk
+    :param words: (n, 2) uint64 hashes without repeated rows
+    :param max_distance: maximum number of different bits of the hashes
+    :return: row pairs (left < right) of near-duplicates
+    """
+    lefts, rights = [], []
+    for keys in get_chunk_keys(words, max_distance):
+        order = np.argsort(keys, kind="stable")
+        sorted_keys, sorted_words = keys[order], words[order]
+        # only the rows followed by a row with the same chunk value take part in the sweep
+        active = np.flatnonzero(sorted_keys[1:] == sorted_keys[:-1])
+        distance = 1
+        while len(active) > 0:
+            active = active[active + distance < len(order)]
+            # a row leaves the sweep when the rows at this distance have another chunk value
+            active = active[sorted_keys[active + distance] == sorted_keys[active]]
+            near = active[get_distances(sorted_words[active], sorted_words[active + distance]) <= max_distance]
+            left, right = order[near], order[near + distance]
+            lefts.append(np.minimum(left, right))
+            rights.append(np.maximum(left, right))
+            distance += 1
+
+    if not lefts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    # a pair sharing several chunks is found once per chunk
+    pairs = np.unique(np.concatenate(lefts) * len(words) + np.concatenate(rights))
+    return pairs // len(words), pairs % len(words)
+
+
+def find_duplicate_groups(ids: list, hashes: np.ndarray, max_distance: int = DUPLICATE_DISTANCE) -> list:
+    """
+    :param ids: id of each hash
+    :param hashes: (len(ids), HASH_BYTES) uint8 hashes
+    :param max_distance: maximum number of different bits of the hashes
+    :return: lists of the ids of duplicate and near-duplicate images, the largest groups first
+    """
+    if len(ids) < 2:
+        return []
+
+    # identical hashes are merged first so that a burst of identical frames is one row of the search
+    words = to_words(hashes)
+    order = np.lexsort((words[:, 1], words[:, 0]))
+    is_first = np.concatenate([[True], np.any(np.diff(words[order].view(np.int64), axis=0) != 0, axis=1)])
+    inverse = np.empty(len(order), dtype=np.int64)
+    inverse[order] = np.cumsum(is_first) - 1
+    unique_rows = order[is_first]
+
+    left, right = find_near_duplicate_pairs(words[unique_rows], max_distance)
+    graph = coo_matrix((np.ones(len(left), dtype=np.int8), (left, right)),
+                       shape=(len(unique_rows), len(unique_rows)))
+    _, components = connected_components(graph, directed=False)
+
+    image_components = components[inverse]
+    sizes = np.bincount(image_components)
+    rows = np.flatnonzero(sizes[image_components] > 1)
+    rows = rows[np.argsort(image_components[rows], kind="stable")]
+    boundaries = np.flatnonzero(np.diff(image_components[rows])) + 1
+    groups = [[ids[row] for row in group_rows] for group_rows in np.split(rows, boundaries) if len(group_rows) > 1]
+
+    return sorted(groups, key=len, reverse=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Groups the duplicate and near-duplicate images of folders")
+    parser.add_argument("folders", nargs="+", help="image folders (e.g., thumbnails)")
+    parser.add_argument("--distance", type=int, default=DUPLICATE_DISTANCE, help="maximum number of different bits")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes")
+    args = parser.parse_args()
+
+    paths = [os.path.join(folder, filename) for folder in args.folders for filename in sorted(scan_image_mtimes(folder))]
+    readable = [(path, image_hashes) for path, image_hashes in
+                zip(paths, calculate_all_file_hashes(paths, max_workers=args.workers)) if image_hashes is not None]
+    duplicate_groups = find_duplicate_groups([path for path, _ in readable],
+                                             np.array([image_hashes for _, image_hashes in readable]),
+                                             max_distance=args.distance)
+    print(f"{sum(len(group) for group in duplicate_groups)} of {len(paths)} images in {len(duplicate_groups)} groups")
+    for group in duplicate_groups:
+        print("  " + ", ".join(group))
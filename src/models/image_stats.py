@@ -0,0 +1,144 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageStat
+
+from src.common.logger import get_logger
+
+logger = get_logger(__name__)
+
+"""
+.. module:: image_stats
+   :synopsis: per-image statistics (dimensions, aspect ratio, brightness) of the data folders
+    The dimensions are read from the image headers and the brightness is calculated on a reduced decode
+    (JPEG draft mode), in a process pool for large folders.
+    The statistics are cached next to each folder (<folder>.stats.csv) and reused for the files
+    whose size and modification time (ns) did not change.
+"""
+
+IMAGE_STATS_EXT = ".stats.csv"
+IMAGE_STATS_COLUMNS = ['filename', 'size', 'mtime_ns', 'width', 'height', 'aspect_ratio', 'brightness']
+
+# JPEG images are decoded at 1/8 of their size to calculate the brightness
+BRIGHTNESS_SCALE = 8
+# with fewer images, starting the process pool takes longer than calculating the statistics
+MIN_PARALLEL_IMAGES = 64
+
+EXIF_ORIENTATION_TAG = 0x0112
+# orientations in which the image is stored rotated by 90 degrees
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def get_stats_filename(folder: str) -> str:
+    folder = os.path.normpath(folder)
+    return os.path.join(os.path.dirname(folder), os.path.basename(folder) + IMAGE_STATS_EXT)
+
+
+def calculate_image_stats(image_path: str) -> tuple:
+    """
+    :param image_path: image filename
+    :return: (width, height, brightness) or None if the image cannot be read
+    """
+    try:
+        with Image.open(image_path) as image:
+            width, height = image.size
+            is_transposed = image.getexif().get(EXIF_ORIENTATION_TAG) in TRANSPOSED_ORIENTATIONS
+            # no-op for the formats other than JPEG
+            image.draft("L", (max(1, width // BRIGHTNESS_SCALE), max(1, height // BRIGHTNESS_SCALE)))
+            brightness = ImageStat.Stat(image.convert("L")).mean[0]
+    except Exception as e:
+        logger.error(f"Cannot read {image_path}: {e}")
+        return None
+
+    if is_transposed:
+        width, height = height, width
+
+    return width, height, brightness
+
+
+def calculate_all_image_stats(image_paths: list, max_workers: int = None) -> list:
+    """
+    :param image_paths: image filenames
+    :param max_workers: number of processes; defaults to the number of CPUs
+    :return: list of (width, height, brightness) or None in the order of image_paths
+    """
+    if len(image_paths) < MIN_PARALLEL_IMAGES or max_workers == 1:
+        return [calculate_image_stats(image_path) for image_path in image_paths]
+
+    max_workers = max_workers or os.cpu_count() or 1
+    chunksize = max(1, len(image_paths) // (max_workers * 4))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(calculate_image_stats, image_paths, chunksize=chunksize))
+
+
+def load_image_stats(folder: str, filenames: list, max_workers: int = None) -> pd.DataFrame:
+    """
+    loads the cached statistics of a folder and calculates (and caches) the ones of new or changed files
+    :param folder: data folder
+    :param filenames: image filenames in the folder
+    :param max_workers: number of processes; defaults to the number of CPUs
+    :return: one row per readable image (IMAGE_STATS_COLUMNS)
+    """
+    stats_filename = get_stats_filename(folder)
+    cached = dict()
+    if os.path.exists(stats_filename):
+        try:
+            df_cached = pd.read_csv(stats_filename, dtype={'filename': str})
+            cached = {row[0]: row for row in df_cached[IMAGE_STATS_COLUMNS].itertuples(index=False, name=None)}
+        except (ValueError, KeyError) as e:
+            logger.warning(f"Ignoring {stats_filename}: {e}")
+
+    rows = []
+    to_calculate = []
+    for filename in filenames:
+        try:
+            file_stat = os.stat(os.path.join(folder, filename))
+        except OSError as e:
+            logger.error(f"Cannot stat {filename}: {e}")
+            continue
+
+        row = cached.get(filename)
+        if row is not None and row[1] == file_stat.st_size and row[2] == file_stat.st_mtime_ns:
+            rows.append(row)
+        else:
+            to_calculate.append((filename, file_stat.st_size, file_stat.st_mtime_ns))
+
+    if to_calculate:
+        logger.info(f"Calculating the statistics of {len(to_calculate)} images in {folder}")
+        image_paths = [os.path.join(folder, filename) for filename, _, _ in to_calculate]
+        for (filename, size, mtime_ns), stats in zip(to_calculate, calculate_all_image_stats(image_paths, max_workers)):
+            # unreadable images are cached too so that they are not read again until they change
+            width, height, brightness = stats if stats else (np.nan, np.nan, np.nan)
+            aspect_ratio = width / height if stats and height else np.nan
+            rows.append((filename, size, mtime_ns, width, height, aspect_ratio, brightness))
+
+    df_stats = pd.DataFrame(rows, columns=IMAGE_STATS_COLUMNS)
+    if to_calculate or len(cached) != len(rows):
+        try:
+            df_stats.to_csv(stats_filename, index=False)
+        except OSError as e:
+            logger.warning(f"Cannot cache the image statistics: {e}")
+
+    return df_stats.dropna(subset=['width', 'height']).reset_index(drop=True)
+
+
+def get_image_stats(files_dict: dict, max_workers: int = None) -> pd.DataFrame:
+    """
+    :param files_dict: folder -> image filenames (relative to the folder or full paths)
+    :param max_workers: number of processes; defaults to the number of CPUs
+    :return: one row per readable image (IMAGE_STATS_COLUMNS) with the folder of the image
+    """
+    folder_files = dict()
+    for folder, files in files_dict.items():
+        for file in files:
+            image_path = os.path.join(folder, file)
+            folder_files.setdefault(os.path.dirname(image_path), []).append(os.path.basename(image_path))
+
+    df_folders = [load_image_stats(folder, filenames, max_workers).assign(folder=folder)
+                  for folder, filenames in folder_files.items()]
+    if not df_folders:
+        return pd.DataFrame(columns=IMAGE_STATS_COLUMNS + ['folder'])
+
+    return pd.concat(df_folders, ignore_index=True)
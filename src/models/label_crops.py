@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from src.common.logger import get_logger
+from src.common.utils import get_crop_box
+from src.models.data_labels import DataLabels
+
+logger = get_logger(__name__)
+
+"""
+.. module:: label_crops
+   :synopsis: crops of the label objects of a task packed into one array file
+    Each source image is decoded once and all its object crops are sliced out of the same array and resized.
+    The images are processed in a process pool and the crops are written into <task>/label_crops.npy
+    (N, height, width, 3) with an index (label_crops.csv) of the image, object and class of each crop.
+    The crops are extracted again when the label file or one of the images changed.
+        python -m src.models.label_crops <task folder> <label file> [--workers N]
+"""
+
+CROPS_FILE_STEM = "label_crops"
+CROPS_EXT = ".npy"
+CROPS_INDEX_EXT = ".csv"
+CROPS_META_EXT = ".json"
+CROP_SIZE = (50, 50)
+CROP_INDEX_COLUMNS = ['filename', 'object_index', 'label']
+# keypoints and vanishing points have no extent, so their surroundings are cropped as in the viewer previews
+POINT_CROP_SIZE = 64
+POINT_TYPES = ('keypoint', 'VP')
+# with fewer images, starting the process pool takes longer than extracting the crops
+MIN_PARALLEL_IMAGES = 16
+
+
+def get_crops_filename(task_folder: str, ext: str = CROPS_EXT) -> str:
+    return os.path.join(task_folder, CROPS_FILE_STEM + ext)
+
+
+def get_object_rectangles(image: DataLabels.Image) -> list:
+    """
+    :return: (object index, label, bounding rectangle, minimum crop size) of the objects with points
+    """
+    rectangles = []
+    for object_index, label_object in enumerate(image.objects):
+        if not label_object.points:
+            continue
+        min_size = POINT_CROP_SIZE if label_object.type in POINT_TYPES else 1
+        rectangles.append((object_index, label_object.label,
+                           DataLabels.Object.get_bounding_rectangle(label_object)[:4], min_size))
+
+    return rectangles
+
+
+def extract_image_crops(image_path: str, rectangles: list, size: tuple = CROP_SIZE) -> (list, np.ndarray):
+    """
+    :param image_path: image filename
+    :param rectangles: (object index, label, rectangle, minimum crop size) of the objects
+    :param size: (width, height) of the crops
+    :return: (object index, label) of the extracted crops and the (n, height, width, 3) uint8 crops
+    """
+    try:
+        with Image.open(image_path) as image:
+            pixels = np.asarray(image.convert("RGB"))
+    except Exception as e:
+        logger.error(f"Cannot read {image_path}: {e}")
+        return [], np.empty((0, size[1], size[0], 3), dtype=np.uint8)
+
+    height, width = pixels.shape[:2]
+    keys, crops = [], []
+    for object_index, label, rectangle, min_size in rectangles:
+        crop_box = get_crop_box(rectangle, width, height, min_size)
+        if crop_box is None:
+            continue
+        xtl, ytl, xbr, ybr = crop_box
+        # the slice is a view of the decoded image; only the resized crop is copied
+        crops.append(cv2.resize(pixels[ytl:ybr, xtl:xbr], size, interpolation=cv2.INTER_AREA))
+        keys.append((object_index, label))
+
+    return keys, np.array(crops, dtype=np.uint8).reshape(len(crops), size[1], size[0], 3)
+
+
+def _extract_image_crops(args: tuple) -> (list, np.ndarray):
+    return extract_image_crops(*args)
+
+
+def get_sources(anno_file_name: str, data_folder: str, image_names: list) -> dict:
+    """
+    :return: modification times (ns) of the label file and the images the crops are extracted from
+    """
+    sources = {os.path.basename(anno_file_name): os.stat(anno_file_name).st_mtime_ns}
+    for image_name in image_names:
+        image_path = os.path.join(data_folder, image_name)
+        sources[image_name] = os.stat(image_path).st_mtime_ns if os.path.exists(image_path) else None
+
+    return sources
+
+
+def is_stale(task_folder: str, sources: dict) -> bool:
+    """
+    :return: True if the crops do not exist or were extracted from other versions of the sources
+    """
+    meta_filename = get_crops_filename(task_folder, CROPS_META_EXT)
+    if not os.path.exists(meta_filename) or not os.path.exists(get_crops_filename(task_folder)):
+        return True
+
+    with open(meta_filename, encoding="utf-8") as meta_file:
+        return json.load(meta_file).get("sources") != sources
+
+
+def extract_task_crops(task_folder: str, anno_file_name: str, size: tuple = CROP_SIZE,
+                       max_workers: int = None) -> (np.ndarray, pd.DataFrame):
+    """
+    extracts the crops of all the label objects of a task unless they are up to date
+    :param task_folder: .adq/<project id>/<task id> with the data folder
+    :param anno_file_name: label file of the task
+    :param size: (width, height) of the crops
+    :param max_workers: number of processes; defaults to the number of CPUs
+    :return: memory-mapped (N, height, width, 3) crops and their index (CROP_INDEX_COLUMNS)
+    """
+    data_folder = os.path.join(task_folder, "data")
+    data_labels = DataLabels.load(anno_file_name)
+    images = data_labels.images if data_labels else []
+    sources = get_sources(anno_file_name, data_folder, [image.name for image in images])
+
+    crops_filename, index_filename = get_crops_filename(task_folder), get_crops_filename(task_folder, CROPS_INDEX_EXT)
+    if not is_stale(task_folder, sources):
+        return np.load(crops_filename, mmap_mode="r"), pd.read_csv(index_filename, dtype={'filename': str,
+                                                                                           'label': str})
+
+    jobs = [(os.path.join(data_folder, image.name), get_object_rectangles(image), size) for image in images]
+    jobs = [job for job in jobs if job[1]]
+    logger.info(f"Extracting the label crops of {len(jobs)} images in {task_folder}")
+
+    # the crops are written into a temporary array file that replaces the old one when it is complete
+    object_count = sum(len(rectangles) for _, rectangles, _ in jobs)
+    temp_filename = crops_filename + ".tmp" + CROPS_EXT
+    crops = np.lib.format.open_memmap(temp_filename, mode="w+", dtype=np.uint8,
+                                      shape=(object_count, size[1], size[0], 3))
+    rows = []
+    if len(jobs) < MIN_PARALLEL_IMAGES:
+        results = map(_extract_image_crops, jobs)
+        rows = _write_crops(jobs, results, crops)
+    else:
+        max_workers = max_workers or os.cpu_count() or 1
+        chunksize = max(1, len(jobs) // (max_workers * 4))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            rows = _write_crops(jobs, executor.map(_extract_image_crops, jobs, chunksize=chunksize), crops)
+    crops.flush()
+    del crops
+
+    # unreadable images and objects outside of their image leave unused rows at the end
+    if len(rows) < object_count:
+        _truncate_crops(temp_filename, len(rows))
+    os.replace(temp_filename, crops_filename)
+
+    df_index = pd.DataFrame(rows, columns=CROP_INDEX_COLUMNS)
+    df_index.to_csv(index_filename, index=False)
+    with open(get_crops_filename(task_folder, CROPS_META_EXT), "w", encoding="utf-8") as meta_file:
+        json.dump({"sources": sources, "size": list(size)}, meta_file)
+
+    return np.load(crops_filename, mmap_mode="r"), df_index
+
+
+def _truncate_crops(crops_filename: str, row_count: int, chunk_size: int = 4096):
+    crops = np.load(crops_filename, mmap_mode="r")
+    truncated_filename = crops_filename + ".tmp" + CROPS_EXT
+    truncated = np.lib.format.open_memmap(truncated_filename, mode="w+", dtype=crops.dtype,
+                                          shape=(row_count,) + crops.shape[1:])
+    for start in range(0, row_count, chunk_size):
+        truncated[start:start + chunk_size] = crops[start:min(start + chunk_size, row_count)]
+    truncated.flush()
+    del crops, truncated
+    os.replace(truncated_filename, crops_filename)
+
+
+def _write_crops(jobs: list, results, crops: np.ndarray) -> list:
+    rows = []
+    for (image_path, _, _), (keys, image_crops) in zip(jobs, results):
+        crops[len(rows):len(rows) + len(image_crops)] = image_crops
+        rows.extend((os.path.basename(image_path), object_index, label) for object_index, label in keys)
+
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Extracts the crops of the label objects of a task")
+    parser.add_argument("task_folder", help="task folder with the data folder")
+    parser.add_argument("anno_file_name", help="label file of the task")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes")
+    args = parser.parse_args()
+
+    task_crops, task_index = extract_task_crops(args.task_folder, args.anno_file_name, max_workers=args.workers)
+    print(f"{get_crops_filename(args.task_folder)}: {len(task_index)} crops of "
+          f"{task_index['filename'].nunique()} images in {task_index['label'].nunique()} classes")
@@ -0,0 +1,306 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import attr
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import IsolationForest
+
+from src.common.constants import ADQ_WORKING_FOLDER
+from src.common.logger import get_logger
+from src.models.data_labels import DataLabels
+from src.models.label_rules import BOX_TYPES, get_object_table
+from src.models.report_engine import POLYGON_TYPES
+
+logger = get_logger(__name__)
+
+"""
+.. module:: label_outliers
+   :synopsis: per-class outlier scores of the label geometry and the review queue of the most suspicious objects
+    Each object with an area is described by its width, height and aspect ratio (log of the share of the image)
+    and the position of its center in the image.
+    The features and per-class histograms of each label file are cached next to it (<label file>.geometry.npz)
+    and computed again only when the label file changes.
+    The per-class medians and median absolute deviations (MAD) of the project come from the merged histograms,
+    so that the robust z-scores of the objects need no pass over the other tasks.
+    An isolation forest per class scores the combinations of the features that are unusual.
+    The objects with the highest scores are kept in a review queue (.adq/<project id>/outliers.csv)
+    that the viewer jumps through.
+        python -m src.models.label_outliers <project id> <label file>...
+"""
+
+GEOMETRY_EXT = ".geometry.npz"
+OUTLIERS_FILENAME = "outliers.csv"
+FEATURE_NAMES = ['log_width', 'log_height', 'log_aspect', 'center_x', 'center_y']
+# (min, max) of the histogram of each feature; the values outside are counted in the first or last bin
+FEATURE_RANGES = [(-10, 2), (-10, 2), (-6, 6), (-0.5, 1.5), (-0.5, 1.5)]
+HISTOGRAM_BINS = 512
+# robust z-score above which an object is an outlier (Iglewicz and Hoaglin)
+ROBUST_Z_THRESHOLD = 3.5
+# isolation score (0 to 1) above which an object is an outlier
+ISOLATION_THRESHOLD = 0.65
+# classes with fewer objects get robust z-scores only
+MIN_ISOLATION_OBJECTS = 50
+# maximum number of objects of a class the isolation forest is fitted on
+ISOLATION_SAMPLE_SIZE = 10000
+MAX_QUEUE_SIZE = 10000
+QUEUE_COLUMNS = ['anno_file_name', 'image_index', 'image_name', 'object_index', 'label', 'score', 'robust_z',
+                 'feature', 'isolation_score']
+
+
+@attr.s(slots=True, frozen=False)
+class TaskGeometry:
+    anno_file_name = attr.ib(validator=attr.validators.instance_of(str))
+    # modification time of the label file the geometry was computed from
+    mtime = attr.ib(default=None)
+    image_indices = attr.ib(default=attr.Factory(lambda: np.empty(0, dtype=np.int64)))
+    image_names = attr.ib(default=attr.Factory(lambda: np.empty(0, dtype=str)))
+    object_indices = attr.ib(default=attr.Factory(lambda: np.empty(0, dtype=np.int64)))
+    labels = attr.ib(default=attr.Factory(lambda: np.empty(0, dtype=str)))
+    # (objects, FEATURE_NAMES) float32
+    features = attr.ib(default=attr.Factory(lambda: np.empty((0, len(FEATURE_NAMES)), dtype=np.float32)))
+    # label -> (FEATURE_NAMES, HISTOGRAM_BINS) counts
+    histograms = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
+
+    def is_valid(self) -> bool:
+        return os.path.exists(self.anno_file_name) and self.mtime == os.path.getmtime(self.anno_file_name)
+
+    def save(self):
+        hist_labels = sorted(self.histograms.keys())
+        np.savez(TaskGeometry.get_geometry_filename(self.anno_file_name), mtime=np.float64(self.mtime),
+                 image_indices=self.image_indices, image_names=self.image_names.astype(str),
+                 object_indices=self.object_indices, labels=self.labels.astype(str), features=self.features,
+                 hist_labels=np.array(hist_labels, dtype=str),
+                 histograms=np.array([self.histograms[label] for label in hist_labels], dtype=np.int64)
+                 .reshape(len(hist_labels), len(FEATURE_NAMES), HISTOGRAM_BINS))
+
+    @staticmethod
+    def get_geometry_filename(anno_file_name: str) -> str:
+        return anno_file_name + GEOMETRY_EXT
+
+    @staticmethod
+    def from_labels(anno_file_name: str) -> 'TaskGeometry':
+        """
+        :param anno_file_name: label filename
+        :return: features and per-class histograms of the objects with an area
+        """
+        geometry = TaskGeometry(anno_file_name=anno_file_name, mtime=os.path.getmtime(anno_file_name))
+        data_labels = DataLabels.load(anno_file_name)
+        if not data_labels:
+            return geometry
+
+        df, _ = get_object_table(data_labels)
+        if df.empty:
+            return geometry
+
+        box_width, box_height = (df['xbr'] - df['xtl']).to_numpy(), (df['ybr'] - df['ytl']).to_numpy()
+        image_width, image_height = df['width'].to_numpy(), df['height'].to_numpy()
+        # degenerate shapes and images without a size are left to the label rules
+        is_valid = (df['type'].isin(BOX_TYPES + POLYGON_TYPES).to_numpy() & (box_width > 0) & (box_height > 0) &
+                    (image_width > 0) & (image_height > 0))
+        df = df[is_valid]
+        box_width, box_height = box_width[is_valid], box_height[is_valid]
+        image_width, image_height = image_width[is_valid], image_height[is_valid]
+
+        geometry.image_indices = df['image_index'].to_numpy()
+        geometry.image_names = df['image_name'].to_numpy().astype(str)
+        geometry.object_indices = df['object_index'].to_numpy()
+        geometry.labels = df['label'].astype(str).to_numpy().astype(str)
+        geometry.features = np.stack([np.log(box_width / image_width), np.log(box_height / image_height),
+                                      np.log(box_width / box_height),
+                                      (df['xtl'].to_numpy() + box_width / 2) / image_width,
+                                      (df['ytl'].to_numpy() + box_height / 2) / image_height],
+                                     axis=1).astype(np.float32)
+        geometry.histograms = {label: get_histograms(geometry.features[geometry.labels == label])
+                               for label in np.unique(geometry.labels)}
+        return geometry
+
+    @staticmethod
+    def load(anno_file_name: str) -> 'TaskGeometry':
+        """
+        :param anno_file_name: label filename
+        :return: the cached geometry if the label file did not change; otherwise it is computed and cached
+        """
+        geometry_filename = TaskGeometry.get_geometry_filename(anno_file_name)
+        if os.path.exists(geometry_filename):
+            try:
+                with np.load(geometry_filename, allow_pickle=False) as cached:
+                    geometry = TaskGeometry(anno_file_name=anno_file_name, mtime=float(cached["mtime"]),
+                                            image_indices=cached["image_indices"], image_names=cached["image_names"],
+                                            object_indices=cached["object_indices"], labels=cached["labels"],
+                                            features=cached["features"],
+                                            histograms=dict(zip(cached["hist_labels"].tolist(),
+                                                                cached["histograms"])))
+                if geometry.is_valid():
+                    return geometry
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Cannot load {geometry_filename}: {e}")
+
+        geometry = TaskGeometry.from_labels(anno_file_name)
+        geometry.save()
+        return geometry
+
+
+def get_bin_edges(feature: int) -> np.ndarray:
+    return np.linspace(*FEATURE_RANGES[feature], HISTOGRAM_BINS + 1)
+
+
+def get_histograms(features: np.ndarray) -> np.ndarray:
+    """
+    :param features: (objects, FEATURE_NAMES) features of a class
+    :return: (FEATURE_NAMES, HISTOGRAM_BINS) counts
+    """
+    histograms = np.empty((len(FEATURE_NAMES), HISTOGRAM_BINS), dtype=np.int64)
+    for feature, (min_value, max_value) in enumerate(FEATURE_RANGES):
+        histograms[feature] = np.histogram(np.clip(features[:, feature], min_value, max_value),
+                                           bins=get_bin_edges(feature))[0]
+
+    return histograms
+
+
+def get_histogram_median(counts: np.ndarray, bin_edges: np.ndarray) -> float:
+    """
+    :return: median interpolated within its bin
+    """
+    cumulative = np.cumsum(counts)
+    half = cumulative[-1] / 2
+    median_bin = int(np.searchsorted(cumulative, half))
+    below = cumulative[median_bin - 1] if median_bin > 0 else 0
+    share = (half - below) / counts[median_bin] if counts[median_bin] > 0 else 0.5
+    return float(bin_edges[median_bin] + share * (bin_edges[median_bin + 1] - bin_edges[median_bin]))
+
+
+def get_class_statistics(geometries: list) -> dict:
+    """
+    merges the histograms of the tasks
+    :param geometries: geometries of the tasks
+    :return: label -> (medians, MADs) of FEATURE_NAMES; a MAD is at least the width of a bin
+    """
+    merged = dict()
+    for geometry in geometries:
+        for label, histograms in geometry.histograms.items():
+            merged[label] = merged[label] + histograms if label in merged else np.array(histograms)
+
+    statistics = dict()
+    for label, histograms in merged.items():
+        medians, mads = np.empty(len(FEATURE_NAMES)), np.empty(len(FEATURE_NAMES))
+        for feature in range(len(FEATURE_NAMES)):
+            bin_edges = get_bin_edges(feature)
+            medians[feature] = get_histogram_median(histograms[feature], bin_edges)
+            # the absolute deviations of the bin centers from the median, weighted by the counts;
+            # each count is spread between the midpoints to the neighboring deviations
+            deviations = np.abs((bin_edges[:-1] + bin_edges[1:]) / 2 - medians[feature])
+            order = np.argsort(deviations)
+            sorted_deviations = deviations[order]
+            deviation_edges = np.concatenate([[0], (sorted_deviations[:-1] + sorted_deviations[1:]) / 2,
+                                              [sorted_deviations[-1] + (bin_edges[1] - bin_edges[0]) / 2]])
+            mads[feature] = max(get_histogram_median(histograms[feature][order], deviation_edges),
+                                bin_edges[1] - bin_edges[0])
+        statistics[label] = (medians, mads)
+
+    return statistics
+
+
+def score_objects(geometries: list, statistics: dict) -> pd.DataFrame:
+    """
+    :param geometries: geometries of the tasks
+    :param statistics: per-class medians and MADs
+    :return: one row (QUEUE_COLUMNS) per object; score >= 1 for outliers
+    """
+    frames = [pd.DataFrame({'anno_file_name': geometry.anno_file_name, 'image_index': geometry.image_indices,
+                            'image_name': geometry.image_names, 'object_index': geometry.object_indices,
+                            'label': geometry.labels}) for geometry in geometries if len(geometry.labels) > 0]
+    if not frames:
+        return pd.DataFrame(columns=QUEUE_COLUMNS)
+
+    df = pd.concat(frames, ignore_index=True)
+    features = np.concatenate([geometry.features for geometry in geometries if len(geometry.labels) > 0])
+    robust_z = np.zeros(len(df))
+    worst_features = np.zeros(len(df), dtype=np.int64)
+    isolation_scores = np.zeros(len(df))
+    rng = np.random.default_rng(0)
+    for label, rows in df.groupby('label', sort=False).indices.items():
+        medians, mads = statistics[label]
+        # 0.6745 makes the MAD of a normal distribution comparable to its standard deviation
+        z = np.abs(0.6745 * (features[rows] - medians) / mads)
+        worst_features[rows] = np.argmax(z, axis=1)
+        robust_z[rows] = z[np.arange(len(rows)), worst_features[rows]]
+
+        if len(rows) >= MIN_ISOLATION_OBJECTS:
+            sample = rows if len(rows) <= ISOLATION_SAMPLE_SIZE else rng.choice(rows, ISOLATION_SAMPLE_SIZE,
+                                                                                replace=False)
+            forest = IsolationForest(random_state=0).fit(features[sample])
+            isolation_scores[rows] = -forest.score_samples(features[rows])
+
+    df['robust_z'] = robust_z
+    df['feature'] = np.array(FEATURE_NAMES)[worst_features]
+    df['isolation_score'] = isolation_scores
+    df['score'] = np.maximum(robust_z / ROBUST_Z_THRESHOLD, isolation_scores / ISOLATION_THRESHOLD)
+    return df[QUEUE_COLUMNS]
+
+
+def load_geometries(anno_file_names: list, max_workers: int = None) -> list:
+    """
+    loads the cached geometries of the label files; the changed ones are computed in parallel
+    """
+    if len(anno_file_names) < 2 or max_workers == 1:
+        return [TaskGeometry.load(anno_file_name) for anno_file_name in anno_file_names]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(TaskGeometry.load, anno_file_names))
+
+
+def get_queue_filename(project_id: int) -> str:
+    return os.path.join(ADQ_WORKING_FOLDER, str(project_id), OUTLIERS_FILENAME)
+
+
+def build_outlier_queue(project_id: int, anno_file_names: list, max_workers: int = None,
+                        max_size: int = MAX_QUEUE_SIZE) -> pd.DataFrame:
+    """
+    scores the objects of all the label files of a project and saves the outliers with the highest scores
+    :param project_id: project id
+    :param anno_file_names: label filenames
+    :param max_workers: number of processes
+    :param max_size: maximum number of objects in the queue
+    :return: queue (QUEUE_COLUMNS) sorted by score
+    """
+    geometries = load_geometries(anno_file_names, max_workers)
+    df_scores = score_objects(geometries, get_class_statistics(geometries))
+    df_queue = df_scores[df_scores['score'] >= 1].nlargest(max_size, 'score').reset_index(drop=True)
+
+    queue_filename = get_queue_filename(project_id)
+    os.makedirs(os.path.dirname(queue_filename), exist_ok=True)
+    df_queue.to_csv(queue_filename + ".tmp", index=False)
+    os.replace(queue_filename + ".tmp", queue_filename)
+    logger.info(f"{len(df_queue)} outliers of {len(df_scores)} objects in project {project_id}")
+
+    return df_queue
+
+
+def load_outlier_queue(project_id: int, anno_file_name: str = None) -> pd.DataFrame:
+    """
+    :param project_id: project id
+    :param anno_file_name: label file whose outliers are returned; None for all
+    :return: saved queue (QUEUE_COLUMNS) sorted by score; empty if there is none
+    """
+    queue_filename = get_queue_filename(project_id)
+    if not os.path.exists(queue_filename):
+        return pd.DataFrame(columns=QUEUE_COLUMNS)
+
+    df_queue = pd.read_csv(queue_filename, dtype={'image_name': str, 'label': str})
+    if anno_file_name:
+        df_queue = df_queue[df_queue['anno_file_name'].map(os.path.normpath) == os.path.normpath(anno_file_name)]
+
+    return df_queue.reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Builds the review queue of the label geometry outliers")
+    parser.add_argument("project_id", type=int, help="project id")
+    parser.add_argument("anno_file_names", nargs="+", help="label files")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes")
+    args = parser.parse_args()
+
+    queue = build_outlier_queue(args.project_id, args.anno_file_names, max_workers=args.workers)
+    print(queue.head(20).to_string())
@@ -0,0 +1,328 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from src.common.constants import ErrorType
+from src.common.logger import get_logger
+from src.models.data_labels import DataLabels
+from src.models.report_engine import POLYGON_TYPES, to_polygons
+
+logger = get_logger(__name__)
+
+"""
+.. module:: label_rules
+   :synopsis: rule engine that flags suspicious label objects (tiny, degenerate, out of bounds, duplicates)
+    The objects of a label file are flattened once into columns (image, object, label, type, bounding box,
+    image size) and every rule runs as a batch over the columns.
+    Duplicates are found by a sweep over the boxes sorted by image, label and xtl: the pairs at a growing
+    distance in the sorted order are compared at once and a box drops out as soon as the next boxes start
+    right of it, so only the pairs whose x ranges overlap are ever compared.
+    The flags can be written into the label files as suggested verification results for the reviewers.
+        python -m src.models.label_rules <label file>... [--write]
+"""
+
+TINY = "Tiny"
+DEGENERATE = "Degenerate"
+OUT_OF_BOUNDS = "Out of bounds"
+DUPLICATE_BOX = "Duplicate box"
+DUPLICATE_POLYGON = "Duplicate polygon"
+RULES = [TINY, DEGENERATE, OUT_OF_BOUNDS, DUPLICATE_BOX, DUPLICATE_POLYGON]
+RULE_ERROR_CODES = {
+    TINY: ErrorType.DVE_RANGE.description,
+    DEGENERATE: ErrorType.DVE_RANGE.description,
+    OUT_OF_BOUNDS: ErrorType.DVE_RANGE.description,
+    DUPLICATE_BOX: ErrorType.DVE_OVER.description,
+    DUPLICATE_POLYGON: ErrorType.DVE_OVER.description
+}
+FLAG_COLUMNS = ['anno_file_name', 'image_index', 'image_name', 'object_index', 'label', 'rule', 'comment']
+
+# an object whose bounding box covers less than this share of the image is tiny
+TINY_AREA_RATIO = 0.0001
+# an object narrower or lower than this many pixels is tiny
+TINY_SIDE = 2
+DUPLICATE_IOU = 0.9
+# polygons whose bounding boxes overlap less than this are not compared
+POLYGON_BOX_MIN_IOU = 0.5
+BOX_TYPES = ('box',)
+# comments of the verification results written by the rule engine start with this
+SUGGESTION_PREFIX = "Auto-review: "
+
+
+def get_object_table(data_labels: DataLabels) -> (pd.DataFrame, dict):
+    """
+    flattens the objects with points into columns
+    :param data_labels: labels
+    :return: objects (image_index, image_name, object_index, label, type, xtl, ytl, xbr, ybr, width, height)
+        and the points of the polygon objects by row
+    """
+    image_indices, object_indices, labels, types, point_counts = [], [], [], [], []
+    coords = []
+    polygon_points = dict()
+    image_names, image_widths, image_heights = [], [], []
+    for image_index, image in enumerate(data_labels.images):
+        image_names.append(image.name)
+        image_widths.append(image.width)
+        image_heights.append(image.height)
+        for object_index, label_object in enumerate(image.objects):
+            if not label_object.points:
+                continue
+            if label_object.type in BOX_TYPES:
+                xtl, ytl, xbr, ybr = label_object.points[0][:4]
+                points = [[xtl, ytl], [xbr, ybr]]
+            else:
+                points = [point[:2] for point in label_object.points]
+                if label_object.type in POLYGON_TYPES:
+                    polygon_points[len(labels)] = points
+
+            image_indices.append(image_index)
+            object_indices.append(object_index)
+            labels.append(label_object.label)
+            types.append(label_object.type)
+            point_counts.append(len(points))
+            coords.extend(points)
+
+    df = pd.DataFrame({'image_index': np.array(image_indices, dtype=np.int64),
+                       'object_index': np.array(object_indices, dtype=np.int64),
+                       'label': pd.Categorical(labels), 'type': pd.Categorical(types)})
+    if len(df) == 0:
+        return df.assign(**{column: np.empty(0) for column in
+                            ['image_name', 'xtl', 'ytl', 'xbr', 'ybr', 'width', 'height']}), polygon_points
+
+    df['image_name'] = np.array(image_names, dtype=object)[df['image_index']]
+
+    # boxes keep their corners as they are (an inverted box stays inverted); other shapes get their extent
+    coords = np.array(coords, dtype=np.float64).reshape(-1, 2)
+    starts = np.concatenate([[0], np.cumsum(point_counts)[:-1]])
+    is_box = df['type'].isin(BOX_TYPES).to_numpy()
+    df['xtl'] = np.where(is_box, coords[starts, 0], np.minimum.reduceat(coords[:, 0], starts))
+    df['ytl'] = np.where(is_box, coords[starts, 1], np.minimum.reduceat(coords[:, 1], starts))
+    df['xbr'] = np.where(is_box, coords[np.minimum(starts + 1, len(coords) - 1), 0],
+                         np.maximum.reduceat(coords[:, 0], starts))
+    df['ybr'] = np.where(is_box, coords[np.minimum(starts + 1, len(coords) - 1), 1],
+                         np.maximum.reduceat(coords[:, 1], starts))
+    df['width'] = np.array(image_widths, dtype=np.float64)[df['image_index']]
+    df['height'] = np.array(image_heights, dtype=np.float64)[df['image_index']]
+
+    return df, polygon_points
+
+
+def find_overlapping_pairs(df: pd.DataFrame, min_iou: float) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    finds the pairs of boxes of the same image and label whose IoU is at least min_iou
+    :param df: objects with image_index, label, xtl, ytl, xbr, ybr
+    :param min_iou: minimum intersection over union
+    :return: rows of the earlier and later box of each pair (in df) and their IoU
+    """
+    if len(df) < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+
+    groups = df['image_index'].to_numpy() * (len(df['label'].cat.categories) + 1) + df['label'].cat.codes.to_numpy()
+    xtl, ytl, xbr, ybr = [df[column].to_numpy() for column in ['xtl', 'ytl', 'xbr', 'ybr']]
+    order = np.lexsort((xtl, groups))
+    groups, xtl, ytl, xbr, ybr = groups[order], xtl[order], ytl[order], xbr[order], ybr[order]
+    areas = (xbr - xtl) * (ybr - ytl)
+
+    lefts, rights, ious = [], [], []
+    active = np.arange(len(order) - 1)
+    distance = 1
+    while len(active) > 0:
+        active = active[active + distance < len(order)]
+        right = active + distance
+        # sorted by xtl within a group: once a later box starts right of a box, all the following ones do too
+        active = active[(groups[right] == groups[active]) & (xtl[right] < xbr[active])]
+        right = active + distance
+
+        dx = np.minimum(xbr[active], xbr[right]) - np.maximum(xtl[active], xtl[right])
+        dy = np.minimum(ybr[active], ybr[right]) - np.maximum(ytl[active], ytl[right])
+        intersections = np.where((dx > 0) & (dy > 0), dx * dy, 0)
+        unions = areas[active] + areas[right] - intersections
+        iou = np.divide(intersections, unions, out=np.zeros(len(active)), where=unions > 0)
+        is_pair = iou >= min_iou
+        lefts.append(active[is_pair])
+        rights.append(right[is_pair])
+        ious.append(iou[is_pair])
+        distance += 1
+
+    left, right = order[np.concatenate(lefts)], order[np.concatenate(rights)]
+    return np.minimum(left, right), np.maximum(left, right), np.concatenate(ious)
+
+
+def find_flags(df: pd.DataFrame, polygon_points: dict, tiny_area_ratio: float = TINY_AREA_RATIO,
+               duplicate_iou: float = DUPLICATE_IOU) -> pd.DataFrame:
+    """
+    runs all the rules over the objects of a label file
+    :param df: objects from get_object_table
+    :param polygon_points: points of the polygon objects by row
+    :param tiny_area_ratio: share of the image area below which an object is tiny
+    :param duplicate_iou: IoU from which two objects of the same label are duplicates
+    :return: one row (image_index, image_name, object_index, label, rule, comment) per flag
+    """
+    flags = []
+
+    def add_flags(rows, rule: str, comments):
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) > 0:
+            flags.append(df.iloc[rows][['image_index', 'image_name', 'object_index', 'label']]
+                         .astype({'label': str})
+                         .assign(rule=rule, comment=np.asarray(comments, dtype=object)))
+
+    box_width, box_height = (df['xbr'] - df['xtl']).to_numpy(), (df['ybr'] - df['ytl']).to_numpy()
+    # lines (e.g., splines) and points have no area
+    has_area = df['type'].isin(BOX_TYPES + POLYGON_TYPES).to_numpy()
+    is_box = df['type'].isin(BOX_TYPES).to_numpy()
+
+    degenerate = has_area & ((box_width <= 0) | (box_height <= 0))
+    rows = np.flatnonzero(degenerate)
+    add_flags(rows, DEGENERATE, [f"{'inverted' if min(w, h) < 0 else 'zero-area'} shape ({w:g} x {h:g})"
+                                 for w, h in zip(box_width[rows], box_height[rows])])
+
+    image_areas = (df['width'] * df['height']).to_numpy()
+    tiny = has_area & ~degenerate & ((box_width * box_height < tiny_area_ratio * image_areas) |
+                                       (np.minimum(box_width, box_height) < TINY_SIDE))
+    rows = np.flatnonzero(tiny)
+    add_flags(rows, TINY, [f"{w:g} x {h:g} in a {iw:g} x {ih:g} image" for w, h, iw, ih in
+                           zip(box_width[rows], box_height[rows], df['width'].to_numpy()[rows],
+                               df['height'].to_numpy()[rows])])
+
+    has_size = (df['width'] > 0).to_numpy() & (df['height'] > 0).to_numpy()
+    out_of_bounds = has_size & ((df[['xtl', 'xbr']].min(axis=1) < 0) | (df[['ytl', 'ybr']].min(axis=1) < 0) |
+                                (df[['xtl', 'xbr']].max(axis=1) > df['width']) |
+                                (df[['ytl', 'ybr']].max(axis=1) > df['height'])).to_numpy()
+    rows = np.flatnonzero(out_of_bounds)
+    add_flags(rows, OUT_OF_BOUNDS, [f"[{x1:g}, {y1:g}, {x2:g}, {y2:g}] outside of {w:g} x {h:g}" for
+                                    x1, y1, x2, y2, w, h in df.iloc[rows][['xtl', 'ytl', 'xbr', 'ybr', 'width',
+                                                                           'height']].itertuples(index=False)])
+
+    # the earlier object of a pair is kept and the later one is flagged
+    boxes = np.flatnonzero(is_box & ~degenerate)
+    left, right, iou = find_overlapping_pairs(df.iloc[boxes], duplicate_iou)
+    add_flags(boxes[right], DUPLICATE_BOX, [f"IoU {value:.2f} with object {object_index}" for value, object_index in
+                                            zip(iou, df['object_index'].to_numpy()[boxes[left]])])
+
+    left, right, iou = find_duplicate_polygons(df, polygon_points, duplicate_iou)
+    add_flags(right, DUPLICATE_POLYGON, [f"IoU {value:.2f} with object {object_index}" for value, object_index in
+                                         zip(iou, df['object_index'].to_numpy()[left])])
+
+    if not flags:
+        return pd.DataFrame(columns=FLAG_COLUMNS[1:])
+
+    return pd.concat(flags, ignore_index=True)
+
+
+def find_duplicate_polygons(df: pd.DataFrame, polygon_points: dict,
+                            duplicate_iou: float = DUPLICATE_IOU) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    :return: rows (in df) of the polygon pairs of the same image and label whose IoU is at least duplicate_iou
+        and their IoU; only the pairs with similar bounding boxes are intersected
+    """
+    rows = np.array([row for row, points in polygon_points.items() if len(points) >= 3], dtype=np.int64)
+    empty = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+    if len(rows) < 2:
+        return empty
+
+    left, right, _ = find_overlapping_pairs(df.iloc[rows], POLYGON_BOX_MIN_IOU)
+    if len(left) == 0:
+        return empty
+
+    pair_rows = np.unique(np.concatenate([left, right]))
+    try:
+        polygons = to_polygons([polygon_points[row] for row in rows[pair_rows]])
+    except (shapely.errors.GEOSException, ValueError) as e:
+        logger.warning(f"Cannot create the polygons: {e}")
+        return empty
+
+    positions = np.searchsorted(pair_rows, left), np.searchsorted(pair_rows, right)
+    left_polygons, right_polygons = polygons[positions[0]], polygons[positions[1]]
+    intersections = shapely.area(shapely.intersection(left_polygons, right_polygons))
+    unions = shapely.area(left_polygons) + shapely.area(right_polygons) - intersections
+    iou = np.divide(intersections, unions, out=np.zeros(len(left)), where=unions > 0)
+    is_duplicate = iou >= duplicate_iou
+
+    return rows[left[is_duplicate]], rows[right[is_duplicate]], iou[is_duplicate]
+
+
+def check_labels(anno_file_name: str) -> pd.DataFrame:
+    """
+    :param anno_file_name: label filename
+    :return: flags (FLAG_COLUMNS) of the objects of the label file
+    """
+    data_labels = DataLabels.load(anno_file_name)
+    if not data_labels:
+        return pd.DataFrame(columns=FLAG_COLUMNS)
+
+    df, polygon_points = get_object_table(data_labels)
+    df_flags = find_flags(df, polygon_points)
+    df_flags.insert(0, 'anno_file_name', anno_file_name)
+    return df_flags
+
+
+def check_all_labels(anno_file_names: list, max_workers: int = None) -> pd.DataFrame:
+    """
+    runs the rules over the label files, in parallel if there are several
+    :param anno_file_names: label filenames
+    :param max_workers: number of processes; defaults to the number of CPUs
+    :return: flags (FLAG_COLUMNS) of all the label files
+    """
+    if len(anno_file_names) < 2 or max_workers == 1:
+        results = [check_labels(anno_file_name) for anno_file_name in anno_file_names]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(check_labels, anno_file_names))
+
+    results = [df_flags for df_flags in results if not df_flags.empty]
+    if not results:
+        return pd.DataFrame(columns=FLAG_COLUMNS)
+
+    return pd.concat(results, ignore_index=True)
+
+
+def write_suggestions(anno_file_name: str, df_flags: pd.DataFrame) -> int:
+    """
+    writes the flags of a label file as suggested verification results;
+    the verification results of the reviewers are not overwritten
+    :param anno_file_name: label filename
+    :param df_flags: flags of the label file
+    :return: number of objects that got a suggested verification result
+    """
+    data_labels = DataLabels.load(anno_file_name)
+    if not data_labels or df_flags.empty:
+        return 0
+
+    written = 0
+    for (image_index, object_index), df_object in df_flags.groupby(['image_index', 'object_index'], sort=False):
+        label_object = data_labels.images[image_index].objects[object_index]
+        verification_result = label_object.verification_result
+        if verification_result and not str(verification_result.get("comment", "")).startswith(SUGGESTION_PREFIX):
+            continue
+
+        rules = df_object['rule'].tolist()
+        label_object.verification_result = {
+            "error_code": RULE_ERROR_CODES[rules[0]],
+            "comment": SUGGESTION_PREFIX + "; ".join(f"{rule}: {comment}" for rule, comment in
+                                                     zip(rules, df_object['comment']))
+        }
+        written += 1
+
+    if written:
+        data_labels.save(anno_file_name)
+        logger.info(f"Suggested {written} verification results in {anno_file_name}")
+
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Flags tiny, degenerate, out of bounds and duplicate objects")
+    parser.add_argument("anno_file_names", nargs="+", help="label files")
+    parser.add_argument("--write", action="store_true", help="write the flags as suggested verification results")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes")
+    args = parser.parse_args()
+
+    all_flags = check_all_labels(args.anno_file_names, max_workers=args.workers)
+    print(all_flags.groupby('rule').size().reindex(RULES, fill_value=0).to_string())
+    if args.write:
+        for file_name, df_file_flags in all_flags.groupby('anno_file_name'):
+            print(f"{os.path.basename(file_name)}: {write_suggestions(file_name, df_file_flags)} suggestions")
@@ -1,13 +1,12 @@
-import base64
 import os
 
 import altair as alt
-import cv2
+import joblib
 import numpy as np
 import pandas as pd
 from altair import Tooltip
-from sklearn.cluster import KMeans
-from sklearn.decomposition import PCA
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import IncrementalPCA
 
 from src.common.charts import display_chart
 from src.common.logger import get_logger
@@ -18,39 +17,144 @@ import streamlit as st
 
 logger = get_logger(__name__)
 
-
-def cluster_images(images: list, n_clusters=5):
-    X = np.array(images)
-    X = X.reshape(X.shape[0], -1)
-
-    kmeans = KMeans(n_clusters=n_clusters)
-    kmeans.fit(X)
-
-    return kmeans.labels_
-
-
-def reduce_features(images: list, n_components=2):
-    # Perform dimensionality reduction for plotting
-    flattened_images = np.array(images).reshape(len(images), -1)
-    pca = PCA(n_components=n_components)
-    return pca.fit_transform(flattened_images)
-
-
-def plot_image_clusters(project_id: str, title: str, filenames: list, images: list, cluster_labels, reduced_features):
+"""
+.. module:: metrics
+   :synopsis: incremental clustering of image and label features for the auto-reviews
+    MiniBatchKMeans and IncrementalPCA are fitted chunk by chunk so that the features never have to be
+    copied into one in-memory batch. The cluster assignments are cached per project with the fitted models;
+    when new images arrive, the models are updated with their features and only they are assigned.
+"""
+
+CLUSTER_CHUNK_SIZE = 4096
+# the cached models are fitted again from scratch when the new features are more than this share of all
+MAX_INCREMENTAL_RATIO = 0.5
+# the cluster plots show at most this many points
+MAX_PLOT_POINTS = 20000
+
+
+def _iter_chunks(count: int, chunk_size: int, min_size: int = 1):
+    """
+    :return: slices of chunk_size rows; a last chunk smaller than min_size is merged into the previous one
+    """
+    starts = list(range(0, count, chunk_size))
+    if len(starts) > 1 and count - starts[-1] < min_size:
+        starts.pop()
+    for idx, start in enumerate(starts):
+        yield slice(start, starts[idx + 1] if idx + 1 < len(starts) else count)
+
+
+def _partial_fit(kmeans: MiniBatchKMeans, pca: IncrementalPCA, features: np.ndarray, chunk_size: int):
+    min_size = max(kmeans.n_clusters, pca.n_components)
+    for chunk in _iter_chunks(len(features), chunk_size, min_size):
+        kmeans.partial_fit(features[chunk])
+        pca.partial_fit(features[chunk])
+
+
+def _assign(kmeans: MiniBatchKMeans, pca: IncrementalPCA, features: np.ndarray, chunk_size: int):
+    labels = np.empty(len(features), dtype=np.int32)
+    coords = np.empty((len(features), pca.n_components), dtype=np.float32)
+    for chunk in _iter_chunks(len(features), chunk_size):
+        labels[chunk] = kmeans.predict(features[chunk])
+        coords[chunk] = pca.transform(features[chunk])
+
+    return labels, coords
+
+
+def cluster_features(features: np.ndarray, n_clusters: int = 5, n_components: int = 2,
+                     chunk_size: int = CLUSTER_CHUNK_SIZE) -> (np.ndarray, np.ndarray, dict):
+    """
+    :param features: (n, d) features; an array or a memory-mapped array
+    :param n_clusters: number of clusters
+    :param n_components: number of dimensions of the reduced features
+    :param chunk_size: number of rows fitted at a time
+    :return: cluster label and reduced features of each row and the fitted models
+    """
+    n_clusters = min(n_clusters, len(features))
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=chunk_size, random_state=0, n_init=3)
+    pca = IncrementalPCA(n_components=min(n_components, features.shape[1], len(features)), batch_size=chunk_size)
+    _partial_fit(kmeans, pca, features, chunk_size)
+
+    labels, coords = _assign(kmeans, pca, features, chunk_size)
+    return labels, coords, {"kmeans": kmeans, "pca": pca}
+
+
+def get_cluster_assignments(cache_filename: str, ids: list, features: np.ndarray, n_clusters: int = 5,
+                            chunk_size: int = CLUSTER_CHUNK_SIZE) -> (np.ndarray, np.ndarray):
+    """
+    clusters the features using the cached assignments of the ids that were already clustered
+    :param cache_filename: cached assignments and models of a project
+    :param ids: id of each row of the features
+    :param features: (n, d) features
+    :param n_clusters: number of clusters
+    :param chunk_size: number of rows fitted at a time
+    :return: cluster label and 2D coordinates of each id
+    """
+    cached = joblib.load(cache_filename) if os.path.exists(cache_filename) else None
+    if cached and cached["n_clusters"] == n_clusters and cached["feature_dim"] == features.shape[1]:
+        cached_rows = {cached_id: row for row, cached_id in enumerate(cached["ids"])}
+        new_rows = np.array([row for row, feature_id in enumerate(ids) if feature_id not in cached_rows],
+                            dtype=np.int64)
+        if len(new_rows) == 0 or len(new_rows) <= MAX_INCREMENTAL_RATIO * len(ids):
+            labels = np.empty(len(ids), dtype=np.int32)
+            coords = np.empty((len(ids), cached["coords"].shape[1]), dtype=np.float32)
+            old_rows = np.array([row for row, feature_id in enumerate(ids) if feature_id in cached_rows],
+                                dtype=np.int64)
+            cached_indices = np.array([cached_rows[ids[row]] for row in old_rows], dtype=np.int64)
+            labels[old_rows] = cached["labels"][cached_indices]
+            coords[old_rows] = cached["coords"][cached_indices]
+
+            if len(new_rows):
+                logger.info(f"Assigning {len(new_rows)} new rows to the cached clusters")
+                new_features = features[new_rows]
+                _partial_fit(cached["kmeans"], cached["pca"], new_features, chunk_size)
+                labels[new_rows], coords[new_rows] = _assign(cached["kmeans"], cached["pca"], new_features,
+                                                             chunk_size)
+                _save_assignments(cache_filename, ids, labels, coords, cached["kmeans"], cached["pca"],
+                                  n_clusters, features.shape[1])
+            elif len(old_rows) != len(cached["ids"]):
+                _save_assignments(cache_filename, ids, labels, coords, cached["kmeans"], cached["pca"],
+                                  n_clusters, features.shape[1])
+            return labels, coords
+
+    logger.info(f"Clustering {len(ids)} rows")
+    labels, coords, models = cluster_features(features, n_clusters, chunk_size=chunk_size)
+    _save_assignments(cache_filename, ids, labels, coords, models["kmeans"], models["pca"],
+                      n_clusters, features.shape[1])
+    return labels, coords
+
+
+def _save_assignments(cache_filename: str, ids: list, labels: np.ndarray, coords: np.ndarray,
+                      kmeans: MiniBatchKMeans, pca: IncrementalPCA, n_clusters: int, feature_dim: int):
+    os.makedirs(os.path.dirname(cache_filename) or ".", exist_ok=True)
+    joblib.dump({"ids": list(ids), "labels": labels, "coords": coords, "kmeans": kmeans, "pca": pca,
+                 "n_clusters": n_clusters, "feature_dim": feature_dim}, cache_filename)
+
+
+def sample_points(labels: np.ndarray, max_points: int = MAX_PLOT_POINTS) -> np.ndarray:
+    """
+    :param labels: cluster label of each point
+    :param max_points: maximum number of points
+    :return: sorted indices of a uniform sample of at most max_points points, which keeps the share of each cluster
+    """
+    if len(labels) <= max_points:
+        return np.arange(len(labels))
+
+    rng = np.random.default_rng(0)
+    return np.sort(rng.choice(len(labels), size=max_points, replace=False))
+
+
+def plot_image_clusters(project_id: str, title: str, filenames: list, cluster_labels, reduced_features):
     # Verify lengths of arrays
-    assert len(filenames) == len(images) == len(cluster_labels), "Array lengths do not match"
+    assert len(filenames) == len(cluster_labels) == len(reduced_features), "Array lengths do not match"
 
-    # Create a DataFrame with reduced features, cluster labels, and filenames
-    filenames = [os.path.basename(filenames[i]) for i in range(len(filenames))]
+    # Create a DataFrame with reduced features, cluster labels, and filenames of a sample of the points
+    sampled = sample_points(np.asarray(cluster_labels))
     df = pd.DataFrame(
-        {'PC1': reduced_features[:, 0], 'PC2': reduced_features[:, 1], 'Cluster': cluster_labels, 'Filename': filenames})
-
-    # Generate thumbnail images and encode them as base64
-    thumbnail_images = [cv2.resize(img, (100, 100)) for img in images]
-    encoded_images = [base64.b64encode(cv2.imencode('.png', img)[1]).decode() for img in thumbnail_images]
-
-    # Add base64 encoded images to the DataFrame
-    df['Thumbnail'] = encoded_images
+        {'PC1': reduced_features[sampled, 0], 'PC2': reduced_features[sampled, 1],
+         'Cluster': np.asarray(cluster_labels)[sampled],
+         'Filename': [os.path.basename(filenames[i]) for i in sampled]})
+    if len(sampled) < len(filenames):
+        st.caption(f"{title}: showing {len(sampled)} of {len(filenames)} points")
 
     ## Create Altair scatter plot
     #scatter_plot = alt.Chart(df).mark_circle(size=60).encode(
@@ -96,7 +200,7 @@ def plot_image_clusters(project_id: str, title: str, filenames: list, images: li
     # Create scatter plot using Plotly
     chart = px.scatter(df, x='PC1', y='PC2', color='Cluster',
                     title=title, hover_data=['Filename', 'Cluster'],
-                    color_continuous_scale='Viridis')
+                    color_continuous_scale='Viridis', render_mode='webgl')
 
     # Set plot title
     chart.update_layout(title=title)
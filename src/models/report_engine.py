@@ -0,0 +1,424 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import attr
+import numpy as np
+import pandas as pd
+import shapely
+from scipy import sparse
+
+from src.common.logger import get_logger
+from src.models.data_labels import DataLabels
+
+logger = get_logger(__name__)
+
+"""
+.. module:: report_engine
+   :synopsis: label metrics of the reports (class counts, error counts, overlaps, dimensions, per-image table)
+    The metrics of a label file are computed in a single pass over its images into a ReportPartial.
+    Partials of several label files (or workers) are merged into the metrics of a project.
+    The per-image counts are kept as (image index, label, count) triples and pivoted once into sparse columns,
+    so that hundreds of classes do not make a dense table of all images.
+    Polygon and segmentation objects also get true polygon overlaps: an STRtree per image finds the candidate
+    pairs and the intersection areas are computed in vectorized chunks within a time budget per image.
+    The engine does not depend on Streamlit so that it can run from the command line or a worker:
+        python -m src.models.report_engine <label file>... [--output report.json]
+"""
+
+# the error columns every report has, even without errors
+REQUIRED_ERROR_CODES = ['Mis-tagged', 'Untagged', 'Over-tagged', 'Range_error', 'Attributes_error']
+IMAGE_TABLE_COLUMNS = ['filename', 'total_classes', 'class_names']
+DIMENSION_COLUMNS = ['filename', 'width', 'height', 'class', 'data_folder']
+# number of rows of the per-image table converted to dense rows at a time when exporting
+EXPORT_CHUNK_SIZE = 10000
+
+POLYGON_TYPES = ('polygon', 'segmentation')
+# an image with more candidate pairs than this gets the overlaps of a random sample of its polygons
+MAX_POLYGON_PAIRS = 20000
+# number of polygons whose pairs are queried and intersected at a time
+POLYGON_PAIRS_CHUNK_SIZE = 64
+# seconds spent on the polygon overlaps of an image before the remaining pairs are skipped
+POLYGON_OVERLAP_TIME_BUDGET = 1.0
+
+
+def calculate_overlap_percents(rectangles: np.ndarray) -> np.ndarray:
+    """
+    calculates the overlaps of all rectangle pairs of an image at once
+    :param rectangles: (n, 4) array of xtl, ytl, xbr, ybr
+    :return: overlap area of each overlapping pair in % of the larger rectangle, rounded to 1%
+    """
+    if len(rectangles) < 2:
+        return np.empty(0)
+
+    dx = (np.minimum(rectangles[:, None, 2], rectangles[None, :, 2]) -
+          np.maximum(rectangles[:, None, 0], rectangles[None, :, 0]))
+    dy = (np.minimum(rectangles[:, None, 3], rectangles[None, :, 3]) -
+          np.maximum(rectangles[:, None, 1], rectangles[None, :, 1]))
+    areas = (rectangles[:, 2] - rectangles[:, 0]) * (rectangles[:, 3] - rectangles[:, 1])
+    max_areas = np.maximum(areas[:, None], areas[None, :])
+
+    # each pair once
+    upper = np.triu(np.ones((len(rectangles), len(rectangles)), dtype=bool), k=1)
+    overlapping = upper & (dx > 0) & (dy > 0) & (max_areas > 0)
+
+    return np.round((dx * dy)[overlapping] / max_areas[overlapping], 2) * 100
+
+
+def to_polygons(points_list: list) -> np.ndarray:
+    """
+    :param points_list: points ([[x, y]...] or [[x, y, r]...]) of each polygon with at least 3 points
+    :return: shapely polygons; invalid (e.g., self-intersecting) polygons are made valid
+    """
+    coords = np.concatenate([np.asarray(points, dtype=np.float64)[:, :2] for points in points_list])
+    indices = np.repeat(np.arange(len(points_list)), [len(points) for points in points_list])
+    polygons = shapely.polygons(shapely.linearrings(coords, indices=indices))
+
+    invalid = ~shapely.is_valid(polygons)
+    if invalid.any():
+        polygons[invalid] = shapely.make_valid(polygons[invalid])
+
+    return polygons
+
+
+def calculate_polygon_overlap_percents(points_list: list, max_pairs: int = MAX_POLYGON_PAIRS,
+                                       time_budget: float = POLYGON_OVERLAP_TIME_BUDGET) -> (np.ndarray, bool):
+    """
+    calculates the overlaps of the polygons of an image; an STRtree finds the pairs whose bounding boxes intersect.
+    The polygons are queried in chunks in a random order and each pair is calculated with the first of its
+    polygons in that order, so that stopping at max_pairs or at the time budget leaves a random sample of
+    the polygons with all their pairs
+    :param points_list: points of each polygon
+    :param max_pairs: number of candidate pairs after which the remaining polygons are skipped
+    :param time_budget: seconds after which the remaining polygons are skipped; the polygons and their tree
+        are always built, so that the budget is spent on the pairs
+    :return: overlap area of each overlapping pair in % of the larger polygon, rounded to 1%,
+        and whether only a sample of the pairs was calculated
+    """
+    points_list = [points for points in points_list if len(points) >= 3]
+    if len(points_list) < 2:
+        return np.empty(0), False
+
+    try:
+        polygons = to_polygons(points_list)
+    except (shapely.errors.GEOSException, ValueError) as e:
+        logger.warning(f"Cannot create the polygons: {e}")
+        return np.empty(0), False
+
+    areas = shapely.area(polygons)
+    tree = shapely.STRtree(polygons)
+    # a fixed seed keeps the reports of the same labels identical
+    order = np.random.default_rng(0).permutation(len(polygons))
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+
+    start = time.perf_counter()
+    overlap_percents = []
+    pair_count = 0
+    for chunk_start in range(0, len(order), POLYGON_PAIRS_CHUNK_SIZE):
+        if pair_count >= max_pairs or time.perf_counter() - start > time_budget:
+            logger.warning(f"Calculated the overlaps of {chunk_start} of {len(order)} polygons "
+                           f"({pair_count} pairs, {time.perf_counter() - start:.1f}s)")
+            return (np.concatenate(overlap_percents) if overlap_percents else np.empty(0)), True
+
+        chunk = order[chunk_start:chunk_start + POLYGON_PAIRS_CHUNK_SIZE]
+        chunk_indices, right = tree.query(polygons[chunk])
+        left = chunk[chunk_indices]
+        # each pair once, from the polygon queried first; its partner may be in a chunk that is skipped
+        is_pair = (ranks[left] < ranks[right]) & (areas[left] > 0) & (areas[right] > 0)
+        left, right = left[is_pair], right[is_pair]
+        pair_count += len(left)
+
+        intersection_areas = shapely.area(shapely.intersection(polygons[left], polygons[right]))
+        max_areas = np.maximum(areas[left], areas[right])
+        overlapping = intersection_areas > 0
+        overlap_percents.append(np.round(intersection_areas[overlapping] / max_areas[overlapping], 2) * 100)
+
+    return np.concatenate(overlap_percents), False
+
+
+@attr.s(slots=True, frozen=False)
+class ReportPartial:
+    # class label -> number of objects
+    class_counts = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
+    # error code -> number of objects
+    error_counts = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
+    # overlap % -> number of object pairs
+    overlap_counts = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
+    # overlap % -> number of polygon/segmentation pairs
+    polygon_overlap_counts = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
+    # images whose polygon overlaps were calculated on a sample of the pairs
+    polygon_sampled_images = attr.ib(default=attr.Factory(list), validator=attr.validators.instance_of(list))
+    # (filename, width, height, class, data folder) of each object with points
+    dimensions = attr.ib(default=attr.Factory(list), validator=attr.validators.instance_of(list))
+    # the index of an image in image_names is the image index of the triples
+    image_names = attr.ib(default=attr.Factory(list), validator=attr.validators.instance_of(list))
+    # comma-separated sorted class labels of each image
+    image_class_names = attr.ib(default=attr.Factory(list), validator=attr.validators.instance_of(list))
+    # (image index, class label, number of objects)
+    class_triples = attr.ib(default=attr.Factory(list), validator=attr.validators.instance_of(list))
+    # (image index, error code, number of objects)
+    error_triples = attr.ib(default=attr.Factory(list), validator=attr.validators.instance_of(list))
+
+    def add_image(self, image: DataLabels.Image, data_folder: str = None):
+        """
+        :param image: label image
+        :param data_folder: folder of the image file; it tells apart the images of the same name in different tasks
+        """
+        class_counts = dict()
+        error_counts = dict()
+        rectangles = []
+        polygons = []
+        for label_object in image.objects:
+            class_counts[label_object.label] = class_counts.get(label_object.label, 0) + 1
+            if label_object.verification_result:
+                error_code = label_object.verification_result['error_code']
+                error_counts[error_code] = error_counts.get(error_code, 0) + 1
+
+            if not label_object.points:
+                logger.warning("empty points in {}".format(label_object.label))
+                continue
+
+            xtl, ytl, xbr, ybr = DataLabels.Object.get_bounding_rectangle(label_object)[:4]
+            rectangles.append((xtl, ytl, xbr, ybr))
+            self.dimensions.append((image.name, xbr - xtl, ybr - ytl, label_object.label, data_folder))
+            if label_object.type in POLYGON_TYPES:
+                polygons.append(label_object.points)
+
+        for overlap_percent in calculate_overlap_percents(np.array(rectangles, dtype=np.float64)):
+            overlap_percent = float(overlap_percent)
+            self.overlap_counts[overlap_percent] = self.overlap_counts.get(overlap_percent, 0) + 1
+
+        polygon_overlap_percents, is_sampled = calculate_polygon_overlap_percents(polygons)
+        for overlap_percent in polygon_overlap_percents:
+            overlap_percent = float(overlap_percent)
+            self.polygon_overlap_counts[overlap_percent] = self.polygon_overlap_counts.get(overlap_percent, 0) + 1
+        if is_sampled:
+            self.polygon_sampled_images.append(image.name)
+
+        ReportPartial._add_counts(self.class_counts, class_counts)
+        ReportPartial._add_counts(self.error_counts, error_counts)
+
+        image_index = len(self.image_names)
+        self.image_names.append(image.name)
+        self.image_class_names.append(", ".join(sorted(class_counts.keys())))
+        self.class_triples.extend((image_index, label, count) for label, count in class_counts.items())
+        self.error_triples.extend((image_index, error_code, count) for error_code, count in error_counts.items())
+
+    def merge(self, other: 'ReportPartial') -> 'ReportPartial':
+        """
+        adds the metrics of another partial to this one
+        :param other: partial of other label files
+        :return: self
+        """
+        ReportPartial._add_counts(self.class_counts, other.class_counts)
+        ReportPartial._add_counts(self.error_counts, other.error_counts)
+        ReportPartial._add_counts(self.overlap_counts, other.overlap_counts)
+        ReportPartial._add_counts(self.polygon_overlap_counts, other.polygon_overlap_counts)
+        self.polygon_sampled_images.extend(other.polygon_sampled_images)
+        self.dimensions.extend(other.dimensions)
+
+        offset = len(self.image_names)
+        self.image_names.extend(other.image_names)
+        self.image_class_names.extend(other.image_class_names)
+        self.class_triples.extend((offset + image_index, label, count)
+                                  for image_index, label, count in other.class_triples)
+        self.error_triples.extend((offset + image_index, error_code, count)
+                                  for image_index, error_code, count in other.error_triples)
+
+        return self
+
+    def get_error_counts(self) -> dict:
+        """
+        :return: error code -> number of objects including the required error codes
+        """
+        error_counts = dict(self.error_counts)
+        for error_code in REQUIRED_ERROR_CODES:
+            error_counts.setdefault(error_code, 0)
+
+        return error_counts
+
+    def get_dimensions(self) -> pd.DataFrame:
+        return pd.DataFrame(self.dimensions, columns=DIMENSION_COLUMNS)
+
+    def get_image_table(self) -> pd.DataFrame:
+        """
+        :return: one row per image with the number of classes, the class names (categorical)
+            and the number of objects per class and per error code (sparse)
+        """
+        image_count = len(self.image_names)
+        image_indices = np.fromiter((image_index for image_index, _, _ in self.class_triples),
+                                    dtype=np.int64, count=len(self.class_triples))
+        df_table = pd.DataFrame({
+            'filename': self.image_names,
+            'total_classes': np.bincount(image_indices, minlength=image_count),
+            # most images share a few combinations of classes
+            'class_names': pd.Categorical(self.image_class_names)
+        })
+
+        # the columns are known once all images are added, so the counts are pivoted once
+        df_classes = pivot_sparse(self.class_triples, sorted(self.class_counts.keys()), image_count)
+        df_errors = pivot_sparse(self.error_triples,
+                                 sorted(set(self.error_counts.keys()) | set(REQUIRED_ERROR_CODES)), image_count)
+
+        return pd.concat([df_table, df_classes, df_errors], axis=1)
+
+    def to_json(self):
+        return {
+            "class_counts": self.class_counts,
+            "error_counts": self.error_counts,
+            "overlap_counts": self.overlap_counts,
+            "polygon_overlap_counts": self.polygon_overlap_counts,
+            "polygon_sampled_images": self.polygon_sampled_images,
+            "dimensions": self.dimensions,
+            "image_names": self.image_names,
+            "image_class_names": self.image_class_names,
+            "class_triples": self.class_triples,
+            "error_triples": self.error_triples
+        }
+
+    @staticmethod
+    def _add_counts(counts: dict, other_counts: dict):
+        for key, count in other_counts.items():
+            counts[key] = counts.get(key, 0) + count
+
+    @staticmethod
+    def from_json(json_dict) -> 'ReportPartial':
+        return ReportPartial(
+            class_counts=json_dict.get("class_counts", {}),
+            error_counts=json_dict.get("error_counts", {}),
+            # json keys are always strings
+            overlap_counts={float(overlap_percent): count
+                            for overlap_percent, count in json_dict.get("overlap_counts", {}).items()},
+            polygon_overlap_counts={float(overlap_percent): count
+                                    for overlap_percent, count in json_dict.get("polygon_overlap_counts", {}).items()},
+            polygon_sampled_images=json_dict.get("polygon_sampled_images", []),
+            # the dimensions of older reports have no data folder
+            dimensions=[tuple(dimension) + (None,) * (len(DIMENSION_COLUMNS) - len(dimension))
+                        for dimension in json_dict.get("dimensions", [])],
+            image_names=json_dict.get("image_names", []),
+            image_class_names=json_dict.get("image_class_names", []),
+            class_triples=[tuple(triple) for triple in json_dict.get("class_triples", [])],
+            error_triples=[tuple(triple) for triple in json_dict.get("error_triples", [])]
+        )
+
+
+def pivot_sparse(triples: list, columns: list, row_count: int) -> pd.DataFrame:
+    """
+    :param triples: (row index, column name, count)
+    :param columns: column names
+    :param row_count: number of rows
+    :return: sparse frame of the counts with 0 as the fill value
+    """
+    column_indices = {column: idx for idx, column in enumerate(columns)}
+    rows = np.fromiter((row for row, _, _ in triples), dtype=np.int64, count=len(triples))
+    cols = np.fromiter((column_indices[column] for _, column, _ in triples), dtype=np.int64, count=len(triples))
+    counts = np.fromiter((count for _, _, count in triples), dtype=np.int32, count=len(triples))
+    matrix = sparse.coo_matrix((counts, (rows, cols)), shape=(row_count, len(columns)), dtype=np.int32)
+
+    return pd.DataFrame.sparse.from_spmatrix(matrix.tocsc(), columns=columns)
+
+
+def _to_dense(df: pd.DataFrame) -> pd.DataFrame:
+    return df.astype({column: dtype.subtype for column, dtype in df.dtypes.items()
+                      if isinstance(dtype, pd.SparseDtype)})
+
+
+def write_image_table(df_table: pd.DataFrame, output, file_format: str = "CSV",
+                      chunk_size: int = EXPORT_CHUNK_SIZE):
+    """
+    writes the per-image table converting only chunk_size rows at a time to dense rows
+    :param df_table: table from ReportPartial.get_image_table
+    :param output: filename or binary file object to write to
+    :param file_format: CSV or Excel
+    :param chunk_size: number of rows converted at a time
+    """
+    if isinstance(output, str):
+        with open(output, "wb") as output_file:
+            write_image_table(df_table, output_file, file_format, chunk_size)
+        return
+
+    if file_format == "CSV":
+        for start in range(0, max(1, len(df_table)), chunk_size):
+            csv_chunk = _to_dense(df_table.iloc[start:start + chunk_size]).to_csv(header=(start == 0), index=False)
+            output.write(csv_chunk.encode("utf-8"))
+    elif file_format == "Excel":
+        # imported here so that the engine does not need openpyxl unless Excel is exported
+        import openpyxl
+
+        # the write-only workbook streams the rows to the file instead of keeping the cells in memory
+        workbook = openpyxl.Workbook(write_only=True)
+        worksheet = workbook.create_sheet()
+        worksheet.append([str(column) for column in df_table.columns])
+        for start in range(0, len(df_table), chunk_size):
+            for row in _to_dense(df_table.iloc[start:start + chunk_size]).itertuples(index=False, name=None):
+                worksheet.append(row)
+        workbook.save(output)
+    else:
+        raise ValueError(f"Unsupported format {file_format}")
+
+
+def compute_partial(anno_file_name: str) -> ReportPartial:
+    """
+    :param anno_file_name: label filename
+    :return: metrics of the label file
+    """
+    partial = ReportPartial()
+    data_labels = DataLabels.load(anno_file_name)
+    if not data_labels:
+        logger.warning(f"No labels in {anno_file_name}")
+        return partial
+
+    # the images of a task are in the data folder next to its label file
+    data_folder = os.path.join(os.path.dirname(anno_file_name), "data")
+    for image in data_labels.images:
+        partial.add_image(image, data_folder)
+
+    return partial
+
+
+def compute_report(anno_file_names: list, max_workers: int = None) -> ReportPartial:
+    """
+    computes the partials of the label files, in parallel if there are several, and merges them
+    :param anno_file_names: label filenames
+    :param max_workers: number of processes; defaults to the number of CPUs
+    :return: metrics of all the label files
+    """
+    if len(anno_file_names) < 2 or max_workers == 1:
+        partials = [compute_partial(anno_file_name) for anno_file_name in anno_file_names]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            partials = list(executor.map(compute_partial, anno_file_names))
+
+    report = ReportPartial()
+    for partial in partials:
+        report.merge(partial)
+
+    return report
+
+
+def get_anno_file_names(label_files_dict: dict) -> list:
+    """
+    :param label_files_dict: label files with key=folder value=label filenames
+    :return: full label filenames
+    """
+    return [os.path.join(folder, label_file)
+            for folder, label_files in label_files_dict.items() for label_file in label_files]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Computes the label metrics of label files")
+    parser.add_argument("anno_file_names", nargs="+", help="label files")
+    parser.add_argument("--output", help="JSON file to write the merged metrics to")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes")
+    args = parser.parse_args()
+
+    report = compute_report(args.anno_file_names, max_workers=args.workers)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(report.to_json(), output_file, ensure_ascii=False)
+
+    print(pd.Series(report.class_counts, name="objects").to_string())
+    print(pd.Series(report.get_error_counts(), name="errors").to_string())
@@ -0,0 +1,345 @@
+import argparse
+import datetime
+import glob
+import json
+import os
+
+import attr
+import numpy as np
+
+import src.common.utils as utils
+from src.common.constants import ADQ_WORKING_FOLDER, JSON_EXT, TASKS
+from src.common.logger import get_logger
+from src.models.file_inventory import scan_folder
+from src.models.image_stats import get_image_stats
+from src.models.report_engine import ReportPartial, compute_report
+from src.models.tasks_info import TaskPointers
+
+logger = get_logger(__name__)
+
+"""
+.. module:: report_snapshot
+   :synopsis: precomputed file, image and label metrics of a project
+    A snapshot is computed in the background (command line or the backend worker) and saved in
+    .adq/<project id>/reports/snapshot-<sequence>.json so that the Reports page can load it instantly.
+    The snapshot records the modification times of the label files and the data folders it was computed from;
+    its label metrics are stale as soon as a label file is added, removed or changed, and its file and image metrics
+    as soon as a data folder changes.
+    The summaries of older snapshots are kept for the trends; only the latest keeps the full label metrics.
+        python -m src.models.report_snapshot <project id>... [--workers N]
+"""
+
+# format version of the snapshot files
+SNAPSHOT_VERSION = 1
+REPORTS_FOLDER = "reports"
+SNAPSHOT_PREFIX = "snapshot-"
+REPORT_EXT = ".report.json"
+# category of the snapshots registered as statistics in the backend
+REPORT_SNAPSHOT_CATEGORY = "report_snapshot"
+
+SNAPSHOT_BINS = 50
+SNAPSHOT_QUANTILES = (0.05, 0.5, 0.95)
+BRIGHTNESS_RANGE = (0, 255)
+
+
+@attr.s(slots=True, frozen=False)
+class ReportSnapshot:
+    project_id = attr.ib(validator=attr.validators.instance_of(int))
+    # increasing number of the snapshots of a project
+    sequence = attr.ib(default=0, validator=attr.validators.instance_of(int))
+    version = attr.ib(default=SNAPSHOT_VERSION)
+    created_at = attr.ib(default=None)
+    # label filename -> modification time when the snapshot was computed
+    sources = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
+    # data folder -> modification time (ns) when the snapshot was computed
+    data_sources = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
+    file_metrics = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
+    image_metrics = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
+    # class counts, error counts and totals of the label metrics
+    label_metrics = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
+    # full label metrics (ReportPartial); only kept for the latest snapshot
+    report_file_name = attr.ib(default=None)
+
+    def to_json(self):
+        return {
+            "project_id": self.project_id,
+            "sequence": self.sequence,
+            "version": self.version,
+            "created_at": self.created_at,
+            "sources": self.sources,
+            "data_sources": self.data_sources,
+            "file_metrics": self.file_metrics,
+            "image_metrics": self.image_metrics,
+            "label_metrics": self.label_metrics,
+            "report_file_name": self.report_file_name
+        }
+
+    def get_filename(self) -> str:
+        return os.path.join(ReportSnapshot.get_reports_folder(self.project_id),
+                            f"{SNAPSHOT_PREFIX}{self.sequence:04d}{JSON_EXT}")
+
+    def is_stale(self, anno_file_names: list) -> bool:
+        """
+        :param anno_file_names: current label files of the project
+        :return: True if a label file was added, removed or changed since the snapshot
+        """
+        return get_source_mtimes(anno_file_names) != self.sources
+
+    def is_data_stale(self, data_folders: list) -> bool:
+        """
+        :param data_folders: current data folders of the project
+        :return: True if a data folder was added, removed or changed since the snapshot
+        """
+        return get_folder_mtimes(data_folders) != self.data_sources
+
+    def load_report(self) -> ReportPartial:
+        """
+        :return: full label metrics or None if they were not kept
+        """
+        if not self.report_file_name or not os.path.exists(self.report_file_name):
+            return None
+
+        return ReportPartial.from_json(utils.from_file(self.report_file_name))
+
+    def save(self, report: ReportPartial = None):
+        """
+        saves the snapshot with the full label metrics and drops the full label metrics of the older snapshots
+        :param report: full label metrics
+        """
+        os.makedirs(ReportSnapshot.get_reports_folder(self.project_id), exist_ok=True)
+        snapshot_filename = self.get_filename()
+        if report:
+            self.report_file_name = snapshot_filename.replace(JSON_EXT, REPORT_EXT)
+            utils.to_file(json.dumps(report.to_json(), default=utils.default, ensure_ascii=False),
+                          self.report_file_name)
+
+        utils.to_file(json.dumps(self.to_json(), default=utils.default, ensure_ascii=False, indent=2),
+                      snapshot_filename)
+
+        for report_file_name in glob.glob(os.path.join(ReportSnapshot.get_reports_folder(self.project_id),
+                                                       f"{SNAPSHOT_PREFIX}*{REPORT_EXT}")):
+            if report_file_name != self.report_file_name:
+                os.remove(report_file_name)
+
+    @staticmethod
+    def get_reports_folder(project_id: int) -> str:
+        return os.path.join(ADQ_WORKING_FOLDER, str(project_id), REPORTS_FOLDER)
+
+    @staticmethod
+    def list_project_ids() -> list:
+        """
+        :return: ids of the projects with snapshots
+        """
+        reports_folders = glob.glob(os.path.join(ADQ_WORKING_FOLDER, "*", REPORTS_FOLDER))
+        return sorted(int(os.path.basename(os.path.dirname(reports_folder))) for reports_folder in reports_folders
+                      if os.path.basename(os.path.dirname(reports_folder)).isdigit())
+
+    @staticmethod
+    def get_sequence(filename: str) -> int:
+        """
+        :param filename: snapshot filename
+        :return: sequence of the snapshot without reading the file
+        """
+        return int(os.path.basename(filename)[len(SNAPSHOT_PREFIX):-len(JSON_EXT)])
+
+    @staticmethod
+    def list_filenames(project_id: int) -> list:
+        """
+        :return: snapshot filenames of the project from the oldest to the latest
+        """
+        filenames = glob.glob(os.path.join(ReportSnapshot.get_reports_folder(project_id),
+                                           f"{SNAPSHOT_PREFIX}*{JSON_EXT}"))
+        return sorted(filename for filename in filenames if not filename.endswith(REPORT_EXT))
+
+    @staticmethod
+    def load_all(project_id: int) -> list:
+        """
+        :return: snapshots of the project from the oldest to the latest (skipping other format versions)
+        """
+        snapshots = [ReportSnapshot.from_json(utils.from_file(filename))
+                     for filename in ReportSnapshot.list_filenames(project_id)]
+        return [snapshot for snapshot in snapshots if snapshot.version == SNAPSHOT_VERSION]
+
+    @staticmethod
+    def load_latest(project_id: int) -> 'ReportSnapshot':
+        """
+        :return: the latest snapshot of the project or None
+        """
+        for filename in reversed(ReportSnapshot.list_filenames(project_id)):
+            snapshot = ReportSnapshot.from_json(utils.from_file(filename))
+            if snapshot.version == SNAPSHOT_VERSION:
+                return snapshot
+
+    @staticmethod
+    def from_json(json_dict) -> 'ReportSnapshot':
+        return ReportSnapshot(
+            project_id=json_dict["project_id"],
+            sequence=json_dict.get("sequence", 0),
+            version=json_dict.get("version"),
+            created_at=json_dict.get("created_at"),
+            sources=json_dict.get("sources", {}),
+            data_sources=json_dict.get("data_sources", {}),
+            file_metrics=json_dict.get("file_metrics", {}),
+            image_metrics=json_dict.get("image_metrics", {}),
+            label_metrics=json_dict.get("label_metrics", {}),
+            report_file_name=json_dict.get("report_file_name")
+        )
+
+
+def get_source_mtimes(anno_file_names: list) -> dict:
+    """
+    :param anno_file_names: label filenames
+    :return: normalized label filename -> modification time (None if missing)
+    """
+    return {os.path.normpath(anno_file_name):
+            os.path.getmtime(anno_file_name) if os.path.exists(anno_file_name) else None
+            for anno_file_name in anno_file_names}
+
+
+def get_folder_mtimes(data_folders: list) -> dict:
+    """
+    :param data_folders: data folders
+    :return: normalized data folder -> modification time (ns) of the folder (None if missing);
+        as for the file inventory, it changes when a file is added, removed or renamed
+    """
+    return {os.path.normpath(data_folder):
+            os.stat(data_folder).st_mtime_ns if os.path.isdir(data_folder) else None
+            for data_folder in data_folders}
+
+
+def get_project_sources(project_id: int) -> (list, list):
+    """
+    :param project_id: project id
+    :return: label filenames and data folders of the tasks of the project in the working folder
+    """
+    json_task_pointers = utils.from_file(os.path.join(ADQ_WORKING_FOLDER, TASKS + JSON_EXT))
+    if not json_task_pointers:
+        return [], []
+
+    anno_file_names, data_folders = [], []
+    for task_pointer in TaskPointers.from_json(json_task_pointers).task_pointers:
+        if task_pointer.project_id != project_id:
+            continue
+
+        task_folder = os.path.join(ADQ_WORKING_FOLDER, str(project_id), str(task_pointer.id))
+        data_folders.append(os.path.join(task_folder, "data"))
+        if task_pointer.anno_file_name:
+            anno_file_names.append(os.path.join(task_folder, os.path.basename(task_pointer.anno_file_name)))
+
+    return anno_file_names, data_folders
+
+
+def summarize_values(values, value_range: tuple = None) -> dict:
+    """
+    :param values: numbers; NaN values are ignored
+    :param value_range: (min, max) of the bins; defaults to the range of the values
+    :return: histogram (counts, edges) and quantiles of the values
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return {"count": 0}
+
+    counts, edges = np.histogram(values, bins=SNAPSHOT_BINS, range=value_range)
+    return {
+        "count": int(len(values)),
+        "counts": counts.tolist(),
+        "edges": edges.tolist(),
+        "quantiles": {str(quantile): float(value)
+                      for quantile, value in zip(SNAPSHOT_QUANTILES, np.quantile(values, SNAPSHOT_QUANTILES))}
+    }
+
+
+def compute_file_metrics(data_folders: list) -> dict:
+    """
+    :param data_folders: data folders of the tasks
+    :return: number and total size of the files per folder and in total,
+        the summary of the file sizes and the number of files per creation date
+    """
+    folders = dict()
+    sizes, created_dates = [], dict()
+    for data_folder in data_folders:
+        df_inventory = scan_folder(data_folder)
+        folders[data_folder] = {"count": int(len(df_inventory)), "size": int(df_inventory['size'].sum())}
+        sizes.append(df_inventory['size'].to_numpy(dtype=float))
+        for created_date, count in df_inventory['ctime'].dt.date.astype(str).value_counts().items():
+            created_dates[created_date] = created_dates.get(created_date, 0) + int(count)
+
+    return {
+        "count": sum(folder["count"] for folder in folders.values()),
+        "size": sum(folder["size"] for folder in folders.values()),
+        "folders": folders,
+        "sizes": summarize_values(np.concatenate(sizes) if sizes else []),
+        "created_dates": dict(sorted(created_dates.items()))
+    }
+
+
+def compute_image_metrics(data_folders: list, max_workers: int = None) -> dict:
+    """
+    :param data_folders: data folders of the tasks
+    :param max_workers: number of processes of the image statistics
+    :return: summaries of the aspect ratios and the brightness of the images
+    """
+    files_dict = {data_folder: scan_folder(data_folder)['name'].tolist() for data_folder in data_folders}
+    df_stats = get_image_stats(files_dict, max_workers=max_workers)
+
+    return {
+        "count": int(len(df_stats)),
+        "aspect_ratio": summarize_values(df_stats['aspect_ratio']),
+        "brightness": summarize_values(df_stats['brightness'], value_range=BRIGHTNESS_RANGE)
+    }
+
+
+def summarize_report(report: ReportPartial) -> dict:
+    return {
+        "image_count": len(report.image_names),
+        "object_count": int(sum(report.class_counts.values())),
+        "class_counts": report.class_counts,
+        "error_counts": report.get_error_counts()
+    }
+
+
+def create_snapshot(project_id: int, anno_file_names: list = None, data_folders: list = None,
+                    max_workers: int = None) -> ReportSnapshot:
+    """
+    computes and saves a new snapshot of a project
+    :param project_id: project id
+    :param anno_file_names: label filenames; defaults to the label files of the tasks of the project
+    :param data_folders: data folders; defaults to the data folders of the tasks of the project
+    :param max_workers: number of processes
+    :return: the saved snapshot
+    """
+    if anno_file_names is None or data_folders is None:
+        project_anno_file_names, project_data_folders = get_project_sources(project_id)
+        anno_file_names = project_anno_file_names if anno_file_names is None else anno_file_names
+        data_folders = project_data_folders if data_folders is None else data_folders
+
+    latest = ReportSnapshot.load_latest(project_id)
+    # the modification times are taken before computing so that changes during the computation make it stale
+    sources = get_source_mtimes(anno_file_names)
+    data_sources = get_folder_mtimes(data_folders)
+    report = compute_report([anno_file_name for anno_file_name in anno_file_names if os.path.exists(anno_file_name)],
+                            max_workers=max_workers)
+
+    snapshot = ReportSnapshot(project_id=project_id,
+                              sequence=latest.sequence + 1 if latest else 1,
+                              created_at=datetime.datetime.now().isoformat(),
+                              sources=sources,
+                              data_sources=data_sources,
+                              file_metrics=compute_file_metrics(data_folders),
+                              image_metrics=compute_image_metrics(data_folders, max_workers=max_workers),
+                              label_metrics=summarize_report(report))
+    snapshot.save(report)
+    logger.info(f"Saved the report snapshot {snapshot.get_filename()}")
+
+    return snapshot
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Computes the report snapshots of projects")
+    parser.add_argument("project_ids", nargs="+", type=int, help="project ids")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes")
+    args = parser.parse_args()
+
+    for project_id in args.project_ids:
+        print(create_snapshot(project_id, max_workers=args.workers).get_filename())
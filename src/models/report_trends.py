@@ -0,0 +1,195 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import src.common.utils as utils
+from src.common.constants import ADQ_WORKING_FOLDER
+from src.common.logger import get_logger
+from src.models.report_snapshot import SNAPSHOT_VERSION, ReportSnapshot
+
+logger = get_logger(__name__)
+
+"""
+.. module:: report_trends
+   :synopsis: quality trends over time and across projects from the stored report snapshots
+    The counts of each snapshot (images, objects, errors per code, objects per class) are appended once
+    to a long table (.adq/trends.csv); later updates only read the snapshots that are not in the table yet,
+    so that no label file is read again.
+    The trends are aggregated per period from the latest snapshot of each project up to that period:
+    error rates per code, objects per image, class shares and the class distribution drift.
+        python -m src.models.report_trends [--period W] [--output trends.csv]
+"""
+
+TRENDS_FILENAME = os.path.join(ADQ_WORKING_FOLDER, "trends.csv")
+TREND_COLUMNS = ['project_id', 'sequence', 'created_at', 'column', 'value']
+
+IMAGES_COLUMN = "images"
+OBJECTS_COLUMN = "objects"
+ERROR_PREFIX = "error:"
+CLASS_PREFIX = "class:"
+
+OBJECTS_PER_IMAGE = "objects_per_image"
+CLASS_DRIFT = "class_drift"
+ERROR_RATE_PREFIX = "error_rate:"
+# key of the trends of all projects together
+ALL_PROJECTS = "all"
+
+
+def get_trend_rows(snapshot: ReportSnapshot) -> list:
+    """
+    :param snapshot: report snapshot
+    :return: one TREND_COLUMNS row per count of the snapshot
+    """
+    label_metrics = snapshot.label_metrics
+    counts = {IMAGES_COLUMN: label_metrics.get("image_count", 0),
+              OBJECTS_COLUMN: label_metrics.get("object_count", 0)}
+    counts.update({ERROR_PREFIX + code: count for code, count in label_metrics.get("error_counts", {}).items()})
+    counts.update({CLASS_PREFIX + label: count for label, count in label_metrics.get("class_counts", {}).items()})
+
+    return [(snapshot.project_id, snapshot.sequence, snapshot.created_at, column, count)
+            for column, count in counts.items()]
+
+
+def load_trends(filename: str = TRENDS_FILENAME) -> pd.DataFrame:
+    if not os.path.exists(filename):
+        return pd.DataFrame(columns=TREND_COLUMNS)
+
+    try:
+        return pd.read_csv(filename, dtype={'column': str})
+    except (ValueError, KeyError) as e:
+        logger.warning(f"Ignoring {filename}: {e}")
+        return pd.DataFrame(columns=TREND_COLUMNS)
+
+
+def update_trends(project_ids: list = None, filename: str = TRENDS_FILENAME) -> pd.DataFrame:
+    """
+    appends the counts of the snapshots that are not in the trends table yet
+    :param project_ids: projects to update; defaults to all the projects with snapshots
+    :param filename: trends table
+    :return: counts of all the snapshots in the table (TREND_COLUMNS)
+    """
+    df_trends = load_trends(filename)
+    known = set(zip(df_trends['project_id'], df_trends['sequence']))
+
+    rows = []
+    for project_id in project_ids if project_ids is not None else ReportSnapshot.list_project_ids():
+        for snapshot_filename in ReportSnapshot.list_filenames(project_id):
+            # the sequence is in the filename so that the known snapshots are not read
+            if (project_id, ReportSnapshot.get_sequence(snapshot_filename)) in known:
+                continue
+
+            snapshot = ReportSnapshot.from_json(utils.from_file(snapshot_filename))
+            if snapshot.version == SNAPSHOT_VERSION:
+                rows.extend(get_trend_rows(snapshot))
+
+    if not rows:
+        return df_trends
+
+    logger.info(f"Adding {len(rows)} counts to the trends")
+    df_trends = pd.concat([df for df in [df_trends, pd.DataFrame(rows, columns=TREND_COLUMNS)] if not df.empty],
+                          ignore_index=True)
+    try:
+        df_trends.to_csv(filename, index=False)
+    except OSError as e:
+        logger.warning(f"Cannot save the trends: {e}")
+
+    return df_trends
+
+
+def get_period_counts(df_trends: pd.DataFrame, period: str = "W", project_ids: list = None) -> pd.DataFrame:
+    """
+    :param df_trends: counts of the snapshots (TREND_COLUMNS)
+    :param period: pandas period alias (D, W, M, ...)
+    :param project_ids: projects to include; defaults to all
+    :return: counts (columns) of each (project_id, period); a project keeps its latest counts
+        in the periods without a new snapshot so that the totals do not drop
+    """
+    if project_ids is not None:
+        df_trends = df_trends[df_trends['project_id'].isin(project_ids)]
+    if df_trends.empty:
+        return pd.DataFrame()
+
+    df_trends = df_trends.assign(
+        period=pd.to_datetime(df_trends['created_at']).dt.to_period(period).dt.start_time)
+    # the latest snapshot of a project in a period
+    latest = df_trends.groupby(['project_id', 'period'])['sequence'].transform('max') == df_trends['sequence']
+    df_counts = df_trends[latest].pivot_table(index='period', columns=['project_id', 'column'],
+                                              values='value', aggfunc='sum')
+
+    # a count missing in a snapshot (e.g., a class without objects any more) is zero, not the previous count
+    has_snapshot = df_counts.notna().T.groupby(level='project_id').transform('any').T
+    df_counts = df_counts.mask(has_snapshot & df_counts.isna(), 0)
+
+    periods = pd.period_range(df_counts.index.min(), df_counts.index.max(), freq=period).start_time
+    df_counts = df_counts.reindex(periods).ffill()
+    df_counts.index.name = 'period'
+
+    return df_counts.stack(level='project_id').dropna(how='all').fillna(0)
+
+
+def calculate_trends(df_counts: pd.DataFrame) -> (pd.DataFrame, pd.DataFrame):
+    """
+    :param df_counts: counts of each (key, period) where the key is a project or ALL_PROJECTS
+    :return: metrics (objects per image, error rates per code, class drift) and class shares of each (key, period)
+    """
+    objects = df_counts[OBJECTS_COLUMN].replace(0, np.nan)
+    class_columns = [column for column in df_counts.columns if column.startswith(CLASS_PREFIX)]
+    error_columns = [column for column in df_counts.columns if column.startswith(ERROR_PREFIX)]
+
+    df_shares = df_counts[class_columns].div(objects, axis=0).fillna(0)
+    df_shares.columns = [column[len(CLASS_PREFIX):] for column in class_columns]
+
+    df_metrics = pd.DataFrame({
+        IMAGES_COLUMN: df_counts[IMAGES_COLUMN],
+        OBJECTS_COLUMN: df_counts[OBJECTS_COLUMN],
+        OBJECTS_PER_IMAGE: df_counts[OBJECTS_COLUMN] / df_counts[IMAGES_COLUMN].replace(0, np.nan)
+    })
+    for column in error_columns:
+        df_metrics[ERROR_RATE_PREFIX + column[len(ERROR_PREFIX):]] = df_counts[column] / objects
+    # total variation distance between the class distributions of consecutive periods
+    df_metrics[CLASS_DRIFT] = df_shares.groupby(level='key').diff().abs().sum(axis=1, min_count=1) / 2
+
+    return df_metrics, df_shares
+
+
+def summarize_trends(df_trends: pd.DataFrame, period: str = "W", project_ids: list = None,
+                     by_project: bool = False) -> (pd.DataFrame, pd.DataFrame):
+    """
+    :param df_trends: counts of the snapshots (TREND_COLUMNS)
+    :param period: pandas period alias (D, W, M, ...)
+    :param project_ids: projects to include; defaults to all
+    :param by_project: trends of each project instead of all the projects together
+    :return: metrics and class shares indexed by (key, period); the key is the project id or ALL_PROJECTS
+    """
+    df_counts = get_period_counts(df_trends, period, project_ids)
+    if df_counts.empty:
+        return pd.DataFrame(), pd.DataFrame()
+
+    df_counts = df_counts.swaplevel().sort_index()
+    if by_project:
+        df_counts.index.names = ['key', 'period']
+    else:
+        df_counts = df_counts.groupby(level='period').sum()
+        df_counts.index = pd.MultiIndex.from_product([[ALL_PROJECTS], df_counts.index], names=['key', 'period'])
+
+    for column in [IMAGES_COLUMN, OBJECTS_COLUMN]:
+        if column not in df_counts.columns:
+            df_counts[column] = 0
+
+    return calculate_trends(df_counts)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Updates and summarizes the quality trends of the projects")
+    parser.add_argument("--period", default="W", help="pandas period alias (D, W, M, ...)")
+    parser.add_argument("--by-project", action="store_true", help="trends of each project")
+    parser.add_argument("--output", help="CSV file to write the trends to")
+    args = parser.parse_args()
+
+    df_metrics, _ = summarize_trends(update_trends(), period=args.period, by_project=args.by_project)
+    if args.output:
+        df_metrics.to_csv(args.output)
+    else:
+        print(df_metrics.to_string())
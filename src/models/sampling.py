@@ -0,0 +1,370 @@
+import argparse
+import json
+import os
+import shutil
+
+import attr
+import numpy as np
+from scipy import sparse
+
+import src.common.utils as utils
+from src.common.logger import get_logger
+
+logger = get_logger(__name__)
+
+"""
+.. module:: sampling
+   :synopsis: image index of a label file and uniform or stratified (by class) samples of its images
+    The index (name, object count and classes of each image) is built in one pass over the label file and cached
+    next to it (<label file>.images.npz) until the label file changes, so that the samples are drawn from the
+    index without loading the labels.
+    The label file is read incrementally: the images are decoded one at a time from the "images" array,
+    so that neither building the index nor writing a sample holds all the images in memory.
+    A sample is written by streaming the selected images of the label file one at a time into the sample label file;
+    the other images are neither converted nor copied. The sampled image files are hard-linked (or copied where
+    links are not supported) into the data folder of the sample.
+        python -m src.models.sampling <label file> <output label file> --percent 5 [--stratified]
+            [--data-folder <image folder> --output-data-folder <sample image folder>]
+"""
+
+IMAGE_INDEX_EXT = ".images.npz"
+# characters read from the label file at a time
+READ_SIZE = 1 << 20
+JSON_WHITESPACE = " \t\r\n"
+JSON_DELIMITERS = JSON_WHITESPACE + ",]}"
+
+
+class JsonStream:
+    """
+    decodes the values of a JSON text one at a time from a file with a buffer of about READ_SIZE characters
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.buffer = ""
+        self.position = 0
+        self.is_eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _read(self) -> bool:
+        # a value larger than the buffer doubles the next read so that it is decoded again only a few times
+        chunk = self.file.read(max(READ_SIZE, len(self.buffer) - self.position))
+        if not chunk:
+            self.is_eof = True
+            return False
+
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self) -> str:
+        """
+        :return: next character after whitespace without consuming it; empty at the end of the file
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in JSON_WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._read():
+                return ""
+
+    def consume(self, expected: str):
+        character = self.peek()
+        if character != expected:
+            raise ValueError(f"Expected '{expected}' but found '{character}' in {self.file.name}")
+        self.position += 1
+
+    def decode(self):
+        """
+        :return: next JSON value
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # a number (e.g., "12.5" of "12.5e3") is complete only if a delimiter follows it in the buffer
+                if self.is_eof or isinstance(value, (str, list, dict)) or (
+                        end < len(self.buffer) and self.buffer[end] in JSON_DELIMITERS):
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.is_eof:
+                    raise
+            self._read()
+
+    def iter_array(self):
+        """
+        :return: generator of the values of the next JSON array
+        """
+        self.consume("[")
+        is_first = True
+        while self.peek() != "]":
+            if not is_first:
+                self.consume(",")
+            is_first = False
+            yield self.decode()
+        self.consume("]")
+
+
+def iter_labels(file):
+    """
+    :param file: label file opened as text
+    :return: generator of (key, value) of the label file; the value of "images" is a generator of the images,
+        which is skipped if it is not consumed before the next item
+    """
+    stream = JsonStream(file)
+    stream.consume("{")
+    is_first = True
+    while stream.peek() != "}":
+        if not is_first:
+            stream.consume(",")
+        is_first = False
+        key = stream.decode()
+        stream.consume(":")
+        if key == "images" and stream.peek() == "[":
+            json_images = stream.iter_array()
+            yield key, json_images
+            for _ in json_images:
+                pass
+        else:
+            yield key, stream.decode()
+    stream.consume("}")
+
+
+@attr.s(slots=True, frozen=False)
+class ImageIndex:
+    anno_file_name = attr.ib(validator=attr.validators.instance_of(str))
+    # modification time of the label file the index was built from
+    mtime = attr.ib(default=None)
+    names = attr.ib(default=attr.Factory(lambda: np.empty(0, dtype=str)))
+    object_counts = attr.ib(default=attr.Factory(lambda: np.empty(0, dtype=np.int64)))
+    class_names = attr.ib(default=attr.Factory(lambda: np.empty(0, dtype=str)))
+    # (images, classes) CSR matrix of the classes in each image
+    classes = attr.ib(default=attr.Factory(lambda: sparse.csr_matrix((0, 0), dtype=np.int8)))
+
+    def is_valid(self) -> bool:
+        return os.path.exists(self.anno_file_name) and self.mtime == os.path.getmtime(self.anno_file_name)
+
+    def save(self):
+        np.savez(ImageIndex.get_index_filename(self.anno_file_name), mtime=np.float64(self.mtime),
+                 names=self.names.astype(str), object_counts=self.object_counts,
+                 class_names=self.class_names.astype(str), class_indptr=self.classes.indptr,
+                 class_indices=self.classes.indices)
+
+    @staticmethod
+    def get_index_filename(anno_file_name: str) -> str:
+        return anno_file_name + IMAGE_INDEX_EXT
+
+    @staticmethod
+    def from_labels(anno_file_name: str) -> 'ImageIndex':
+        """
+        :param anno_file_name: label filename
+        :return: index built from the JSON images without converting them to DataLabels
+        """
+        index = ImageIndex(anno_file_name=anno_file_name, mtime=os.path.getmtime(anno_file_name))
+
+        class_ids = dict()
+        names, object_counts, indptr, indices = [], [], [0], []
+        with open(anno_file_name, encoding="utf-8") as anno_file:
+            for key, json_images in iter_labels(anno_file):
+                if key != "images" or not json_images:
+                    continue
+                for json_image in json_images:
+                    json_objects = json_image.get("objects") or []
+                    names.append(json_image.get("name", ""))
+                    object_counts.append(len(json_objects))
+                    image_class_ids = {class_ids.setdefault(json_object.get("label"), len(class_ids))
+                                       for json_object in json_objects}
+                    indices.extend(sorted(image_class_ids))
+                    indptr.append(len(indices))
+
+        index.names = np.array(names, dtype=str)
+        index.object_counts = np.array(object_counts, dtype=np.int64)
+        index.class_names = np.array([str(class_name) for class_name in class_ids], dtype=str)
+        index.classes = sparse.csr_matrix((np.ones(len(indices), dtype=np.int8), np.array(indices, dtype=np.int64),
+                                           np.array(indptr, dtype=np.int64)), shape=(len(names), len(class_ids)))
+        return index
+
+    @staticmethod
+    def load(anno_file_name: str) -> 'ImageIndex':
+        """
+        :param anno_file_name: label filename
+        :return: the cached index if the label file did not change; otherwise it is built and cached
+        """
+        index_filename = ImageIndex.get_index_filename(anno_file_name)
+        if os.path.exists(index_filename):
+            try:
+                with np.load(index_filename, allow_pickle=False) as cached:
+                    indices = cached["class_indices"]
+                    index = ImageIndex(anno_file_name=anno_file_name, mtime=float(cached["mtime"]),
+                                       names=cached["names"], object_counts=cached["object_counts"],
+                                       class_names=cached["class_names"],
+                                       classes=sparse.csr_matrix((np.ones(len(indices), dtype=np.int8), indices,
+                                                                  cached["class_indptr"]),
+                                                                 shape=(len(cached["names"]),
+                                                                        len(cached["class_names"]))))
+                if index.is_valid():
+                    return index
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Cannot load {index_filename}: {e}")
+
+        index = ImageIndex.from_labels(anno_file_name)
+        index.save()
+        return index
+
+
+def get_sample_count(count: int, percent: float) -> int:
+    return int((count * percent) / 100)
+
+
+def sample_uniform(image_count: int, sample_count: int, seed: int = None) -> np.ndarray:
+    """
+    :param image_count: number of images
+    :param sample_count: number of images to sample
+    :param seed: random seed; None for a different sample each time
+    :return: sorted indices of a uniform sample of the images
+    """
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(image_count, min(sample_count, image_count), replace=False))
+
+
+def sample_stratified(index: ImageIndex, sample_count: int, seed: int = None) -> np.ndarray:
+    """
+    samples the images so that each class gets images in proportion to the number of images it is in
+    and at least one image; the rarest classes are sampled first and the rest of the sample is uniform
+    :param index: image index
+    :param sample_count: number of images to sample
+    :param seed: random seed; None for a different sample each time
+    :return: sorted indices of the sampled images
+    """
+    image_count = len(index.names)
+    sample_count = min(sample_count, image_count)
+    rng = np.random.default_rng(seed)
+    class_images = index.classes.tocsc()
+    class_image_counts = np.diff(class_images.indptr)
+    quotas = np.maximum(1, np.round(class_image_counts * sample_count / max(1, image_count))).astype(np.int64)
+
+    is_sampled = np.zeros(image_count, dtype=bool)
+    sampled_count = 0
+    for class_id in np.argsort(class_image_counts, kind="stable"):
+        if sampled_count >= sample_count:
+            break
+        images = class_images.indices[class_images.indptr[class_id]:class_images.indptr[class_id + 1]]
+        # the images sampled for rarer classes count toward the quota
+        missing = min(quotas[class_id] - np.count_nonzero(is_sampled[images]), sample_count - sampled_count)
+        candidates = images[~is_sampled[images]]
+        if missing <= 0 or len(candidates) == 0:
+            continue
+        picked = rng.choice(candidates, min(missing, len(candidates)), replace=False)
+        is_sampled[picked] = True
+        sampled_count += len(picked)
+
+    if sampled_count < sample_count:
+        remaining = np.flatnonzero(~is_sampled)
+        is_sampled[rng.choice(remaining, sample_count - sampled_count, replace=False)] = True
+
+    return np.flatnonzero(is_sampled)
+
+
+def write_sample(anno_file_name: str, image_indices: np.ndarray, output_filename: str):
+    """
+    streams the selected images of a label file into a new label file; the file is replaced when it is complete.
+    The images are decoded one at a time and only the selected ones are written
+    :param anno_file_name: label filename
+    :param image_indices: indices of the images to write
+    :param output_filename: sample label filename
+    """
+    selected = set(np.asarray(image_indices).tolist())
+    temp_filename = output_filename + ".tmp"
+    with open(anno_file_name, encoding="utf-8") as anno_file, open(temp_filename, "w", encoding="utf-8") as output:
+        output.write("{")
+        for key_index, (key, value) in enumerate(iter_labels(anno_file)):
+            if key_index > 0:
+                output.write(", ")
+            output.write(f"{json.dumps(key)}: ")
+            if key != "images" or not hasattr(value, "__next__"):
+                output.write(json.dumps(value, default=utils.default, ensure_ascii=False))
+                continue
+
+            output.write("[")
+            written_count = 0
+            for position, json_image in enumerate(value):
+                if position not in selected:
+                    continue
+                if written_count > 0:
+                    output.write(",\n")
+                output.write(json.dumps(json_image, default=utils.default, ensure_ascii=False))
+                written_count += 1
+            output.write("]")
+        output.write("}")
+    os.replace(temp_filename, output_filename)
+
+
+def link_images(image_names: list, data_folder: str, output_data_folder: str) -> int:
+    """
+    hard-links the images into another folder; they are copied if the folders do not support links between them
+    :param image_names: image filenames relative to data_folder
+    :param data_folder: folder of the images
+    :param output_data_folder: folder to link the images into
+    :return: number of linked or copied images; the missing images are skipped
+    """
+    os.makedirs(output_data_folder, exist_ok=True)
+    linked_count = 0
+    for image_name in image_names:
+        image_path = os.path.join(data_folder, image_name)
+        output_path = os.path.join(output_data_folder, os.path.basename(image_name))
+        if not os.path.exists(image_path):
+            logger.warning(f"{image_path} does not exist")
+            continue
+        if not os.path.exists(output_path):
+            try:
+                os.link(image_path, output_path)
+            except OSError:
+                shutil.copy2(image_path, output_path)
+        linked_count += 1
+
+    return linked_count
+
+
+def sample_labels(anno_file_name: str, output_filename: str, sample_count: int, is_stratified: bool = False,
+                  seed: int = None, data_folder: str = None, output_data_folder: str = None) -> (int, int, int):
+    """
+    :param anno_file_name: label filename
+    :param output_filename: sample label filename
+    :param sample_count: number of images to sample
+    :param is_stratified: if True, the sample is stratified by class; otherwise it is uniform
+    :param seed: random seed; None for a different sample each time
+    :param data_folder: folder of the images of the label file
+    :param output_data_folder: if set with data_folder, the sampled images are linked into this folder
+    :return: number of sampled images, their number of objects and the number of images of the label file
+    """
+    index = ImageIndex.load(anno_file_name)
+    if is_stratified:
+        image_indices = sample_stratified(index, sample_count, seed)
+    else:
+        image_indices = sample_uniform(len(index.names), sample_count, seed)
+
+    write_sample(anno_file_name, image_indices, output_filename)
+    if data_folder and output_data_folder:
+        link_images(index.names[image_indices].tolist(), data_folder, output_data_folder)
+    return len(image_indices), int(index.object_counts[image_indices].sum()), len(index.names)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Samples the images of a label file")
+    parser.add_argument("anno_file_name", help="label file")
+    parser.add_argument("output_filename", help="sample label file")
+    parser.add_argument("--percent", type=float, required=True, help="percentage of the images to sample")
+    parser.add_argument("--stratified", action="store_true", help="stratify the sample by class")
+    parser.add_argument("--seed", type=int, default=None, help="random seed")
+    parser.add_argument("--data-folder", default=None, help="folder of the images of the label file")
+    parser.add_argument("--output-data-folder", default=None, help="folder to link the sampled images into")
+    args = parser.parse_args()
+
+    sample_count = get_sample_count(len(ImageIndex.load(args.anno_file_name).names), args.percent)
+    data_count, object_count, total_count = sample_labels(args.anno_file_name, args.output_filename, sample_count,
+                                                          is_stratified=args.stratified, seed=args.seed,
+                                                          data_folder=args.data_folder,
+                                                          output_data_folder=args.output_data_folder)
+    print(f"Sampled {data_count} of {total_count} images with {object_count} objects into {args.output_filename}")
@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+
+from src.common.logger import get_logger
+from src.models.data_labels import DataLabels
+
+logger = get_logger(__name__)
+
+"""
+.. module:: task_comparison
+   :synopsis: pairs the objects of two tasks on the same images (e.g., annotator vs. reviewer)
+    Objects are compared by the IoU of their bounding rectangles and paired with the Hungarian algorithm.
+    A pair whose labels differ is a label disagreement and an object without a pair is a missing object.
+"""
+
+DEFAULT_IOU_THRESHOLD = 0.5
+
+COMPARISON_COLUMNS = ['image_name', 'index1', 'index2', 'object_count1', 'object_count2',
+                      'matched', 'unmatched1', 'unmatched2', 'label_mismatches', 'mean_iou', 'disagreements']
+
+
+def get_bounding_rectangles(image: DataLabels.Image) -> np.ndarray:
+    """
+    :param image: label image
+    :return: (n, 4) array of xtl, ytl, xbr, ybr; objects without points get an empty rectangle
+    """
+    rectangles = np.zeros((len(image.objects), 4), dtype=np.float32)
+    for idx, label_object in enumerate(image.objects):
+        if label_object.points:
+            rectangles[idx] = DataLabels.Object.get_bounding_rectangle(label_object)[:4]
+
+    return rectangles
+
+
+def calculate_iou_matrix(rectangles1: np.ndarray, rectangles2: np.ndarray) -> np.ndarray:
+    """
+    calculates the IoU of all rectangle pairs at once
+    :param rectangles1: (n, 4) array of xtl, ytl, xbr, ybr
+    :param rectangles2: (m, 4) array of xtl, ytl, xbr, ybr
+    :return: (n, m) IoU matrix
+    """
+    xtl = np.maximum(rectangles1[:, None, 0], rectangles2[None, :, 0])
+    ytl = np.maximum(rectangles1[:, None, 1], rectangles2[None, :, 1])
+    xbr = np.minimum(rectangles1[:, None, 2], rectangles2[None, :, 2])
+    ybr = np.minimum(rectangles1[:, None, 3], rectangles2[None, :, 3])
+    intersections = np.clip(xbr - xtl, 0, None) * np.clip(ybr - ytl, 0, None)
+
+    areas1 = (rectangles1[:, 2] - rectangles1[:, 0]) * (rectangles1[:, 3] - rectangles1[:, 1])
+    areas2 = (rectangles2[:, 2] - rectangles2[:, 0]) * (rectangles2[:, 3] - rectangles2[:, 1])
+    unions = areas1[:, None] + areas2[None, :] - intersections
+
+    return np.divide(intersections, unions, out=np.zeros_like(intersections), where=unions > 0)
+
+
+def match_objects(image1: DataLabels.Image, image2: DataLabels.Image,
+                  iou_threshold: float = DEFAULT_IOU_THRESHOLD) -> list:
+    """
+    pairs the objects of two label images
+    :param image1: label image of the first task
+    :param image2: label image of the second task
+    :param iou_threshold: minimum IoU for two objects to be paired
+    :return: list of (object index1 or None, object index2 or None, iou)
+    """
+    rectangles1 = get_bounding_rectangles(image1)
+    rectangles2 = get_bounding_rectangles(image2)
+
+    pairs = []
+    matched1, matched2 = set(), set()
+    if len(rectangles1) > 0 and len(rectangles2) > 0:
+        iou_matrix = calculate_iou_matrix(rectangles1, rectangles2)
+        rows, cols = linear_sum_assignment(iou_matrix, maximize=True)
+        for row, col in zip(rows, cols):
+            if iou_matrix[row, col] >= iou_threshold:
+                pairs.append((int(row), int(col), float(iou_matrix[row, col])))
+                matched1.add(row)
+                matched2.add(col)
+
+    pairs.extend((idx, None, 0.0) for idx in range(len(rectangles1)) if idx not in matched1)
+    pairs.extend((None, idx, 0.0) for idx in range(len(rectangles2)) if idx not in matched2)
+
+    return pairs
+
+
+def compare_data_labels(data_labels1: DataLabels, data_labels2: DataLabels,
+                        iou_threshold: float = DEFAULT_IOU_THRESHOLD) -> pd.DataFrame:
+    """
+    compares the images both tasks have in common
+    :param data_labels1: labels of the first task
+    :param data_labels2: labels of the second task
+    :param iou_threshold: minimum IoU for two objects to be paired
+    :return: one row per common image (COMPARISON_COLUMNS) in the order of the first task
+    """
+    image_indices2 = {image.name: idx for idx, image in enumerate(data_labels2.images)}
+
+    rows = []
+    for index1, image1 in enumerate(data_labels1.images):
+        index2 = image_indices2.get(image1.name)
+        if index2 is None:
+            continue
+
+        image2 = data_labels2.images[index2]
+        pairs = match_objects(image1, image2, iou_threshold)
+        matched = [(idx1, idx2, iou) for idx1, idx2, iou in pairs if idx1 is not None and idx2 is not None]
+        label_mismatches = sum(1 for idx1, idx2, _ in matched
+                               if image1.objects[idx1].label != image2.objects[idx2].label)
+        unmatched1 = sum(1 for idx1, idx2, _ in pairs if idx2 is None)
+        unmatched2 = sum(1 for idx1, idx2, _ in pairs if idx1 is None)
+
+        rows.append((image1.name, index1, index2, len(image1.objects), len(image2.objects),
+                     len(matched), unmatched1, unmatched2, label_mismatches,
+                     float(np.mean([iou for _, _, iou in matched])) if matched else 0.0,
+                     unmatched1 + unmatched2 + label_mismatches))
+
+    return pd.DataFrame(rows, columns=COMPARISON_COLUMNS)
@@ -0,0 +1,131 @@
+import json
+import math
+import os
+import tempfile
+
+from PIL import Image, ImageDraw
+
+import src.common.utils as utils
+from src.common.constants import JSON_EXT
+from src.common.logger import get_logger
+from src.models.thumbnails import FILE_MODE, THUMBNAIL_SIZE, scan_image_mtimes
+
+logger = get_logger(__name__)
+
+"""
+.. module:: thumbnail_atlas
+   :synopsis: pages of thumbnails packed into one image (atlas) with the offsets of each thumbnail
+    A page of N thumbnails of a task is a single JPEG (atlases/atlas-<N>-<page>.jpg) and a JSON file with the
+    filename and the cell of each thumbnail, so that a page of the image grid is one image transfer.
+    An atlas records the modification times of its thumbnails and is packed again only when they change.
+"""
+
+ATLAS_FOLDER = "atlases"
+ATLAS_PREFIX = "atlas-"
+ATLAS_EXT = ".jpg"
+ATLAS_PAGE_SIZE = 100
+ATLAS_COLUMNS = 10
+ATLAS_BACKGROUND = (255, 255, 255)
+ATLAS_QUALITY = 85
+# color of the cell numbers drawn on the atlas
+ATLAS_INDEX_COLOR = (255, 0, 0)
+
+
+def get_atlas_folder(thumbnails_folder: str) -> str:
+    """
+    :param thumbnails_folder: .adq/<project id>/<task id>/thumbnails
+    :return: .adq/<project id>/<task id>/atlases
+    """
+    return os.path.join(os.path.dirname(os.path.normpath(thumbnails_folder)), ATLAS_FOLDER)
+
+
+def get_page_count(thumbnails_folder: str, page_size: int = ATLAS_PAGE_SIZE) -> int:
+    return math.ceil(len(scan_image_mtimes(thumbnails_folder)) / page_size)
+
+
+def _write_atomically(filename: str, write):
+    file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(filename), suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "wb") as temp_file:
+            write(temp_file)
+        os.chmod(temp_path, FILE_MODE)
+        os.replace(temp_path, filename)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def pack_atlas(thumbnail_paths: list, atlas_filename: str, cell_size: tuple = THUMBNAIL_SIZE,
+               columns: int = ATLAS_COLUMNS) -> list:
+    """
+    packs the thumbnails into one image; each thumbnail is centered in its cell and numbered from 1
+    :param thumbnail_paths: thumbnail filenames
+    :param atlas_filename: atlas image to write
+    :param cell_size: (width, height) of a cell
+    :param columns: number of cells per row
+    :return: [x, y, width, height] of each thumbnail in the atlas (None if it cannot be read)
+    """
+    cell_width, cell_height = cell_size
+    rows = max(1, math.ceil(len(thumbnail_paths) / columns))
+    atlas = Image.new("RGB", (cell_width * min(columns, max(1, len(thumbnail_paths))), cell_height * rows),
+                      ATLAS_BACKGROUND)
+    draw = ImageDraw.Draw(atlas)
+
+    offsets = []
+    for idx, thumbnail_path in enumerate(thumbnail_paths):
+        cell_x, cell_y = (idx % columns) * cell_width, (idx // columns) * cell_height
+        try:
+            with Image.open(thumbnail_path) as thumbnail:
+                thumbnail.thumbnail(cell_size)
+                x = cell_x + (cell_width - thumbnail.width) // 2
+                y = cell_y + (cell_height - thumbnail.height) // 2
+                atlas.paste(thumbnail.convert("RGB"), (x, y))
+                offsets.append([x, y, thumbnail.width, thumbnail.height])
+        except Exception as e:
+            logger.error(f"Cannot pack {thumbnail_path}: {e}")
+            offsets.append(None)
+        draw.text((cell_x + 2, cell_y + 2), str(idx + 1), fill=ATLAS_INDEX_COLOR)
+
+    _write_atomically(atlas_filename, lambda output: atlas.save(output, format="JPEG", quality=ATLAS_QUALITY))
+    return offsets
+
+
+def get_atlas_page(thumbnails_folder: str, page: int, page_size: int = ATLAS_PAGE_SIZE) -> (str, list):
+    """
+    :param thumbnails_folder: thumbnail folder of a task
+    :param page: page number from 0
+    :param page_size: number of thumbnails per page
+    :return: atlas image filename and one {"filename", "offset"} entry per thumbnail of the page;
+        the atlas is packed only if it does not exist or its thumbnails changed
+    """
+    thumbnail_mtimes = scan_image_mtimes(thumbnails_folder)
+    filenames = sorted(thumbnail_mtimes.keys())[page * page_size:(page + 1) * page_size]
+    if not filenames:
+        return None, []
+
+    atlas_folder = get_atlas_folder(thumbnails_folder)
+    atlas_filename = os.path.join(atlas_folder, f"{ATLAS_PREFIX}{page_size}-{page:04d}{ATLAS_EXT}")
+    offsets_filename = atlas_filename[:-len(ATLAS_EXT)] + JSON_EXT
+
+    sources = [[filename, thumbnail_mtimes[filename]] for filename in filenames]
+    json_atlas = utils.from_file(offsets_filename)
+    if json_atlas.get("sources") == sources and os.path.exists(atlas_filename):
+        return atlas_filename, json_atlas["entries"]
+
+    logger.info(f"Packing {atlas_filename}")
+    os.makedirs(atlas_folder, exist_ok=True)
+    offsets = pack_atlas([os.path.join(thumbnails_folder, filename) for filename in filenames], atlas_filename)
+    entries = [{"filename": filename, "offset": offset} for filename, offset in zip(filenames, offsets)]
+    json_data = json.dumps({"sources": sources, "entries": entries}, ensure_ascii=False)
+    _write_atomically(offsets_filename, lambda output: output.write(json_data.encode("utf-8")))
+
+    return atlas_filename, entries
+
+
+def get_data_path(thumbnails_folder: str, filename: str) -> str:
+    """
+    :return: full-size image of a thumbnail
+    """
+    task_folder = os.path.dirname(os.path.normpath(thumbnails_folder))
+    return os.path.join(task_folder, "data", filename)
+
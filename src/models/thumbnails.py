@@ -0,0 +1,177 @@
+import argparse
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import attr
+from PIL import Image
+
+from src.common.constants import SUPPORTED_IMAGE_FILE_EXTENSIONS
+from src.common.logger import get_logger
+
+logger = get_logger(__name__)
+
+"""
+.. module:: thumbnails
+   :synopsis: thumbnails of the data folders generated in parallel and incrementally
+    Only the images without a thumbnail or with a thumbnail older than the image are processed.
+    JPEG images are decoded at a reduced scale (draft mode) and each thumbnail is written to a temporary file
+    that is renamed, so that a reader never sees a partial thumbnail.
+    The thumbnails of a task are generated when its data is added; the pages only fill in what is missing.
+        python -m src.models.thumbnails <data folder>... [--workers N]
+"""
+
+THUMBNAIL_SIZE = (128, 128)
+THUMBNAILS_FOLDER = "thumbnails"
+# with fewer images, starting the process pool takes longer than generating the thumbnails
+MIN_PARALLEL_IMAGES = 16
+
+
+def get_file_mode() -> int:
+    """
+    :return: mode of the files created by open() under the current umask
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# tempfile.mkstemp creates the files readable only by their owner and os.replace keeps the mode;
+# the umask is read once because setting it is not thread-safe
+FILE_MODE = get_file_mode()
+
+
+@attr.s(slots=True, frozen=False)
+class ThumbnailResult:
+    # thumbnail filenames that were generated
+    created = attr.ib(default=attr.Factory(list), validator=attr.validators.instance_of(list))
+    # number of thumbnails that were up to date
+    skipped = attr.ib(default=0, validator=attr.validators.instance_of(int))
+    # image filename -> error
+    failures = attr.ib(default=attr.Factory(dict), validator=attr.validators.instance_of(dict))
+
+
+def get_thumbnails_folder(data_folder: str) -> str:
+    """
+    :param data_folder: .adq/<project id>/<task id>/data
+    :return: .adq/<project id>/<task id>/thumbnails
+    """
+    return os.path.join(os.path.dirname(os.path.normpath(data_folder)), THUMBNAILS_FOLDER)
+
+
+def scan_image_mtimes(folder: str) -> dict:
+    """
+    :return: image filename -> modification time (ns) from a single os.scandir pass
+    """
+    if not os.path.isdir(folder):
+        return dict()
+
+    extensions = tuple('.' + extension for extension in SUPPORTED_IMAGE_FILE_EXTENSIONS)
+    with os.scandir(folder) as entries:
+        return {entry.name: entry.stat().st_mtime_ns for entry in entries
+                if entry.is_file() and entry.name.endswith(extensions)}
+
+
+def get_stale_filenames(data_folder: str, thumbnails_folder: str) -> (list, int):
+    """
+    :param data_folder: image folder
+    :param thumbnails_folder: thumbnail folder
+    :return: image filenames without an up-to-date thumbnail and the number of up-to-date thumbnails
+    """
+    image_mtimes = scan_image_mtimes(data_folder)
+    thumbnail_mtimes = scan_image_mtimes(thumbnails_folder)
+    stale_filenames = sorted(filename for filename, mtime in image_mtimes.items()
+                             if thumbnail_mtimes.get(filename, -1) < mtime)
+
+    return stale_filenames, len(image_mtimes) - len(stale_filenames)
+
+
+def create_thumbnail(image_path: str, thumbnail_path: str, size: tuple = THUMBNAIL_SIZE) -> str:
+    """
+    :param image_path: image filename
+    :param thumbnail_path: thumbnail filename; it is replaced atomically
+    :param size: maximum (width, height) of the thumbnail
+    :return: None or the error if the thumbnail cannot be created
+    """
+    temp_path = None
+    try:
+        with Image.open(image_path) as image:
+            image_format = image.format
+            # no-op for the formats other than JPEG
+            image.draft(image.mode, size)
+            image.thumbnail(size)
+
+            file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(thumbnail_path), suffix=".tmp")
+            with os.fdopen(file_descriptor, "wb") as temp_file:
+                image.save(temp_file, format=image_format)
+        os.chmod(temp_path, FILE_MODE)
+        os.replace(temp_path, thumbnail_path)
+    except Exception as e:
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+        return str(e)
+
+
+def _create_thumbnail(args: tuple) -> str:
+    return create_thumbnail(*args)
+
+
+def generate_thumbnails(data_folder: str, thumbnails_folder: str = None, size: tuple = THUMBNAIL_SIZE,
+                        max_workers: int = None, progress=None) -> ThumbnailResult:
+    """
+    generates the missing and outdated thumbnails of a folder
+    :param data_folder: image folder
+    :param thumbnails_folder: thumbnail folder; defaults to the thumbnails folder next to the data folder
+    :param size: maximum (width, height) of the thumbnails
+    :param max_workers: number of processes; defaults to the number of CPUs
+    :param progress: optional function called with (number of processed images, number of images to process)
+    :return: created thumbnails, number of up-to-date thumbnails and failures
+    """
+    thumbnails_folder = thumbnails_folder or get_thumbnails_folder(data_folder)
+    os.makedirs(thumbnails_folder, exist_ok=True)
+
+    stale_filenames, skipped = get_stale_filenames(data_folder, thumbnails_folder)
+    result = ThumbnailResult(skipped=skipped)
+    if not stale_filenames:
+        return result
+
+    logger.info(f"Generating {len(stale_filenames)} thumbnails of {data_folder}")
+    jobs = [(os.path.join(data_folder, filename), os.path.join(thumbnails_folder, filename), size)
+            for filename in stale_filenames]
+    if len(jobs) < MIN_PARALLEL_IMAGES:
+        errors = map(_create_thumbnail, jobs)
+        _collect_results(jobs, errors, result, progress)
+    else:
+        max_workers = max_workers or os.cpu_count() or 1
+        chunksize = max(1, len(jobs) // (max_workers * 4))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            _collect_results(jobs, executor.map(_create_thumbnail, jobs, chunksize=chunksize), result, progress)
+
+    if result.failures:
+        logger.error(f"Cannot generate {len(result.failures)} thumbnails of {data_folder}")
+
+    return result
+
+
+def _collect_results(jobs: list, errors, result: ThumbnailResult, progress):
+    for done, ((image_path, thumbnail_path, _), error) in enumerate(zip(jobs, errors), start=1):
+        if error:
+            result.failures[image_path] = error
+        else:
+            result.created.append(thumbnail_path)
+        if progress:
+            progress(done, len(jobs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generates the missing and outdated thumbnails of data folders")
+    parser.add_argument("data_folders", nargs="+", help="image folders")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes")
+    args = parser.parse_args()
+
+    for folder in args.data_folders:
+        thumbnail_result = generate_thumbnails(folder, max_workers=args.workers)
+        print(f"{folder}: {len(thumbnail_result.created)} created, {thumbnail_result.skipped} up to date, "
+              f"{len(thumbnail_result.failures)} failed")
+        for failed_path, failure in thumbnail_result.failures.items():
+            print(f"  {failed_path}: {failure}")
@@ -1,5 +1,4 @@
 import os.path
-from PIL import Image
 import pandas as pd
 import streamlit as st
 
@@ -13,6 +12,8 @@ from src.common.constants import (
     SUPPORTED_IMAGE_FILE_EXTENSIONS,
     UserType
 )
+from src.models import thumbnails
+from src.models.thumbnail_atlas import get_page_count
 from src.models.projects_info import ProjectsInfo, Project, ProjectPointers
 from src.models.tasks_info import Task, TasksInfo, TaskPointers
 from src.models.users_info import User
@@ -116,24 +117,36 @@ def select_task(project_id: int, label="Select task") -> Task:
         st.markdown("**No task is created!**")
 
 
-def generate_thumbnails(folder_path, thumbnail_size=(128, 128), output_folder="thumbnails"):
-    os.makedirs(output_folder, exist_ok=True)
+def generate_thumbnails(folder_path, thumbnail_size=thumbnails.THUMBNAIL_SIZE, output_folder=None) -> list:
+    """
+    generates the missing and outdated thumbnails of a data folder
+    :param folder_path: data folder
+    :param thumbnail_size: maximum (width, height) of the thumbnails
+    :param output_folder: thumbnail folder; defaults to the thumbnails folder of the task
+    :return: filenames of the thumbnails that were generated
+    """
+    result = thumbnails.generate_thumbnails(folder_path, output_folder, size=thumbnail_size)
+    for image_path, error in result.failures.items():
+        logger.error(f"Error processing {image_path}: {error}")
 
-    thumbnail_filenames = []
-    for filename in os.listdir(folder_path):
-        if any(filename.endswith(ext) for ext in SUPPORTED_IMAGE_FILE_EXTENSIONS):
-            image_path = os.path.join(folder_path, filename)
-            output_path = os.path.join(output_folder, filename)
+    return result.created
 
-            try:
-                with Image.open(image_path) as image:
-                    image.thumbnail(thumbnail_size)
-                    image.save(output_path)
-                    thumbnail_filenames.append(output_path)
-            except Exception as e:
-                logger.error(f"Error processing {filename}: {str(e)}")
 
-    return thumbnail_filenames
+@st.cache_data
+def _get_page_counts(thumbnails_folders: tuple, mtimes: tuple, page_size: int) -> list:
+    # the modification times of the folders are part of the cache key so that added thumbnails are counted
+    return [get_page_count(thumbnails_folder, page_size) for thumbnails_folder in thumbnails_folders]
+
+
+def get_page_counts(thumbnails_folders: list, page_size: int) -> list:
+    """
+    :param thumbnails_folders: thumbnail folders
+    :param page_size: number of thumbnails per page
+    :return: number of atlas pages of each folder; the folders are scanned again only when they change
+    """
+    mtimes = tuple(os.stat(thumbnails_folder).st_mtime_ns if os.path.isdir(thumbnails_folder) else None
+                   for thumbnails_folder in thumbnails_folders)
+    return _get_page_counts(tuple(thumbnails_folders), mtimes, page_size)
 
 
 def get_data_files(project_id, is_thumbnails=False):
@@ -154,17 +167,9 @@ def get_data_files(project_id, is_thumbnails=False):
         data_folder = os.path.join(project_folder, str(task.id), "data")
 
         if is_thumbnails:
-            thumbnails_folder = os.path.join(project_folder, str(task.id), "thumbnails")
-            logger.info(f"thumbnails folder{thumbnails_folder}")
-            if not os.path.exists(thumbnails_folder):
-                generate_thumbnails(data_folder, output_folder=thumbnails_folder)
-            else:
-                logger.info(f"thumbnails folder{thumbnails_folder}")
-                entries = os.scandir(thumbnails_folder)
-                if not any(entries):
-                    logger.info(f"thumbnails folder{thumbnails_folder}")
-                    generate_thumbnails(data_folder, output_folder=thumbnails_folder)
-
+            thumbnails_folder = thumbnails.get_thumbnails_folder(data_folder)
+            # the thumbnails are generated when the data is added; only missing or outdated ones are generated here
+            generate_thumbnails(data_folder, output_folder=thumbnails_folder)
             data_folder = thumbnails_folder
 
         data_filenames.extend(utils.glob_files(data_folder,
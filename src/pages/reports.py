@@ -1,8 +1,5 @@
-from collections import namedtuple
-
 import altair as alt
 import pandas as pd
-import shapely
 import streamlit as st
 
 import plotly.express as px
@@ -11,61 +8,78 @@ from PIL import Image
 import plotly.graph_objects as go
 import os.path
 import numpy as np
-import base64
-import dash
-from dash import Dash
-from dash import dcc
-from dash import html
-from src.common import constants, utils
-from collections import OrderedDict
-
-
-import io
-from PIL import Image
-import plotly.graph_objects as go
-import os.path
-import numpy as np
-import base64
-import dash
-from dash import Dash
-from dash import dcc
-from dash import html
-from src.common import constants, utils
+from src.common import constants, export, utils
 from collections import OrderedDict
 
 
 
 from src.common.charts import (
+    DEFAULT_BINS,
     display_chart,
     plot_aspect_ratios_brightness,
     plot_chart,
     plot_file_info,
-    show_download_charts_button
+    plot_file_summary,
+    plot_image_summary,
+    plot_label_dimensions,
+    show_download_charts_button,
+    show_file_tables
 )
 from src.common.logger import get_logger
-from src.models.data_labels import DataLabels
+from src.models.image_stats import get_image_stats
+from src.models.projects_info import Project
+from src.models.report_engine import (
+    ReportPartial,
+    compute_report,
+    get_anno_file_names,
+    write_image_table
+)
+from src.models.report_snapshot import ReportSnapshot, create_snapshot
+from src.models.report_trends import (
+    CLASS_DRIFT,
+    ERROR_RATE_PREFIX,
+    OBJECTS_PER_IMAGE,
+    summarize_trends,
+    update_trends
+)
 from .home import (
     is_authenticated,
     get_data_files,
     get_label_files,
+    get_tasks_info,
     login,
     logout,
     select_project)
-from src.pages.reviews import load_thumbnail
+from src.pages.reviews import load_preview
 
 logger = get_logger(__name__)
 
-Rectangle = namedtuple('Rectangle', 'xmin ymin xmax ymax')
+# the drill-down lists at most this many images
+MAX_DRILL_DOWN_ROWS = 1000
+# the sampled objects of a class show at most this many images
+MAX_SAMPLED_IMAGES = 20
+TREND_PERIODS = {"Week": "W", "Month": "M", "Day": "D"}
+# the trend charts are saved under this key instead of a project id for the downloads
+TRENDS_KEY = "trends"
+# label metrics kept in memory; a changed label file makes a new entry
+MAX_CACHED_REPORTS = 4
 
 
 def show_file_metrics():
     selected_project = select_project()
     if selected_project:
-
-        data_files = get_data_files(selected_project.id, is_thumbnails=True)
-        #chart_aspect_ratios, chart_brightness = plot_aspect_ratios_brightness("### Aspect ratios",
-                                                                              #data_files)
-        chart_files_ctime, chart_file_sizes, table_files_ctime = plot_file_info("Data files info", data_files)
+        snapshot = show_data_snapshot_status(selected_project)
+        if snapshot:
+            # the files are listed only on demand; the charts come from the snapshot
+            if st.checkbox("Show the data files"):
+                show_file_tables("Data files info", get_data_files(selected_project.id))
+            chart_files_ctime, chart_file_sizes, table_files_ctime = plot_file_summary(snapshot.file_metrics)
+        else:
+            data_files = get_data_files(selected_project.id)
+            #chart_aspect_ratios, chart_brightness = plot_aspect_ratios_brightness("### Aspect ratios",
+                                                                                  #data_files)
+            show_file_tables("Data files info", data_files)
+            chart_files_ctime, chart_file_sizes, table_files_ctime = plot_file_info("Data files info", data_files)
 
         col1, col2 = st.columns(2)
         if chart_files_ctime:
@@ -93,206 +107,210 @@ def show_file_metrics():
 def show_image_metrics():
     selected_project = select_project()
     if selected_project:
-        data_files = get_data_files(selected_project.id, is_thumbnails=True)
-        chart_aspect_ratios, chart_brightness, table_aspect_ratios, table_brightness  = plot_aspect_ratios_brightness("### Aspect ratios",
-                                                                              data_files)
+        snapshot = show_data_snapshot_status(selected_project)
+        if snapshot:
+            # the snapshot keeps the bins of the histograms, so the number of bins cannot be changed
+            chart_aspect_ratios, chart_brightness, table_aspect_ratios, table_brightness = plot_image_summary(
+                snapshot.image_metrics)
+        else:
+            # the statistics are calculated from the image headers and a reduced decode, so no thumbnails are needed
+            data_files = get_data_files(selected_project.id)
+            bins = st.sidebar.number_input("Bins", min_value=5, max_value=500, value=DEFAULT_BINS, step=5)
+            chart_aspect_ratios, chart_brightness, table_aspect_ratios, table_brightness  = plot_aspect_ratios_brightness("### Aspect ratios",
+                                                                                  data_files,
+                                                                                  aspect_ratio_bins=bins,
+                                                                                  brightness_bins=bins)
         col1, col2 = st.columns(2)
         if chart_aspect_ratios:
             display_chart(selected_project.id, "aspect_ratios", chart_aspect_ratios, table_aspect_ratios, column=col1)
         if chart_brightness:
             display_chart(selected_project.id, "brightness", chart_brightness, table_brightness, column=col2)
 
+        # the per-image statistics are loaded only on demand
+        if st.checkbox("Images by aspect ratio / brightness"):
+            show_image_stats_drill_down(get_data_files(selected_project.id) if snapshot else data_files)
+
         show_download_charts_button(selected_project.id)
     else:
         st.write("No image data")
 
 
-def get_label_metrics(label_files_dict: dict) -> (dict, dict, dict, dict):
-    label_objects_dict = DataLabels.load_from_dict(label_files_dict)
-
-    class_labels = dict()
-    overlap_areas = dict()
-    dimensions = dict()
-    errors = dict()
-    error_columns = set()
-    class_columns = set()
-
-    image_table_data = {
-        'filename': [],
-        'total_classes': [],
-        'class_names': []
-    }
-
-    for label_file, data_labels in label_objects_dict.items():
-
-        for image in data_labels.images:
-            count = len(image.objects)
-            class_names = set()
-            error_counts = dict()
-            class_counts = dict()  # Track class counts per image
-
-            for ob_id1 in range(count):
-                object_cur = image.objects[ob_id1]
-                label = object_cur.label
-                class_names.add(label)
-                class_counts[label] = class_counts.get(label, 0) + 1
-                if class_labels.get(label):
-                    class_labels[label] += 1
-                else:
-                    class_labels[label] = 1
-                class_columns.add(label)
-
-                if object_cur.verification_result:
-                    error_code = object_cur.verification_result['error_code']
-                    if errors.get(error_code):
-                        errors[error_code] += 1
-                    else:
-                        errors[error_code] = 1
-
-                    if error_counts.get(error_code):
-                        error_counts[error_code] += 1
-                    else:
-                        error_counts[error_code] = 1
-
-                    error_columns.add(error_code)
-                #else:
-                    #errors = dict()
-                    #error_counts = dict()
-                    #error_columns = set()
-                
-        
-                if not object_cur.points:
-                    logger.warn("empty points in {}".format(object_cur.label))
-                    continue
-
-                xtl1, ytl1, xbr1, ybr1 = DataLabels.Object.get_bounding_rectangle(object_cur)
-                rect1 = Rectangle(xtl1, ytl1, xbr1, ybr1)
-                width1 = rect1.xmax - rect1.xmin
-                height1 = rect1.ymax - rect1.ymin
-
-                if dimensions.get(image.name):
-                    dimensions[image.name].append((width1, height1, image.objects[ob_id1].label))
-                else:
-                    dimensions[image.name] = [(width1, height1, image.objects[ob_id1].label)]
-
-                for ob_id2 in range(ob_id1 + 1, count):
-                    if not image.objects[ob_id2].points:
-                        continue
-
-                    xtl2, ytl2, xbr2, ybr2 = DataLabels.Object.get_bounding_rectangle(image.objects[ob_id2])
-                    rect2 = Rectangle(xtl2, ytl2, xbr2, ybr2)
-
-                    overlap_area, max_area = calculate_overlapping_rect(rect1, rect2)
-
-                    if overlap_area > 0:
-                        overlap_percent = format(overlap_area / max_area, '.2f')
-                        overlap_percent = float(overlap_percent) * 100
-                        if overlap_areas.get(overlap_percent):
-                            overlap_areas[overlap_percent] += 1
-                        else:
-                            overlap_areas[overlap_percent] = 1
-
-            image_table_data['filename'].append(image.name)
-            image_table_data['total_classes'].append(len(class_names))
-            image_table_data['class_names'].append(", ".join(class_names))
-
-            # Add class columns dynamically
-            for label in class_columns:
-                if label not in image_table_data:
-                    image_table_data[label] = [class_counts.get(label, 0)]
-                else:
-                    image_table_data[label].append(class_counts.get(label, 0))
-            # Add error columns dynamically
-            for error_code in error_columns:
-                if error_code not in image_table_data:
-                    image_table_data[error_code] = [error_counts.get(error_code, 0)]
-                else:
-                    image_table_data[error_code].append(error_counts.get(error_code, 0))
-
-            
-    required_keys = ['Mis-tagged', 'Untagged', 'Over-tagged', 'Range_error', 'Attributes_error']
-
-    for key in required_keys:
-        if key not in errors:
-            errors[key] = ['0']
-    # Make sure all arrays have the same length
-    max_length = max(len(value) for value in image_table_data.values())
-
-    for key, value in image_table_data.items():
-        if len(value) < max_length:
-            image_table_data[key].extend([0] * (max_length - len(value)))
-    # Add missing error columns with 0 count
-    error_names = ['Mis-tagged', 'Untagged', 'Over-tagged', 'Range_error', 'Attributes_error']
-
-    for error_code in error_names:
-        if error_code not in image_table_data:
-            image_table_data[error_code] = [0] * len(image_table_data['filename'])
-
-    image_table = pd.DataFrame(image_table_data)
-    # Check if all values in each row are 0 and delete the row
-    image_table = image_table.loc[~(image_table == 0).all(axis=1)]
-    return class_labels, overlap_areas, dimensions, errors, image_table
-
-
-
-
-
-    #return class_labels, overlap_areas, dimensions, errors, image_table
-
-
-def triangle_area(vertices):
-    # Calculates the area of a triangle given its vertices using the cross product formula
-    x1, y1 = vertices[0]
-    x2, y2 = vertices[1]
-    x3, y3 = vertices[2]
-    return abs((x2-x1)*(y3-y1) - (x3-x1)*(y2-y1)) / 2
-
-
-def polygon_area(vertices):
-    # Calculates the area of a polygon given its vertices using the shoelace formula
-    x = [vertex[0] for vertex in vertices]
-    y = [vertex[1] for vertex in vertices]
-    return 0.5 * abs(sum(x[i]*y[i+1] - x[i+1]*y[i] for i in range(-1,len(x)-1)))
-
-
-def overlapping_area(poly1, poly2):
-    # Calculates the overlapping area of two polygons
-    intersect = poly1.intersection(poly2)
-    if intersect.is_empty:
-        return 0
-    triangles = []
-    for poly in [poly1, poly2]:
-        points = list(poly.exterior.coords)
-        for i in range(poly.interiors.__len__()):
-            points += list(poly.interiors[i].coords)
-        for j in range(-1, len(points)-2):
-            triangles.append((points[0], points[j+1], points[j+2]))
-    contained_triangles = []
-    for triangle in triangles:
-        in_poly1 = poly1.contains(shapely.geometry.Point(triangle[0])) and poly1.contains(shapely.geometry.Point(triangle[1])) and poly1.contains(shapely.geometry.Point(triangle[2]))
-        in_poly2 = poly2.contains(shapely.geometry.Point(triangle[0])) and poly2.contains(shapely.geometry.Point(triangle[1])) and poly2.contains(shapely.geometry.Point(triangle[2]))
-        if in_poly1 and not in_poly2:
-            contained_triangles.append(triangle)
-        elif in_poly2 and not in_poly1:
-            contained_triangles.append(triangle)
-    overlapping_area = sum(triangle_area(triangle) for triangle in triangles) - sum(triangle_area(triangle) for triangle in contained_triangles)
-    return overlapping_area
-
-
-def calculate_overlapping_rect(a, b):
-    overlapping_area = 0.0
-    max_area = 0.0
-
-    dx = min(a.xmax, b.xmax) - max(a.xmin, b.xmin)
-    dy = min(a.ymax, b.ymax) - max(a.ymin, b.ymin)
-    if (dx >= 0) and (dy >= 0):
-        area1 = (a.xmax - a.xmin) * (a.ymax - a.ymin)
-        area2 = (b.xmax - b.xmin) * (b.ymax - b.ymin)
-
-        max_area = max(area1, area2)
-        overlapping_area = dx*dy
-
-    return overlapping_area, max_area
+def show_image_stats_drill_down(data_files: dict):
+    """
+    lists the images in a range of aspect ratios or brightness from the cached per-image statistics
+    :param data_files: folder -> image filenames
+    """
+    df_stats = _get_image_stats(data_files, get_folder_mtimes(data_files))
+    if df_stats.empty:
+        st.write("No image data")
+        return
+
+    column = st.radio("Statistic", options=["aspect_ratio", "brightness"], horizontal=True)
+    min_value, max_value = float(df_stats[column].min()), float(df_stats[column].max())
+    if min_value == max_value:
+        st.write(f"All images have the {column} {min_value:.3f}")
+        return
+
+    value_range = st.slider("Range", min_value=min_value, max_value=max_value, value=(min_value, max_value))
+    df_selected = df_stats[df_stats[column].between(*value_range)]
+    st.write(f"{len(df_selected)} images")
+    st.dataframe(df_selected[['folder', 'filename', 'width', 'height', 'aspect_ratio', 'brightness']]
+                 .head(MAX_DRILL_DOWN_ROWS))
+
+
+def get_folder_mtimes(files_dict: dict) -> tuple:
+    """
+    :param files_dict: folder -> filenames (relative to the folder or full paths)
+    :return: modification times of the folders of the files; they change when a file is added, removed or renamed
+    """
+    folders = sorted({os.path.dirname(os.path.join(folder, file))
+                      for folder, files in files_dict.items() for file in files})
+    return tuple((folder, os.stat(folder).st_mtime_ns if os.path.isdir(folder) else None) for folder in folders)
+
+
+@st.cache_data
+def _get_image_stats(data_files: dict, mtimes: tuple) -> pd.DataFrame:
+    # the modification times of the folders are part of the cache key so that added images are included
+    return get_image_stats(data_files)
+
+
+def show_sampled_objects(df_samples: pd.DataFrame, num_columns: int = 5):
+    """
+    shows the images of the objects sampled for the Label Dimensions chart; only those images are loaded
+    :param df_samples: sampled objects with columns filename, width, height, class, data_folder
+    :param num_columns: number of image columns
+    """
+    if df_samples is None or df_samples.empty:
+        return
+
+    with st.expander("Sampled objects"):
+        selected_class = st.selectbox("Class", options=sorted(df_samples['class'].unique()),
+                                      key="dimensions_sample_class")
+        df_class = df_samples[df_samples['class'] == selected_class].head(MAX_SAMPLED_IMAGES)
+
+        columns = st.columns(num_columns)
+        for i, sample in enumerate(df_class.itertuples(index=False)):
+            # the data folder of the task tells apart the images of the same name in different tasks
+            data_path = os.path.join(sample.data_folder, sample.filename) if sample.data_folder else None
+            if not data_path or not os.path.exists(data_path):
+                continue
+            with columns[i % num_columns]:
+                st.image(load_preview(data_path),
+                         caption=f"{sample.filename} ({sample.width:.0f}x{sample.height:.0f})")
+
+
+# the report is shared by the reruns and sessions without being pickled; it must not be modified
+@st.cache_resource(max_entries=MAX_CACHED_REPORTS)
+def _compute_report(anno_file_names: tuple, mtimes: tuple) -> ReportPartial:
+    # the modification times are part of the cache key so that changed label files are recomputed
+    return compute_report(list(anno_file_names))
+
+
+def get_label_files_mtimes(label_files_dict: dict) -> (tuple, tuple):
+    """
+    :param label_files_dict: label files with key=folder value=label filenames
+    :return: full label filenames and their modification times
+    """
+    anno_file_names = tuple(get_anno_file_names(label_files_dict))
+    mtimes = tuple(os.path.getmtime(anno_file_name) if os.path.exists(anno_file_name) else None
+                   for anno_file_name in anno_file_names)
+    return anno_file_names, mtimes
+
+
+@st.cache_resource(max_entries=MAX_CACHED_REPORTS)
+def _load_snapshot_report(report_file_name: str, sequence: int) -> ReportPartial:
+    # the sequence is part of the cache key so that a new snapshot is loaded again
+    return ReportSnapshot(project_id=0, sequence=sequence, report_file_name=report_file_name).load_report()
+
+
+def get_project_data_folders(project_id: int) -> list:
+    project_folder = os.path.join(constants.ADQ_WORKING_FOLDER, str(project_id))
+    return [os.path.join(project_folder, str(task.id), "data")
+            for task in get_tasks_info().get_tasks_by_project_id(project_id)]
+
+
+def get_label_report(label_files_dict: dict, snapshot: ReportSnapshot = None) -> ReportPartial:
+    """
+    :param label_files_dict: label files of the project
+    :param snapshot: report snapshot of the project; its label metrics are used if it is not stale
+    :return: label metrics of the project
+    """
+    report = None
+    if snapshot and not snapshot.is_stale(get_anno_file_names(label_files_dict)):
+        report = _load_snapshot_report(snapshot.report_file_name, snapshot.sequence)
+    if report is None:
+        report = _compute_report(*get_label_files_mtimes(label_files_dict))
+
+    return report
+
+
+def show_snapshot_status(project_id: int, label_files: dict) -> ReportSnapshot:
+    """
+    shows whether the precomputed report snapshot is up to date and lets the user refresh it
+    :param project_id: project id
+    :param label_files: label files of the project
+    :return: the latest snapshot or None
+    """
+    anno_file_names = get_anno_file_names(label_files)
+    if st.sidebar.button("Refresh report snapshot"):
+        with st.spinner("Computing the report snapshot..."):
+            create_snapshot(project_id, anno_file_names, get_project_data_folders(project_id))
+
+    snapshot = ReportSnapshot.load_latest(project_id)
+    if not snapshot:
+        st.sidebar.info("No report snapshot; the label metrics are computed now.")
+    elif snapshot.is_stale(anno_file_names):
+        st.sidebar.warning(f"The report snapshot of {snapshot.created_at} is stale; "
+                           f"the label metrics are computed now.")
+    else:
+        st.sidebar.success(f"Report snapshot of {snapshot.created_at}")
+
+    return snapshot
+
+
+def show_data_snapshot_status(selected_project: Project) -> ReportSnapshot:
+    """
+    shows whether the file and image metrics of the report snapshot are up to date and lets the user refresh it
+    :param selected_project: project
+    :return: the latest snapshot if its file and image metrics are up to date; otherwise None
+    """
+    data_folders = get_project_data_folders(selected_project.id)
+    if st.sidebar.button("Refresh report snapshot"):
+        with st.spinner("Computing the report snapshot..."):
+            create_snapshot(selected_project.id, get_anno_file_names(get_label_files(selected_project)),
+                            data_folders)
+
+    snapshot = ReportSnapshot.load_latest(selected_project.id)
+    if not snapshot:
+        st.sidebar.info("No report snapshot; the metrics are computed now.")
+        return None
+
+    if snapshot.is_data_stale(data_folders):
+        st.sidebar.warning(f"The report snapshot of {snapshot.created_at} is stale; the metrics are computed now.")
+        return None
+
+    st.sidebar.success(f"Report snapshot of {snapshot.created_at}")
+    return snapshot
+
+
+def show_polygon_overlaps(project_id: int, report: ReportPartial):
+    """
+    shows the true overlaps of the polygon and segmentation objects
+    :param project_id: project id
+    :param report: label metrics of the project
+    """
+    chart_polygon_overlaps, table_polygon_overlaps = plot_chart("Polygon Overlap Areas",
+                                                                x_label="overlap %", y_label="count",
+                                                                data_dict=report.polygon_overlap_counts) or (None, None)
+    if not chart_polygon_overlaps:
+        return
+
+    display_chart(project_id, "polygon_overlap_areas", chart_polygon_overlaps, table_polygon_overlaps)
+    if report.polygon_sampled_images:
+        with st.expander(f"{len(report.polygon_sampled_images)} images with sampled polygon overlaps"):
+            st.write("Too many overlapping polygons to calculate all the pairs; a random sample of the polygons "
+                     "was used for these images.")
+            st.dataframe(pd.DataFrame({'filename': report.polygon_sampled_images}).head(MAX_DRILL_DOWN_ROWS))
 
 
 def show_label_metrics():
@@ -304,7 +322,11 @@ def show_label_metrics():
             st.warning("No label files")
             return
 
-        class_labels, overlap_areas, dimensions, errors, image_table = get_label_metrics(label_files)
+        snapshot = show_snapshot_status(selected_project.id, label_files)
+        report = get_label_report(label_files, snapshot)
+        class_labels, overlap_areas, dimensions, errors, image_table = (
+            report.class_counts, report.overlap_counts, report.get_dimensions(),
+            report.get_error_counts(), report.get_image_table())
         
         if errors:
             chart_errors, table_errors = plot_chart("Error Count", "error", "count", errors)
@@ -339,6 +361,8 @@ def show_label_metrics():
                 if collapse_table:
                     st.table_overlap_areas([])  # Empty table to collapse the view
 
+        show_polygon_overlaps(selected_project.id, report)
+
         # if dimensions:
         #     df_dimensions = pd.DataFrame([(k, *t) for k, v in dimensions.items() for t in v],
         #                                  columns=['filename', 'width', 'height', 'class'])
@@ -365,233 +389,106 @@ def show_label_metrics():
         #     if chart_dimensions:
         #         display_chart(selected_project.id, "dimensions", chart_dimensions)
 
-        #Using Plotly
-
-        if dimensions:
-            # df_dimensions = pd.DataFrame([(k, *t) for k, v in dimensions.items() for t in v],
-            #                              columns=['filename', 'width', 'height', 'class'])
-            #
-            # chart_dimensions = px.scatter(df_dimensions, x='width', y='height', color='class',
-            #                             hover_data=['class', 'width', 'height', 'filename'],
-            #                             title="Label Dimensions")
-            #
-            # chart_dimensions.update_layout(width=600, height=400)
-
-            df_dimensions = pd.DataFrame([(k, *t) for k, v in dimensions.items() for t in v],
-                                         columns=['filename', 'width', 'height', 'class'])
-
-            table_dimensions = df_dimensions
-
-            # Generate thumbnails
-            thumbnail_filenames = get_data_files(selected_project.id, is_thumbnails=True)
-
-            thumbnails = []
-
-            for file in thumbnail_filenames["."]:
-                thumbnail_image = load_thumbnail(file)
-                thumbnails.append(thumbnail_image)
-
-            # Add thumbnails to the DataFrame
-            df_dimensions['thumbnail'] = thumbnail_filenames
-
-            # Create a list of image source paths
-            image_sources = [thumbnail_filenames.get(file, '') for file in df_dimensions['filename']]
-
-            # Filter out entries with missing image paths or empty values
-            valid_indices = [i for i, source in enumerate(image_sources) if source]
-
-            # Filter the data frame and image sources
-            df_dimensions_filtered = df_dimensions.iloc[valid_indices]
-            image_sources_filtered = [image_sources[i] for i in valid_indices]
-
-            #Dash Version
-            # Create a Dash app
-            app = dash.Dash(__name__)
-
-            # Define the custom hover template
-            hover_template = (
-                "<b>Class:</b> %{customdata[0]}<br>"
-                "<b>Width:</b> %{customdata[1]}<br>"
-                "<b>Height:</b> %{customdata[2]}<br>"
-                '<img src="data:image/png;base64, %{customdata[3]}" alt="Thumbnail" width="100">'
-            )
-
-            # Encode the thumbnails as base64 strings
-            encoded_thumbnails = []
-            for filename in df_dimensions['filename']:
-                thumbnail_path = thumbnail_filenames.get(filename, '')
-                if thumbnail_path:
-                    with open(thumbnail_path, 'rb') as f:
-                        encoded_thumbnail = base64.b64encode(f.read()).decode('utf-8')
-                        encoded_thumbnails.append(encoded_thumbnail)
-                else:
-                    encoded_thumbnails.append('')
-
-            # Create a copy of the customdata array with an additional column for the encoded thumbnails
-            customdata_with_thumbnails = df_dimensions[['class', 'width', 'height']].copy()
-            customdata_with_thumbnails['thumbnail'] = encoded_thumbnails
-
-            # Assign a numeric value to each unique class label
-            class_labels = customdata_with_thumbnails['class'].unique()
-            class_mapping = {label: i for i, label in enumerate(class_labels)}
-            class_numeric = customdata_with_thumbnails['class'].map(class_mapping)
-
-            # Create the scatter plot with custom hover template
-            # chart_dimensions = go.Figure(
-            #     data=go.Scatter(
-            #         x=customdata_with_thumbnails['width'],
-            #         y=customdata_with_thumbnails['height'],
-            #         mode='markers',
-            #         marker=dict(color='class'),
-            #         hovertemplate=hover_template,
-            #         customdata=customdata_with_thumbnails.values.T,
-            #     ),
-            #
-            #     layout=go.Layout(
-            #         title="Label Dimensions",
-            #         width=600,
-            #         height=400
-            #     )
-            #)
-
-            #this gets you the chart in the normal format as a standin
-            chart_dimensions = px.scatter(df_dimensions, x='width', y='height', color='class',
-                                          hover_data=['class', 'width', 'height', 'filename'],
-                                          title="Label Dimensions")
-            chart_dimensions.update_layout(width=600, height=400)
-
-
-            #chart_dimensions.update_traces(hoverinfo="none", hovertemplate=None)
-
-            # Convert the chart to a Dash Graph component
-            graph_dimensions = dcc.Graph(figure=chart_dimensions)
-
-            # Create the app layout
-            app.layout = html.Div(children=[
-                graph_dimensions
-            ])
-
-            #dash_app_html = app.to_html()
-            app.debug = True
-
-            # Render the Dash app as an iframe in Streamlit
-            #st.markdown(dash_app_html, unsafe_allow_html=True)
-            #st.title('Dash Plot')
-
-            #st.components.v1.html(app.index())
-
-            #end Dash version
-
-
-            #Plotly version
-            # Define the custom hover template
-            # hover_template = (
-            #     "<b>Class:</b> %{customdata[0]}<br>"
-            #     "<b>Width:</b> %{customdata[1]}<br>"
-            #     "<b>Height:</b> %{customdata[2]}<br>"
-            #     "<b>Height:</b> %{customdata[3]}<br>"
-            #     #'<img src="data:image/png;base64, %{customdata[3]}" alt="Thumbnail" width="100">'
-            # )
-            #
-            # # Encode the thumbnails as base64 strings
-            # encoded_thumbnails = []
-            # logger.info(f"*******thumbnail info {thumbnail_filenames}")
-            #
-            # for filename in thumbnail_filenames:
-            #     with open(filename, 'rb') as f:
-            #         encoded_thumbnail = base64.b64encode(f.read()).decode('utf-8')
-            #         encoded_thumbnails.append(encoded_thumbnail)
-            #
-            # logger.info(f"*******thumbnail info{thumbnail_path} {thumbnail_filenames}")
-            #
-            # # Assign a numeric value to each unique class label
-            # class_labels = df_dimensions['class'].unique()
-            # class_mapping = {label: i for i, label in enumerate(class_labels)}
-            # class_numeric = df_dimensions['class'].map(class_mapping)
-            #
-            # # Create the scatter plot with custom hover template
-            # chart_dimensions = go.Figure(
-            #     data=go.Scatter(
-            #         x=df_dimensions['width'],
-            #         y=df_dimensions['height'],
-            #         mode='markers',
-            #         marker=dict(color=class_numeric),
-            #         hoverinfo="none",  # Disable default hover labels
-            #         customdata=encoded_thumbnails,  # Use encoded thumbnails as custom data
-            #     ),
-            #     layout=go.Layout(
-            #         title="Label Dimensions",
-            #         width=600,
-            #         height=400
-            #     )
-            # )
-            #
-            #
-            #
-            # # Update the customdata with encoded thumbnails
-            # #for i, encoded_thumbnail in enumerate(encoded_thumbnails):
-            # #    chart_dimensions.data[0].customdata[i] += (encoded_thumbnail,)
-            #
-            # # Add the image_sources_array as a trace-level customdata
-            # #chart_dimensions.data[0].update(
-            # #    customdata=np.column_stack((chart_dimensions.data[0].customdata, image_sources_array)))
-
-            #app.run_server(debug=True)
+        if not dimensions.empty:
+            # above the density threshold, the chart is a density map with a few sampled points per class
+            chart_dimensions, table_dimensions, df_samples = plot_label_dimensions(dimensions)
             if chart_dimensions:
                 display_chart(selected_project.id, "dimensions", chart_dimensions, table_dimensions)
+                show_sampled_objects(df_samples)
             
 
         image_table = image_table[ list(image_table.columns)]
         show_download_charts_button(selected_project.id)
-        dir_name = selected_project.name
 
         # Create download dropdown button for Excel or CSV file
         download_label = "Download the Combined Error Data Statistics"
         download_options = ["CSV", "Excel"]
         download_format = st.selectbox(download_label, download_options)
-        if " " in dir_name:
-            dir_name = dir_name.replace(" ", "_")
-        project_folder = os.path.join(os.getcwd(),str(dir_name))
-        # Check if the project folder exists
-        if not os.path.exists(project_folder):
-            # Create the project folder if it doesn't exist
-            os.makedirs(project_folder)
 
+        # the table is exported into memory and only again when a label file changed
+        fingerprint = export.get_fingerprint(get_label_files_mtimes(label_files))
         if download_format == "CSV":
             csv_filename = f"{selected_project.name}_data.csv"
-            csv_full_path = os.path.join(project_folder, csv_filename)
-
-            if os.path.exists(csv_full_path):
-                os.remove(csv_full_path)  # Remove the existing file
-
-            with open(csv_full_path, "w", newline="") as f:
-                image_table.to_csv(f, index=False)
-
-            with open(csv_full_path, "rb") as f:
-                file_bytes = f.read()
-                st.download_button(
-                    label="Download CSV",
-                    data=file_bytes,
-                    file_name=csv_filename,
-                    mime="text/csv"
-                )
+            file_bytes = export.get_artifact(csv_filename, fingerprint,
+                                             lambda output: write_image_table(image_table, output, "CSV"))
+            st.download_button(
+                label="Download CSV",
+                data=file_bytes,
+                file_name=csv_filename,
+                mime=export.CSV_MIME
+            )
         elif download_format == "Excel":
             excel_filename = f"{selected_project.name}_data.xlsx"
-            excel_full_path = os.path.join(project_folder, excel_filename)
-            #excel_full_path = os.path.join(os.getcwd(), excel_filename)
-
-            # Create a new Excel writer object
-            with pd.ExcelWriter(excel_full_path, engine="openpyxl") as writer:
-                image_table.to_excel(writer, index=False, header=True)
-
-            with open(excel_full_path, "rb") as f:
-                file_bytes = f.read()
-                st.download_button(
-                    label="Download Excel",
-                    data=file_bytes,
-                    file_name=excel_filename,
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+            file_bytes = export.get_artifact(excel_filename, fingerprint,
+                                             lambda output: write_image_table(image_table, output, "Excel"))
+            st.download_button(
+                label="Download Excel",
+                data=file_bytes,
+                file_name=excel_filename,
+                mime=export.EXCEL_MIME
+            )
+
+
+def plot_trend(title: str, df_trend: pd.DataFrame, y_label: str):
+    """
+    :param title: chart title
+    :param df_trend: values indexed by (key, period) with one column per line
+    :param y_label: label of the values
+    :return: line chart and its table
+    """
+    table = df_trend.reset_index().melt(id_vars=['key', 'period'], var_name='series', value_name=y_label)
+    table = table.dropna(subset=[y_label])
+    if df_trend.shape[1] == 1:
+        table['series'] = table['key'].astype(str)
+    elif table['key'].nunique() > 1:
+        table['series'] = table['key'].astype(str) + " " + table['series']
+
+    chart = px.line(table, x='period', y=y_label, color='series', markers=True, title=title)
+    return chart, table
+
+
+def show_trends():
+    """
+    shows the quality trends over time from the stored report snapshots of the projects
+    """
+    st.title("Quality trends")
+    # only the snapshots that are not in the trends table yet are read
+    df_trends = update_trends()
+    if df_trends.empty:
+        st.warning("No report snapshots")
+        return
+
+    period = TREND_PERIODS[st.sidebar.selectbox("Period", options=list(TREND_PERIODS.keys()))]
+    project_ids = sorted(df_trends['project_id'].unique().tolist())
+    selected_project_ids = st.sidebar.multiselect("Projects (all if none)", options=project_ids)
+    by_project = st.sidebar.checkbox("By project", value=False)
+    df_metrics, df_shares = summarize_trends(df_trends, period=period,
+                                             project_ids=selected_project_ids or None,
+                                             by_project=by_project)
+    if df_metrics.empty:
+        st.write("No trends")
+        return
+
+    error_columns = [column for column in df_metrics.columns if column.startswith(ERROR_RATE_PREFIX)]
+    selected_errors = st.sidebar.multiselect("Error codes", options=error_columns,
+                                             format_func=lambda column: column[len(ERROR_RATE_PREFIX):])
+    df_errors = df_metrics[selected_errors or error_columns]
+    df_errors.columns = [column[len(ERROR_RATE_PREFIX):] for column in df_errors.columns]
+
+    trends = {
+        "error_rates": plot_trend("Error rate", df_errors, "error rate"),
+        "objects_per_image": plot_trend("Objects per image", df_metrics[[OBJECTS_PER_IMAGE]], "objects per image"),
+        "class_drift": plot_trend("Class distribution drift", df_metrics[[CLASS_DRIFT]], "drift")
+    }
+    if not by_project:
+        trends["class_shares"] = plot_trend("Class shares", df_shares, "share")
+
+    for name, (chart, table) in trends.items():
+        display_chart(TRENDS_KEY, name, chart, table)
+
+    show_download_charts_button(TRENDS_KEY)
+
+
 def main():
     # Clear the sidebar
     st.sidebar.empty()
@@ -602,6 +499,7 @@ def main():
         "Show file metrics": lambda: show_file_metrics(),
         "Show image metrics": lambda: show_image_metrics(),
         "Show label metrics": lambda: show_label_metrics(),
+        "Show trends": lambda: show_trends(),
     }
 
     # Create a sidebar with menu options
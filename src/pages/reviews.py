@@ -1,27 +1,40 @@
 import os.path
 
-import cv2
 import numpy as np
 import streamlit as st
 from PIL import Image
 
 import src.viewer.app as app
-from src.common.constants import SUPPORTED_IMAGE_FILE_EXTENSIONS
+from src.common.constants import ADQ_WORKING_FOLDER
 from src.common.logger import get_logger
 from src.common.utils import get_window_size
-from src.common.utils import (
-    glob_files,
-    load_images
+from src.models.thumbnail_atlas import ATLAS_PAGE_SIZE, get_atlas_page, get_data_path
+from src.models.thumbnails import get_thumbnails_folder
+from src.models.feature_store import FeatureStore
+from src.models.features import get_clusters_filename
+from src.models.image_hashes import HASH_BYTES, calculate_all_file_hashes, find_duplicate_groups
+from src.models.label_crops import CROP_INDEX_COLUMNS, extract_task_crops, get_crops_filename
+from src.models.label_outliers import build_outlier_queue
+from src.models.label_rules import (
+    DEGENERATE,
+    DUPLICATE_BOX,
+    DUPLICATE_POLYGON,
+    OUT_OF_BOUNDS,
+    TINY,
+    check_all_labels,
+    write_suggestions
 )
-from src.models.data_labels import DataLabels
+from src.models.report_engine import get_anno_file_names
 from src.models.metrics import (
-    cluster_images,
-    reduce_features,
+    get_cluster_assignments,
     plot_image_clusters
 )
 from .home import (
+    generate_thumbnails,
     get_data_files,
     get_label_files,
+    get_page_counts,
+    get_tasks_info,
     is_authenticated,
     login,
     logout,
@@ -30,29 +43,71 @@ from .home import (
 
 logger = get_logger(__name__)
 
+PREVIEW_SIZE = (128, 128)
 
-@st.cache_resource
-def load_thumbnail(file_path):
+
+def load_preview(file_path, size=PREVIEW_SIZE):
+    """
+    loads a small version of an image; JPEG images are decoded at a reduced scale
+    :param file_path: image filename
+    :param size: maximum (width, height) of the preview
+    :return: PIL image
+    """
     with Image.open(file_path) as image:
+        image.thumbnail(size)
         return image.copy()
 
 
-def show_images(project_id):
-    thumbnail_filenames = get_data_files(project_id, is_thumbnails=True)
+def get_atlas_pages(project_id: int, page_size: int = ATLAS_PAGE_SIZE, is_generate: bool = False) -> list:
+    """
+    :param project_id: project id
+    :param page_size: number of thumbnails per page
+    :param is_generate: if True, the missing or outdated thumbnails are generated first;
+        otherwise the thumbnails generated when the data was added are used
+    :return: (task, thumbnails folder, page number) of each page of the thumbnails of the project
+    """
+    tasks = get_tasks_info().get_tasks_by_project_id(project_id)
+    data_folders = [os.path.join(ADQ_WORKING_FOLDER, str(project_id), str(task.id), "data") for task in tasks]
+    thumbnails_folders = [get_thumbnails_folder(data_folder) for data_folder in data_folders]
+    if is_generate:
+        with st.spinner("Generating thumbnails..."):
+            for data_folder, thumbnails_folder in zip(data_folders, thumbnails_folders):
+                generate_thumbnails(data_folder, output_folder=thumbnails_folder)
+
+    return [(task, thumbnails_folder, page)
+            for task, thumbnails_folder, page_count in zip(tasks, thumbnails_folders,
+                                                           get_page_counts(thumbnails_folders, page_size))
+            for page in range(page_count)]
 
-    # Define the number of columns
-    num_columns = 5
 
-    columns = st.columns(num_columns)
-    for i, file in enumerate(thumbnail_filenames["."]):
-        with columns[i % num_columns]:
-            thumbnail_image = load_thumbnail(file)
-            st.image(thumbnail_image, width=100)
-            truncated_name = os.path.basename(file)[:20] + "..." if len(
-                os.path.basename(file)) > 20 else os.path.basename(file)
-            if st.button(truncated_name, key=f'{truncated_name}_{i}'):
-                full_size_image = Image.open(file.replace("/thumbnail/", "/data/"))
-                st.image(full_size_image, caption="Full-size Image")
+def show_images(project_id, page_size: int = ATLAS_PAGE_SIZE):
+    """
+    shows a page of thumbnails as one atlas image; the full-size image is loaded only for the selected thumbnail
+    :param project_id: project id
+    :param page_size: number of thumbnails per page
+    """
+    pages = get_atlas_pages(project_id, page_size,
+                            is_generate=st.sidebar.button("Generate missing thumbnails", key="review_thumbnails"))
+    if not pages:
+        st.write("No images")
+        return
+
+    page_number = st.sidebar.number_input(f"Page (1-{len(pages)})", min_value=1, max_value=len(pages), value=1)
+    task, thumbnails_folder, page = pages[page_number - 1]
+    atlas_filename, entries = get_atlas_page(thumbnails_folder, page, page_size)
+    if not atlas_filename:
+        st.write("No images")
+        return
+
+    st.caption(f"Task {task.id} {task.name}: images {page * page_size + 1}-{page * page_size + len(entries)}")
+    st.image(atlas_filename)
+
+    # the numbers are drawn on the cells of the atlas
+    options = [""] + [f"{idx + 1}. {entry['filename']}" for idx, entry in enumerate(entries)]
+    selected_option = st.selectbox("Show full-size image", options=options, key=f"full_size_{page_number}")
+    if selected_option:
+        filename = entries[options.index(selected_option) - 1]["filename"]
+        st.image(get_data_path(thumbnails_folder, filename), caption=filename)
 
 
 def review_images():
@@ -84,143 +139,192 @@ def compare_tasks():
         task2 = select_task(selected_project.id, label="Select task2")
 
         if task1 and task2:
-            col1, col2 = st.columns(2)
+            window_width, window_height = get_window_size()
+            st.session_state["window_width"] = window_width
+
+            app.compare(task1, task2)
+
+
+def load_label_crops(task_id: int, task_folder: str, anno_file_name: str, store: FeatureStore) -> (list, set):
+    """
+    extracts the label crops of a task (only if they are stale) and their features
+    :return: feature ids of the crops and the class labels of the task
+    """
+    _, df_crops = extract_task_crops(task_folder, anno_file_name)
+    if df_crops.empty:
+        return [], set()
+
+    ids = [f"{task_id}/{label}-{object_index}-{filename}"
+           for filename, object_index, label in df_crops[CROP_INDEX_COLUMNS].itertuples(index=False, name=None)]
+    return store.update_array(get_crops_filename(task_folder), ids), set(df_crops['label'])
 
-            with col1:
-                app.main(task1)
-            with col2:
-                app.main(task2, is_second_viewer=True)
 
+def cluster_files(project_id: int, name: str, filenames: list, n_clusters: int) -> (list, np.ndarray, np.ndarray):
+    """
+    clusters images by their persisted features; only the features of new or changed files are computed
+    and only the new files are assigned to the cached clusters
+    :param project_id: project id
+    :param name: kind of the images (e.g., images, labels)
+    :param filenames: image filenames
+    :param n_clusters: number of clusters
+    :return: filenames of the readable images, their cluster labels and their 2D coordinates
+    """
+    store = FeatureStore.open(project_id, name)
+    ids = store.update({filename: filename for filename in filenames})
+    return cluster_store(store, ids, n_clusters)
 
-def create_label_thumbnail(image: Image, label_object: DataLabels.Object, target_size: tuple=(50, 50)):
-    """init annotation for current shapes.
 
-    Args:
-        :param target_size:
-        :param image: PIL image
-        :param label_object: label object
-    Returns:
-            prev_img: cv2 image of the preview thumbnail.
+def cluster_store(store: FeatureStore, ids: list, n_clusters: int) -> (list, np.ndarray, np.ndarray):
     """
-    raw_image = np.asarray(image).astype("uint8")
-    height, width, alpha = raw_image.shape
-    width = max(width, 1)
-    height = max(height, 1)
-    prev_img = np.zeros((height, width, alpha), dtype="uint8")
-
-    if label_object.type == 'box':
-        point_list = label_object.points[0]
-        xtl, ytl, xbr, ybr = (
-            int(point_list[0]),
-            int(point_list[1]),
-            int(point_list[2]),
-            int(point_list[3])
-        )
-        x = max(xtl, 0)
-        y = max(ytl, 0)
-
-        x_end = min(xbr, height)
-        y_end = min(ybr, height)
-
-        prev_img[y:y_end, x:x_end] = raw_image[y:y_end, x:x_end]
-        prev_img = prev_img[y:y_end, x:x_end]
-    elif label_object.type == 'spline' or label_object.type == 'boundary' or label_object.type == 'polygon':
-        if label_object.points:
-            min_x, min_y, max_x, max_y = DataLabels.Object.get_bounding_rectangle(label_object)
-            min_x = max(min_x, 0)
-            min_y = max(min_y, 0)
-            max_x = min(max_x, width)
-            max_y = min(max_y, height)
-
-            prev_img[min_y:max_y, min_x:max_x] = raw_image[min_y:max_y, min_x:max_x]
-            prev_img = prev_img[min_y:max_y, min_x:max_x]
-
-    # Resize prev_img to target_size
-    if prev_img.size > 0:
-        return cv2.resize(prev_img, target_size[::-1])
-
-
-def load_label_thumbnails(data_folder: str, data_labels: DataLabels, label_thumbnail_folder: str):
-    # if they are not created, create them first
-    if not os.path.exists(label_thumbnail_folder):
-        os.mkdir(label_thumbnail_folder)
-
-        for label_image in data_labels.images:
-            image_filename = os.path.join(data_folder, label_image.name)
-            image = Image.open(image_filename)
-            for idx, obj in enumerate(label_image.objects):
-                thumbnail_name = os.path.join(label_thumbnail_folder,
-                                              f"{obj.label}-{idx}-{label_image.name}")
-                label_thumbnail = create_label_thumbnail(image, obj)
-                if label_thumbnail is not None:
-                    cv2.imwrite(thumbnail_name, label_thumbnail)
-
-    thumbnail_names = glob_files(label_thumbnail_folder,
-                                 SUPPORTED_IMAGE_FILE_EXTENSIONS)
-    thumbnail_names.sort()
-    label_thumbnails = load_images(thumbnail_names, size=(50, 50))
-
-    return label_thumbnails, thumbnail_names
+    :return: ids, their cluster labels and their 2D coordinates
+    """
+    if len(ids) < n_clusters:
+        return ids, np.empty(0), np.empty((0, 2))
+
+    cluster_labels, reduced_features = get_cluster_assignments(get_clusters_filename(store.project_id, store.name),
+                                                               ids, store.get_features(ids), n_clusters=n_clusters)
+    return ids, cluster_labels, reduced_features
 
 
 def detect_label_anomalies(selected_project):
     """
-    run cluster analysis on label images
+    run cluster analysis on the label crops of all the tasks of the project
     :return:
     """
     label_files_dict = get_label_files(selected_project)
     class_labels = set()
-    label_thumbnails = []
-    thumbnail_names = []
+    crop_ids = []
     if label_files_dict:
-        data_folder = os.path.join(selected_project.dir_name, "data")
-        label_thumbnail_folder = os.path.join(selected_project.dir_name, "label_thumbnails")
+        store = FeatureStore.open(selected_project.id, "labels")
 
         for project_folder, label_files in label_files_dict.items():
             for task_idx, label_file in enumerate(label_files):
                 st.write(f"Analyzing class labels for task {task_idx}")
-                data_labels = DataLabels.load(os.path.join(project_folder, label_file))
-                thumbnails, names = load_label_thumbnails(data_folder, data_labels, label_thumbnail_folder)
-
-                if thumbnails:
-                    label_thumbnails.extend(thumbnails)
-                    thumbnail_names.extend(names)
-
-                cur_class_labels = data_labels.get_class_labels()
+                task_folder = os.path.join(project_folder, os.path.dirname(label_file))
+                ids, cur_class_labels = load_label_crops(os.path.dirname(label_file), task_folder,
+                                                         os.path.join(project_folder, label_file), store)
+                crop_ids.extend(ids)
                 class_labels = class_labels.union(cur_class_labels)
 
         class_count = len(class_labels)
-        st.write(f"Found {len(label_thumbnails)} labels in {class_count} classes: {class_labels}")
-        cluster_labels = cluster_images(label_thumbnails, n_clusters=class_count)
-        reduced_features = reduce_features(label_thumbnails)
+        st.write(f"Found {len(crop_ids)} labels in {class_count} classes: {class_labels}")
+        names, cluster_labels, reduced_features = cluster_store(store, crop_ids, max(1, class_count))
+        if len(cluster_labels) == 0:
+            st.warning("Not enough labels for clustering")
+            return
 
-        plot_image_clusters(selected_project.id, "Label clusters", thumbnail_names,
-                            label_thumbnails, cluster_labels, reduced_features)
+        plot_image_clusters(selected_project.id, "Label clusters", names, cluster_labels, reduced_features)
 
 
 def show_image_clusters(selected_project):
     data_files = get_data_files(selected_project.id, is_thumbnails=True)
-    # Preprocess and cluster images
-    images = load_images(data_files["."])
-    if len(images) < 5:
+    names, cluster_labels, reduced_features = cluster_files(selected_project.id, "images", data_files["."],
+                                                            n_clusters=5)
+    if len(cluster_labels) == 0:
         st.warning("Please add more images for clustering purposes")
         return
 
-    cluster_labels = cluster_images(images, n_clusters=5)
-    reduced_features = reduce_features(images)
-    plot_image_clusters(selected_project.id, "Image clusters", data_files["."],
-                        images, cluster_labels, reduced_features)
+    plot_image_clusters(selected_project.id, "Image clusters", names, cluster_labels, reduced_features)
 
 
 OVERLAPS = "Overlaps"
 TINY_OBJECTS = "Tiny objects"
 CLUSTER_LABELS = "Cluster labels"
 CLUSTER_IMAGES = "Cluster images"
+DUPLICATE_IMAGES = "Duplicate images"
+LABEL_OUTLIERS = "Label outliers"
+# rules of the label rule engine run by each option
+OPTION_RULES = {
+    OVERLAPS: [DUPLICATE_BOX, DUPLICATE_POLYGON],
+    TINY_OBJECTS: [TINY, DEGENERATE, OUT_OF_BOUNDS]
+}
+# number of flagged objects listed on the page
+MAX_FLAG_ROWS = 1000
+# number of groups of duplicate images shown on the page
+MAX_DUPLICATE_GROUPS = 20
+# a burst of identical frames makes a group of thousands of images; only this many are shown per group
+MAX_DUPLICATE_GROUP_IMAGES = 10
+
+
+def show_label_outliers(selected_project):
+    """
+    builds the review queue of the objects whose geometry is unusual for their class;
+    the viewer of Review Task jumps through the queue of its task
+    """
+    anno_file_names = get_anno_file_names(get_label_files(selected_project))
+    if not anno_file_names:
+        st.warning("No label files")
+        return
+
+    df_queue = build_outlier_queue(selected_project.id, anno_file_names)
+    st.write(f"Queued {len(df_queue)} label outliers for review")
+    if df_queue.empty:
+        return
+
+    df_table = df_queue.assign(anno_file_name=df_queue['anno_file_name'].map(
+        lambda anno_file_name: os.path.relpath(anno_file_name, ADQ_WORKING_FOLDER)))
+    if len(df_table) > MAX_FLAG_ROWS:
+        st.caption(f"Showing {MAX_FLAG_ROWS} of {len(df_table)} outliers")
+    st.dataframe(df_table.head(MAX_FLAG_ROWS))
+
+
+def show_duplicate_images(selected_project):
+    """
+    groups the duplicate and near-duplicate images of the project by the perceptual hashes of their thumbnails;
+    only the hashes of new or changed thumbnails are computed
+    """
+    thumbnail_files = get_data_files(selected_project.id, is_thumbnails=True)["."]
+    store = FeatureStore.open(selected_project.id, "hashes", dim=HASH_BYTES, dtype="uint8")
+    ids = store.update({filename: filename for filename in thumbnail_files}, calculate_all=calculate_all_file_hashes)
+    groups = find_duplicate_groups(ids, store.get_features(ids))
+    st.write(f"Found {sum(len(group) for group in groups)} of {len(ids)} images in {len(groups)} groups "
+             f"of duplicates")
+
+    project_folder = os.path.join(ADQ_WORKING_FOLDER, str(selected_project.id))
+    for group_idx, group in enumerate(groups[:MAX_DUPLICATE_GROUPS]):
+        st.caption(f"Group {group_idx + 1}: {len(group)} images")
+        shown = group[:MAX_DUPLICATE_GROUP_IMAGES]
+        st.image(shown, caption=[os.path.relpath(get_data_path(os.path.dirname(filename), os.path.basename(filename)),
+                                                 project_folder) for filename in shown])
+        if len(group) > MAX_DUPLICATE_GROUP_IMAGES:
+            st.caption(f"{len(group) - MAX_DUPLICATE_GROUP_IMAGES} more")
+    if len(groups) > MAX_DUPLICATE_GROUPS:
+        st.caption(f"Showing {MAX_DUPLICATE_GROUPS} of {len(groups)} groups")
+
+
+def check_label_rules(selected_project, rules: list, is_write: bool):
+    """
+    runs the label rules over all the label files of the project and lists the flagged objects
+    :param selected_project: project
+    :param rules: rules to report
+    :param is_write: if True, the flags are written as suggested verification results
+    """
+    anno_file_names = get_anno_file_names(get_label_files(selected_project))
+    if not anno_file_names:
+        st.warning("No label files")
+        return
+
+    df_flags = check_all_labels(anno_file_names)
+    df_flags = df_flags[df_flags['rule'].isin(rules)]
+    st.write(df_flags.groupby('rule').size().reindex(rules, fill_value=0).rename("objects"))
+    if df_flags.empty:
+        return
+
+    df_table = df_flags.assign(anno_file_name=df_flags['anno_file_name'].map(
+        lambda anno_file_name: os.path.relpath(anno_file_name, ADQ_WORKING_FOLDER)))
+    if len(df_table) > MAX_FLAG_ROWS:
+        st.caption(f"Showing {MAX_FLAG_ROWS} of {len(df_table)} flagged objects")
+    st.dataframe(df_table.head(MAX_FLAG_ROWS))
+
+    if is_write:
+        written = sum(write_suggestions(anno_file_name, df_file_flags)
+                      for anno_file_name, df_file_flags in df_flags.groupby('anno_file_name'))
+        st.success(f"Suggested {written} verification results")
 
 
 def auto_review():
     selected_project = select_project(is_sidebar=True)
-    options = [OVERLAPS, TINY_OBJECTS, CLUSTER_IMAGES, CLUSTER_LABELS]
+    options = [OVERLAPS, TINY_OBJECTS, LABEL_OUTLIERS, DUPLICATE_IMAGES, CLUSTER_IMAGES, CLUSTER_LABELS]
 
     with st.form("Auto-Reviews"):
         selected_options = []
@@ -229,10 +333,18 @@ def auto_review():
                 selected = st.checkbox(option)
                 if selected:
                     selected_options.append(option)
+            is_write = st.checkbox("Write the flagged objects as suggested verification results")
 
             start = st.form_submit_button("Start auto-review")
             if start:
                 st.write(f"Starting {selected_options}")
+                rules = [rule for option in selected_options for rule in OPTION_RULES.get(option, [])]
+                if rules:
+                    check_label_rules(selected_project, rules, is_write)
+                if LABEL_OUTLIERS in selected_options:
+                    show_label_outliers(selected_project)
+                if DUPLICATE_IMAGES in selected_options:
+                    show_duplicate_images(selected_project)
                 if CLUSTER_LABELS in selected_options:
                     detect_label_anomalies(selected_project)
                 if CLUSTER_IMAGES in selected_options:
@@ -248,7 +360,7 @@ def main():
     menu = {
         "Review Images": lambda: review_images(),
         "Review Task": lambda: review_task(),
-        # "Compare Tasks": lambda: compare_tasks(),
+        "Compare Tasks": lambda: compare_tasks(),
         "Auto Review": lambda: auto_review()
     }
 
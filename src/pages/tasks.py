@@ -1,10 +1,7 @@
-import copy
-import datetime as dt
-import json
 import os.path
-import random
 import shutil
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 
@@ -32,12 +29,16 @@ from src.converters.project85_writer import Project85Writer
 from src.converters.stvision_reader import StVisionReader
 from src.models.adq_labels import AdqLabels
 from src.models.data_labels import DataLabels
+from src.models.file_inventory import get_file_inventory
 from src.models.projects_info import Project
+from src.models.sampling import get_sample_count, sample_labels
 from src.models.tasks_info import Task, TaskState
+from src.models.thumbnail_atlas import ATLAS_PAGE_SIZE, get_atlas_page, get_page_count
+from src.models.thumbnails import ThumbnailResult, generate_thumbnails, get_thumbnails_folder
 from src.pages.users import select_user
 from .home import (
     api_target,
-    get_tasks_info,
+    get_page_counts,
     get_task_pointers,
     is_authenticated,
     login,
@@ -58,41 +59,65 @@ def _show_full_size_image(full_path, size, date):
                                        date))
 
 
-@st.cache_resource
-def show_images(files_dict: dict):
-    # Define the number of columns
-    num_columns = 5
-
-    for folder, files in files_dict.items():
-        # # Calculate the number of rows needed based on the number of images and columns
-        # num_rows = int(len(files) / num_columns) + (1 if len(files) % num_columns > 0 else 0)
-
-        # Create a layout with the specified number of columns
-        columns = st.columns(num_columns)
-        for i, file in enumerate(files):
-            with columns[i % num_columns]:
-                full_path = os.path.join(folder, file)
-                file_stat = os.stat(full_path)
-                dt_datetime = dt.datetime.fromtimestamp(file_stat.st_ctime)
-                st.image(full_path,
-                         # use_column_width=True,
-                         # title="{} {} {}".format(file,
-                         #                           utils.humanize_bytes(file_stat.st_size),
-                         #                           dt_datetime.date()),
-                         width=100)
-                # button_clicked = st.button("click to expand {}".format(file))
-                # Call the event handler if the button is clicked
-                # Create the expander panel
-                with st.expander("{}".format(file)):
-                    # # Call the event handler if the button is clicked
-                    # if button_clicked:
-                    _show_full_size_image(full_path,
-                                          utils.humanize_bytes(file_stat.st_size),
-                                          dt_datetime.date())
-
-
-def _calculate_sample_count(count, percent):
-    return int((count * percent) / 100)
+def show_images(selected_task: Task, page_size: int = ATLAS_PAGE_SIZE):
+    """
+    browses the images of a task a page at a time: the thumbnails of the page are one atlas image,
+    the metadata comes from the cached file inventory and a full-size image is sent only when it is selected
+    :param selected_task: task
+    :param page_size: number of images per page
+    """
+    data_folder = os.path.join(ADQ_WORKING_FOLDER, str(selected_task.project_id), str(selected_task.id), "data")
+    thumbnails_folder = get_thumbnails_folder(data_folder)
+    # the thumbnails are generated when the data is added; the missing or outdated ones only on request
+    if st.sidebar.button("Generate missing thumbnails", key=f"task_thumbnails_{selected_task.id}"):
+        generate_task_thumbnails(data_folder)
+    page_count = get_page_counts([thumbnails_folder], page_size)[0]
+    if page_count == 0:
+        st.write("No images")
+        return
+
+    page = 1
+    if page_count > 1:
+        page = st.sidebar.number_input(f"Page (1-{page_count})", min_value=1, max_value=page_count, value=1,
+                                       key=f"images_page_{selected_task.id}")
+    atlas_filename, entries = get_atlas_page(thumbnails_folder, page - 1, page_size)
+    if not atlas_filename:
+        st.write("No images")
+        return
+
+    first_number = (page - 1) * page_size + 1
+    st.caption(f"Images {first_number}-{first_number + len(entries) - 1}")
+    st.image(atlas_filename)
+
+    # one scandir pass per folder instead of os.stat per file; only the files of the page are listed
+    df_files = get_file_inventory({data_folder: [entry["filename"] for entry in entries]})
+    df_files = df_files.set_index('name').reindex([entry["filename"] for entry in entries]).reset_index()
+    st.dataframe(pd.DataFrame({'#': np.arange(1, len(df_files) + 1),
+                               'name': df_files['name'],
+                               'size': [utils.humanize_bytes(size) if pd.notna(size) else ""
+                                        for size in df_files['size']],
+                               'created': df_files['ctime'],
+                               'modified': df_files['mtime']}).set_index('#'))
+
+    # the numbers are drawn on the cells of the atlas
+    options = [""] + [f"{idx + 1}. {entry['filename']}" for idx, entry in enumerate(entries)]
+    selected_option = st.selectbox("Show full-size image", options=options,
+                                   key=f"full_size_{selected_task.id}_{page}")
+    if selected_option:
+        file = df_files.iloc[options.index(selected_option) - 1]
+        full_path = os.path.join(data_folder, file['name'])
+        if pd.isna(file['size']) or not os.path.exists(full_path):
+            st.warning(f"{file['name']} does not exist")
+        else:
+            _show_full_size_image(full_path, utils.humanize_bytes(file['size']), file['ctime'].date())
+
+
+def browse_images():
+    selected_project = select_project(is_sidebar=True)
+    if selected_project:
+        selected_task = select_task(selected_project.id)
+        if selected_task:
+            show_images(selected_task)
 
 
 def _calculate_sample_distribution(df_total_count: pd.DataFrame,
@@ -100,7 +125,7 @@ def _calculate_sample_distribution(df_total_count: pd.DataFrame,
     df_sample_count = df_total_count.copy()
 
     for index, row in df_total_count.iterrows():
-        sample_count = _calculate_sample_count(row['count'], sample_percent)
+        sample_count = get_sample_count(row['count'], sample_percent)
         if sample_count < 1.0:
             st.warning("Please set a higher percentage to pick at least one file per folder")
             return None
@@ -110,44 +135,50 @@ def _calculate_sample_distribution(df_total_count: pd.DataFrame,
     return df_sample_count
 
 
-def sample_data(selected_project: Project, data_labels_dict: dict, df_sample_count: pd.DataFrame):
+def sample_data(selected_project: Project, anno_file_names: dict, df_sample_count: pd.DataFrame,
+                is_stratified: bool = False) -> dict:
+    """
+    creates a task per label file with a sample of its images;
+    the samples are drawn from the cached image index and streamed into the new label files,
+    and the sampled images are linked into the data folders of the new tasks with their thumbnails
+    :param selected_project: project
+    :param anno_file_names: label filename -> full path of the label file; its images are in the data folder next to it
+    :param df_sample_count: filename and number of images to sample of each label file
+    :param is_stratified: if True, the samples are stratified by class; otherwise they are uniform
+    :return: label filename -> sample label filename
+    """
     data_total_count, data_sample_count = 0, 0
+    project_folder = os.path.join(ADQ_WORKING_FOLDER, str(selected_project.id))
 
     sampled = {}
-    for index, row in df_sample_count.iterrows():
-        label_filename = row['filename']
-        sample_count = row['count']
-
-        dart_labels = data_labels_dict[label_filename]
-        sampled_data_labels = copy.deepcopy(dart_labels)
-        random.shuffle(sampled_data_labels.images)
-
-        sampled_data_labels.images = sampled_data_labels.images[:sample_count]
-        sampled[label_filename] = sampled_data_labels
+    for row in df_sample_count.itertuples(index=False):
+        label_filename = row.filename
+        anno_file_name = anno_file_names[label_filename]
 
         # save the sample label file
-        task_folder = os.path.join(ADQ_WORKING_FOLDER, str(selected_project.id), str(index))
-        if not os.path.exists(task_folder):
-            os.mkdir(task_folder)
-        utils.to_file(json.dumps(sampled_data_labels, default=utils.default, indent=2),
-                      os.path.join(task_folder, label_filename))
-
-        tasks_info = get_tasks_info()
-        task_name = "{}-{}".format(selected_project.id, label_filename)
-        object_count = sum(image.objects for image in sampled_data_labels.images)
-        new_task = Task(task_name,
+        task_folder = os.path.join(project_folder, str(api_target().get_next_task_id()))
+        os.makedirs(task_folder, exist_ok=True)
+        sample_filename = os.path.join(task_folder, os.path.basename(label_filename))
+        sample_data_folder = os.path.join(task_folder, "data")
+        data_count, object_count, total_count = sample_labels(
+            anno_file_name, sample_filename, row.count, is_stratified=is_stratified,
+            data_folder=os.path.join(os.path.dirname(anno_file_name), "data"), output_data_folder=sample_data_folder)
+        generate_task_thumbnails(sample_data_folder)
+        sampled[label_filename] = sample_filename
+
+        new_task = Task(name="{}-{}".format(selected_project.id, label_filename),
                         project_id=selected_project.id,
+                        dir_name=project_folder,
                         state_id=TaskState.DVS_NEW.value,
-                        state_name=str(TaskState.DVS_NEW.description),
-                        anno_file_name=label_filename,
-                        data_count=len(sampled_data_labels.images),
-                        object_count=object_count
-                        )
-        tasks_info.add(new_task)
-        tasks_info.save()
+                        state_name=TaskState.DVS_NEW.description,
+                        anno_file_name=sample_filename,
+                        data_count=data_count,
+                        object_count=object_count)
+        response = api_target().create_task(new_task.to_json())
+        logger.info(response)
 
-        data_total_count += len(dart_labels.images)
-        data_sample_count += len(sampled_data_labels.images)
+        data_total_count += total_count
+        data_sample_count += data_count
 
     selected_project.data_total_count = data_total_count
     selected_project.data_sample_count = data_sample_count
@@ -291,6 +322,33 @@ def _save_uploaded_files(uploaded_files, sub_folders_str: str):
     return saved_filenames
 
 
+def generate_task_thumbnails(data_folder: str) -> ThumbnailResult:
+    """
+    generates the thumbnails and their atlases of a task when its data is added, showing the progress and the failures
+    :param data_folder: data folder of the task
+    :return: created thumbnails, number of up-to-date thumbnails and failures
+    """
+    progress_bar = st.progress(0, text="Generating thumbnails...")
+
+    def show_progress(done: int, total: int):
+        progress_bar.progress(done / total, text=f"Generating thumbnails {done}/{total}")
+
+    result = generate_thumbnails(data_folder, progress=show_progress)
+    # the atlases of the Review Images grid are packed now instead of on the first view
+    thumbnails_folder = get_thumbnails_folder(data_folder)
+    for page in range(get_page_count(thumbnails_folder)):
+        get_atlas_page(thumbnails_folder, page)
+    progress_bar.empty()
+
+    if result.failures:
+        st.warning(f"Cannot generate {len(result.failures)} thumbnails")
+        with st.expander("Thumbnail failures"):
+            st.dataframe(pd.DataFrame({'filename': [os.path.basename(image_path) for image_path in result.failures],
+                                       'error': list(result.failures.values())}))
+
+    return result
+
+
 def add_data_tasks(selected_project: Project):
     with st.form("Add Data Task"):
         task_name = st.text_input("**Task Name:**")
@@ -364,6 +422,8 @@ def add_data_tasks(selected_project: Project):
                     if os.path.exists(cur_data_filename):
                         shutil.move(cur_data_filename, target_filename)
 
+                generate_task_thumbnails(os.path.join(task_folder, "data"))
+
                 new_task = Task(name=f"{task_name}-{idx}",
                                 project_id=selected_project.id,
                                 dir_name=project_folder,
@@ -470,6 +530,7 @@ def main():
     menu = {
         # "Sample Tasks": lambda: create_data_tasks(),
         "Add Tasks": lambda: add_tasks(),
+        "Browse Images": lambda: browse_images(),
         "Assign Tasks": lambda: assign_tasks(),
         "Change Status": lambda: change_status(),
         "Delete Task": lambda: delete_task(),
@@ -19,7 +19,13 @@ else:
     _component_func = components.declare_component("st_img_label", path=build_dir)
 
 
-def st_img_label(resized_img, shape_color="blue", shape_props=[], key=None) -> dict:
+def get_image_data(resized_img) -> bytes:
+    """Translates the image to RGBA bytes for passing to Javascript"""
+    return np.array(resized_img.convert("RGBA")).flatten().tobytes()
+
+
+def st_img_label(resized_img, shape_color="blue", shape_props=[], shapes_version=0, key=None,
+                 image_data=None) -> dict:
     """Create a new instance of "st_img_label".
 
     Parameters
@@ -28,17 +34,23 @@ def st_img_label(resized_img, shape_color="blue", shape_props=[], key=None) -> d
         The image to be croppepd
     shape_color: string
         The color of the cropper's bounding box. Defaults to blue.
-    shape_props: list
+    shape_props: list or None
         list of shapes that already exists.
+        None if the frontend already holds the shapes of shapes_version.
+    shapes_version: int
+        The version of the shapes (ImageManager.version).
+        The frontend reports its changes against this version.
     key: str or None
         An optional key that uniquely identifies this component. If this is
         None, and the component's arguments are changed, the component will
         be re-mounted in the Streamlit frontend and lose its current state.
+    image_data: bytes or None
+        The RGBA bytes of resized_img if they were already computed (see get_image_data).
 
     Returns
     -------
-    rects: list
-        list of bounding boxes.
+    component_value: dict
+        the selected shape ('shape') and the shape changes since shapes_version ('delta')
     """
     # Get arguments to send to frontend
     canvasWidth = resized_img.width
@@ -46,7 +58,7 @@ def st_img_label(resized_img, shape_color="blue", shape_props=[], key=None) -> d
 
     # Translates image to a list for passing to Javascript
     # imageData = np.array(resized_img.convert("RGBA")).flatten().tolist()
-    imageData = np.array(resized_img.convert("RGBA")).flatten().tobytes()
+    imageData = image_data if image_data is not None else get_image_data(resized_img)
 
     # Call through to our private component function. Arguments we pass here
     # will be sent to the frontend, where they'll be available in an "args"
@@ -61,16 +73,15 @@ def st_img_label(resized_img, shape_color="blue", shape_props=[], key=None) -> d
         canvasWidth=canvasWidth,
         canvasHeight=canvasHeight,
         shapes=shape_props,
+        shapesVersion=shapes_version,
         shapeColor=shape_color,
         # imageData=compressed_image_data,
         imageData=imageData,
         key=key,
     )
 
-    # Return a cropped image using the box from the frontend
+    # Return the selected shape and the changes made in the frontend
     if component_value:
-        # print("component_value {}".format(component_value['shape']))
-        return component_value['shape']
+        return component_value
     else:
-        # return shape_props
         return None
@@ -15,14 +15,38 @@ from src.common.constants import (
     TypeRoadMarkerQ
 )
 from src.common.logger import get_logger
+from src.common.profiler import (
+    RerunProfiler,
+    is_profiling_enabled,
+    summarize_timings
+)
 from src.models.data_labels import DataLabels
+from src.models.error_index import ErrorIndex
+from src.models.label_outliers import get_queue_filename, load_outlier_queue
 from src.models.tasks_info import Task
-from src.viewer import st_img_label
+from src.models.task_comparison import (
+    DEFAULT_IOU_THRESHOLD,
+    compare_data_labels,
+    match_objects
+)
+from src.viewer import get_image_data, st_img_label
 from src.viewer.image_manager import ImageManager
 
 logger = get_logger(__name__)
 
 DEFAULT_SHAPE_COLOR = "magenta"
+IMAGE_MANAGER_KEY = "image_manager"
+SHAPES_SENT_KEY = "shapes_sent"
+DATA_LABELS_KEY = "data_labels"
+COMPARISON_KEY = "task_comparison"
+COMPARE_INDEX_KEY = "compare_index"
+COMPARE_MANAGERS_KEY = "compare_image_managers"
+COMPARE_MATCHES_KEY = "compare_matches"
+ERROR_INDEX_KEY = "error_index"
+OUTLIER_QUEUE_KEY = "outlier_queue"
+OUTLIER_POSITION_KEY = "outlier_position"
+ALL_FILTER = "All"
+PROFILER_KEY = "viewer_profiler"
 min_width = 700
 max_width = 1000
 
@@ -79,6 +103,10 @@ def _display_type_attributes(selected_shape: dict, key="1"):
 
 def main(selected_task: Task, is_second_viewer=False, error_codes=ErrorType.get_all_types()):
     def save(image_index: int, im: ImageManager):
+        with profiler.stage("save"):
+            _save(image_index, im)
+
+    def _save(image_index: int, im: ImageManager):
         image_to_save = im.to_data_labels_image()
 
         curr_image = data_labels.images[image_index]
@@ -86,11 +114,22 @@ def main(selected_task: Task, is_second_viewer=False, error_codes=ErrorType.get_
             data_labels.images[image_index] = image_to_save
         else:
             data_labels.save_image(image_to_save)
+            image_index = next((idx for idx, image in enumerate(data_labels.images)
+                                if image.name == image_to_save.name), image_index)
 
         data_labels.save(selected_task.anno_file_name)
         selected_task.error_count = data_labels.get_verification_result_sum()
         selected_task.save()
 
+        error_index.update_image(image_index, image_to_save)
+        error_index.save()
+
+        # the session's own save does not make its ImageManager stale
+        cached_key, cached_im = st.session_state.get(image_manager_key, (None, None))
+        if cached_im is im:
+            st.session_state[image_manager_key] = (cached_key[:2] + (os.path.getmtime(selected_task.anno_file_name),),
+                                                   im)
+
     def refresh():
         save(st.session_state["image_index"], im)
 
@@ -114,6 +153,53 @@ def main(selected_task: Task, is_second_viewer=False, error_codes=ErrorType.get_
         image_index = st.session_state["img_files"].index(selected_option.split(") ")[-1])
         st.session_state["image_index"] = image_index
 
+    def jump_to_error(reverse=False):
+        save(st.session_state["image_index"], im)
+        error_code = st.session_state.get("error_filter")
+        label = st.session_state.get("error_label_filter")
+        image_index = error_index.find_image(st.session_state["image_index"],
+                                             error_code=error_code if error_code != ALL_FILTER else None,
+                                             label=label if label != ALL_FILTER else None,
+                                             reverse=reverse)
+        if image_index is None:
+            st.warning('There is no {} image with matching errors.'.format('previous' if reverse else 'next'))
+        else:
+            st.session_state["image_index"] = image_index
+
+    def error_navigation_menu():
+        st.sidebar.markdown(f"**{len(error_index.entries)}** images with errors")
+        st.sidebar.selectbox("Error", [ALL_FILTER] + error_index.get_error_codes(), key="error_filter")
+        st.sidebar.selectbox("Label", [ALL_FILTER] + error_index.get_labels(), key="error_label_filter")
+        col1, col2 = st.sidebar.columns(2)
+        col1.button("Previous error", on_click=jump_to_error, kwargs={"reverse": True})
+        col2.button("Next error", on_click=jump_to_error)
+
+    def jump_to_outlier(step: int):
+        save(st.session_state["image_index"], im)
+        position = st.session_state.get(OUTLIER_POSITION_KEY, -1) + step
+        if position < 0 or position >= len(outlier_queue):
+            st.warning('There is no {} outlier.'.format('previous' if step < 0 else 'next'))
+            return
+
+        st.session_state[OUTLIER_POSITION_KEY] = position
+        st.session_state["image_index"] = int(outlier_queue['image_index'].iloc[position])
+
+    def outlier_navigation_menu():
+        if outlier_queue.empty:
+            return
+
+        st.sidebar.markdown(f"**{len(outlier_queue)}** label outliers")
+        col1, col2 = st.sidebar.columns(2)
+        col1.button("Previous outlier", on_click=jump_to_outlier, kwargs={"step": -1})
+        col2.button("Next outlier", on_click=jump_to_outlier, kwargs={"step": 1})
+
+        position = st.session_state.get(OUTLIER_POSITION_KEY, -1)
+        if 0 <= position < len(outlier_queue):
+            outlier = outlier_queue.iloc[position]
+            st.sidebar.caption(f"({position + 1}/{len(outlier_queue)}) {outlier['label']} "
+                               f"object {outlier['object_index'] + 1}: {outlier['feature']} "
+                               f"z={outlier['robust_z']:.1f}, isolation {outlier['isolation_score']:.2f}")
+
     def viewer_menu(im: ImageManager):
         st.markdown(
             """
@@ -130,6 +216,8 @@ def main(selected_task: Task, is_second_viewer=False, error_codes=ErrorType.get_
         )
 
         # Sidebar: show status
+        error_navigation_menu()
+        outlier_navigation_menu()
         n_files = len(st.session_state["img_files"])
         # Main content: review images
         image_index = st.session_state['image_index']
@@ -164,22 +252,11 @@ def main(selected_task: Task, is_second_viewer=False, error_codes=ErrorType.get_
             st.markdown('<div class="label-container"></div>', unsafe_allow_html=True)
             st.button(label="**Save**", on_click=refresh)
 
-        selected_shape = call_frontend(im, image_index)
+        component_value = call_frontend(im, image_index)
         with col5:
+            selected_shape = component_value.get("shape") if component_value else None
             if selected_shape:
-                logger.info(f"***Received {selected_shape}")
-                scaled_shape = process_selected_shape(selected_shape)
-                if scaled_shape is None:
-                    return image_index
-
-                selected_shape_id = scaled_shape["shape_id"]
-                im_selected_shape = im.get_shape_by_id(selected_shape_id)
-                if scaled_shape.get("verification_result") or im_selected_shape.get("verification_result"):
-                    verification_result_dict = scaled_shape.get("verification_result")
-                    im.set_review(selected_shape_id,
-                                  verification_result_dict["error_code"],
-                                  verification_result_dict.get("comment", None))
-                    save(image_index, im)
+                logger.info(f"***Received {selected_shape['shape_id']}")
 
                 # # present 3 columns for the selected shape
                 # selected_shape_id = selected_shape['shape_id']
@@ -239,32 +316,50 @@ def main(selected_task: Task, is_second_viewer=False, error_codes=ErrorType.get_
         max_width = window_width * 0.7 if window_width > 700 else 700
         min_width = window_width * 0.6 if window_width > 700 else 700
         resized_img = im.resizing_img(min_width=min_width, max_width=max_width)
-        resized_shapes = im.get_downscaled_shapes()
         shape_color = DEFAULT_SHAPE_COLOR
+        key = f"{image_index}_2" if is_second_viewer else f"{image_index}_1"
 
         if resized_img:
-            return st_img_label(resized_img, shape_color=shape_color, shape_props=resized_shapes,
-                                key=f"{image_index}_2" if is_second_viewer else f"{image_index}_1")
+            # apply the changes made in the frontend before rendering so that they are not overwritten
+            with profiler.stage("apply_delta"):
+                apply_frontend_delta(im, image_index, key)
+
+            # the frontend keeps its shapes between reruns, so ship them only if it has an older version
+            resized_shapes = None
+            if st.session_state.get(SHAPES_SENT_KEY) != (key, im.version):
+                resized_shapes = im.get_downscaled_shapes()
+                st.session_state[SHAPES_SENT_KEY] = (key, im.version)
+
+            with profiler.stage("serialize"):
+                image_data = get_image_data(resized_img)
+
+            with profiler.stage("component"):
+                return st_img_label(resized_img, shape_color=shape_color, shape_props=resized_shapes,
+                                    shapes_version=im.version, key=key, image_data=image_data)
         else:
             st.write("Image file not found")
 
-    def process_selected_shape(selected_shape: dict):
-        scaled_shape = im.upscale_shape(selected_shape)
-        selected_shape_id = selected_shape["shape_id"]
-        # if shape_id is new, it's an untagged label
-        if not im.get_shape_by_id(selected_shape_id):
-            im.add_shape(scaled_shape)
+    def apply_frontend_delta(im: ImageManager, image_index: int, key: str):
+        component_value = st.session_state.get(key)
+        if not component_value:
+            return
 
-        # if deleted in the frontend, delete here too
-        attributes = scaled_shape.get("attributes")
-        if attributes:
-            status = attributes.get("status")
-            if status and status == "DELETED":
-                im.remove_shape(scaled_shape)
-                logger.info(f"DELETED {scaled_shape}")
-                return None
+        if component_value.get("resync"):
+            # the frontend was re-mounted and lost its shapes
+            st.session_state[SHAPES_SENT_KEY] = None
+            return
 
-        return scaled_shape
+        delta = component_value.get("delta")
+        if not delta:
+            return
+
+        is_in_sync = st.session_state.get(SHAPES_SENT_KEY) == (key, delta.get("version"))
+        if im.apply_shape_delta(delta):
+            logger.info(f"Applied shape delta {delta.get('seq')} to version {delta.get('version')}")
+            save(image_index, im)
+            # the frontend already shows its own changes
+            if is_in_sync:
+                st.session_state[SHAPES_SENT_KEY] = (key, im.version)
 
     def _pick_color(label: str, default_color: str) -> str:
         color_dict = {
@@ -274,13 +369,34 @@ def main(selected_task: Task, is_second_viewer=False, error_codes=ErrorType.get_
         }
         return color_dict.get(label, default_color)
 
+    profiler = get_viewer_profiler()
+
     # Load up the image and the labels
     if selected_task.anno_file_name:
-        data_labels = DataLabels.load(selected_task.anno_file_name)
+        with profiler.stage("load_labels"):
+            data_labels = DataLabels.load(selected_task.anno_file_name)
         if not data_labels:
             st.warning("Data labels are empty")
             return
 
+    # the index of the images with errors is built once per label file and updated on save
+    error_index = st.session_state.get(ERROR_INDEX_KEY)
+    if (not error_index or error_index.anno_file_name != selected_task.anno_file_name or
+            not error_index.is_valid()):
+        with profiler.stage("error_index"):
+            error_index = ErrorIndex.load(selected_task.anno_file_name)
+        st.session_state[ERROR_INDEX_KEY] = error_index
+
+    # the review queue of the label outliers of the project, reloaded when it is built again
+    queue_filename = get_queue_filename(selected_task.project_id)
+    queue_key = (selected_task.anno_file_name,
+                 os.path.getmtime(queue_filename) if os.path.exists(queue_filename) else None)
+    cached_queue_key, outlier_queue = st.session_state.get(OUTLIER_QUEUE_KEY, (None, None))
+    if cached_queue_key != queue_key:
+        outlier_queue = load_outlier_queue(selected_task.project_id, selected_task.anno_file_name)
+        st.session_state[OUTLIER_QUEUE_KEY] = (queue_key, outlier_queue)
+        st.session_state[OUTLIER_POSITION_KEY] = -1
+
     # set session states
     image_filenames = [os.path.join(f"data", image.name) for image in data_labels.images]
     if not st.session_state.get('image_index'):
@@ -292,12 +408,209 @@ def main(selected_task: Task, is_second_viewer=False, error_codes=ErrorType.get_
     image_index = st.session_state["image_index"]
     task_folder = os.path.dirname(selected_task.anno_file_name)
     image_filename = os.path.join(task_folder, image_filenames[image_index])
-    im = ImageManager(image_filename, data_labels.images[image_index])
+
+    # keep the ImageManager between reruns so that the shapes can be patched in place;
+    # it is built again when the label file was changed by someone else (e.g., another session or the auto review)
+    image_manager_key = IMAGE_MANAGER_KEY + ("_2" if is_second_viewer else "_1")
+    manager_key = (selected_task.anno_file_name, image_filename, os.path.getmtime(selected_task.anno_file_name))
+    cached_key, im = st.session_state.get(image_manager_key, (None, None))
+    if cached_key != manager_key:
+        im = ImageManager(image_filename, data_labels.images[image_index], profiler=profiler)
+        st.session_state[image_manager_key] = (manager_key, im)
+    im.profiler = profiler
 
     # call the frontend
     if not is_second_viewer:
         image_index = viewer_menu(im)
 
+    show_timings(profiler, task_id=selected_task.id, image=os.path.basename(image_filename))
+
+
+def get_viewer_profiler() -> RerunProfiler:
+    """
+    the profiler is kept in the session so that the stages timed in callbacks (e.g., saving)
+    are counted towards the rerun they trigger
+    :return: RerunProfiler of the viewer; disabled unless profiling is turned on
+    """
+    enabled = st.sidebar.checkbox("Profile viewer", value=is_profiling_enabled(), key="profile_viewer")
+    profiler = st.session_state.get(PROFILER_KEY)
+    if profiler is None:
+        profiler = RerunProfiler("viewer")
+        st.session_state[PROFILER_KEY] = profiler
+    profiler.enabled = enabled
+
+    return profiler
+
+
+def show_timings(profiler: RerunProfiler, **context):
+    """
+    records the timings of the rerun and shows them in the sidebar
+    :param profiler: profiler of the rerun
+    :param context: additional fields to record
+    """
+    if not profiler.enabled:
+        return
+
+    stages = profiler.finish(**context)
+    with st.sidebar.expander("Timings (ms)", expanded=True):
+        df_stages = pd.DataFrame(stages.items(), columns=["stage", "ms"])
+        st.dataframe(df_stages.round(1))
+        st.write(f"Total: {sum(stages.values()):.1f} ms")
+        if st.button("Show p50/p95", key="show_timings_summary"):
+            st.dataframe(summarize_timings())
+
+
+def load_data_labels(anno_file_name: str) -> DataLabels:
+    """
+    loads the label file once per version of the file and keeps it in the session
+    :param anno_file_name: label filename
+    :return: DataLabels
+    """
+    cache = st.session_state.setdefault(DATA_LABELS_KEY, dict())
+    mtime = os.path.getmtime(anno_file_name) if os.path.exists(anno_file_name) else None
+    cached_mtime, data_labels = cache.get(anno_file_name, (None, None))
+    if data_labels is None or cached_mtime != mtime:
+        data_labels = DataLabels.load(anno_file_name)
+        cache[anno_file_name] = (mtime, data_labels)
+
+    return data_labels
+
+
+def compare(task1: Task, task2: Task, iou_threshold=DEFAULT_IOU_THRESHOLD):
+    """
+    shows the shapes of two tasks side by side on the images they have in common.
+    Each image is decoded and resized once for both tasks and the objects of the tasks are paired up front
+    so that the images with disagreements can be jumped to directly.
+    The changes made in either viewer are applied to its task and saved.
+    :param task1: first task (e.g., annotator)
+    :param task2: second task (e.g., reviewer)
+    :param iou_threshold: minimum IoU for two objects to be paired
+    """
+    def previous_disagreement():
+        st.session_state[COMPARE_INDEX_KEY] = max(st.session_state.get(COMPARE_INDEX_KEY, 0) - 1, 0)
+
+    def next_disagreement():
+        st.session_state[COMPARE_INDEX_KEY] = st.session_state.get(COMPARE_INDEX_KEY, 0) + 1
+
+    def go_to_image():
+        st.session_state[COMPARE_INDEX_KEY] = compare_options.index(st.session_state["compare_img_file"])
+
+    def get_image_manager(task: Task, data_labels: DataLabels, image_index: int, suffix: int,
+                          image=None) -> ImageManager:
+        # kept between reruns so that the changes of the frontend patch the same shapes
+        manager_key = (task.anno_file_name, image_index, os.path.getmtime(task.anno_file_name))
+        managers = st.session_state.setdefault(COMPARE_MANAGERS_KEY, dict())
+        cached_key, im = managers.get(suffix, (None, None))
+        if cached_key != manager_key:
+            im = ImageManager(image_filename, data_labels.images[image_index], image=image)
+            managers[suffix] = (manager_key, im)
+        return im
+
+    def apply_frontend_delta(task: Task, data_labels: DataLabels, image_index: int, im: ImageManager,
+                             suffix: int, key: str):
+        component_value = st.session_state.get(key)
+        delta = component_value.get("delta") if component_value else None
+        if not im.apply_shape_delta(delta):
+            return
+
+        logger.info(f"Applied shape delta {delta.get('seq')} to {task.name}")
+        data_labels.images[image_index] = im.to_data_labels_image()
+        data_labels.save(task.anno_file_name)
+        task.error_count = data_labels.get_verification_result_sum()
+        task.save()
+
+        # the own save does not make the ImageManager stale
+        managers = st.session_state[COMPARE_MANAGERS_KEY]
+        managers[suffix] = (managers[suffix][0][:2] + (os.path.getmtime(task.anno_file_name),), im)
+
+    def get_matches(image1: DataLabels.Image, image2: DataLabels.Image, matches_key: tuple) -> list:
+        # only the pairs of the current image are kept; a changed label file makes a new key
+        cached_key, pairs = st.session_state.get(COMPARE_MATCHES_KEY, (None, None))
+        if cached_key != matches_key:
+            pairs = match_objects(image1, image2, iou_threshold)
+            st.session_state[COMPARE_MATCHES_KEY] = (matches_key, pairs)
+        return pairs
+
+    data_labels1 = load_data_labels(task1.anno_file_name)
+    data_labels2 = load_data_labels(task2.anno_file_name)
+    if not data_labels1 or not data_labels2:
+        st.warning("Data labels are empty")
+        return
+
+    # the matching is computed once for each version of the two label files
+    comparison_key = (task1.anno_file_name, task2.anno_file_name, iou_threshold,
+                      id(data_labels1), id(data_labels2))
+    cached_key, df_comparison = st.session_state.get(COMPARISON_KEY, (None, None))
+    if cached_key != comparison_key:
+        df_comparison = compare_data_labels(data_labels1, data_labels2, iou_threshold)
+        st.session_state[COMPARISON_KEY] = (comparison_key, df_comparison)
+
+    if df_comparison.empty:
+        st.warning("The tasks have no images in common")
+        return
+
+    df_disagreements = df_comparison[df_comparison['disagreements'] > 0]
+    st.sidebar.write(f"{len(df_disagreements)} of {len(df_comparison)} images have disagreements")
+    only_disagreements = st.sidebar.checkbox("Only images with disagreements", value=len(df_disagreements) > 0)
+    df_view = df_disagreements if only_disagreements else df_comparison
+    if df_view.empty:
+        st.success("The tasks agree on all images")
+        return
+
+    position = min(st.session_state.get(COMPARE_INDEX_KEY, 0), len(df_view) - 1)
+    st.session_state[COMPARE_INDEX_KEY] = position
+    compare_options = [f"({i + 1}/{len(df_view)}) {name}" for i, name in enumerate(df_view['image_name'])]
+
+    col1, col2, col3 = st.columns([1, 8, 1])
+    with col1:
+        st.button(label=":arrow_backward:", on_click=previous_disagreement, key="compare_previous")
+    with col2:
+        st.selectbox("", compare_options, index=position, on_change=go_to_image,
+                     key="compare_img_file", label_visibility="collapsed")
+    with col3:
+        st.button(label=":arrow_forward:", on_click=next_disagreement, key="compare_next")
+
+    row = df_view.iloc[position]
+    image1 = data_labels1.images[row['index1']]
+    image2 = data_labels2.images[row['index2']]
+
+    # decode and resize the image once and share it between the two tasks
+    image_filename = os.path.join(os.path.dirname(task1.anno_file_name), "data", image1.name)
+    im1 = get_image_manager(task1, data_labels1, row['index1'], 1)
+    im2 = get_image_manager(task2, data_labels2, row['index2'], 2, image=im1.get_image())
+
+    window_width = st.session_state.get("window_width", 700)
+    viewer_width = max(window_width * 0.35, 350)
+    resized_img = im1.resizing_img(min_width=viewer_width, max_width=viewer_width)
+    if not resized_img:
+        st.write("Image file not found")
+        return
+    im2.set_resized_size(resized_img.width, resized_img.height)
+    image_data = get_image_data(resized_img)
+
+    col1, col2 = st.columns(2)
+    for column, task, data_labels, image_index, im, suffix in [
+            (col1, task1, data_labels1, row['index1'], im1, 1), (col2, task2, data_labels2, row['index2'], im2, 2)]:
+        key = f"compare_{row['image_name']}_{suffix}"
+        # apply the changes made in the frontend before rendering so that they are not overwritten
+        apply_frontend_delta(task, data_labels, image_index, im, suffix, key)
+        with column:
+            st.markdown(f"**{task.name}**")
+            st_img_label(resized_img, shape_color=DEFAULT_SHAPE_COLOR,
+                         shape_props=im.get_downscaled_shapes(), shapes_version=im.version,
+                         key=key, image_data=image_data)
+
+    # the pairs are computed again only for another image or another version of the label files
+    image1, image2 = data_labels1.images[row['index1']], data_labels2.images[row['index2']]
+    pairs = get_matches(image1, image2, (task1.anno_file_name, os.path.getmtime(task1.anno_file_name),
+                                         task2.anno_file_name, os.path.getmtime(task2.anno_file_name),
+                                         row['index1'], row['index2'], iou_threshold))
+    st.dataframe(pd.DataFrame(
+        [(image1.objects[idx1].label if idx1 is not None else None,
+          image2.objects[idx2].label if idx2 is not None else None,
+          round(iou, 2)) for idx1, idx2, iou in pairs],
+        columns=[task1.name, task2.name, "IoU"]))
+
 
 #
 # if __name__ == "__main__":
@@ -18,21 +18,21 @@ import { Box } from "./shapes/box"
 import { Keypoint } from "./shapes/keypoint"
 import { Polygon, VanishingPoint } from "./shapes/polygon"
 import { Spline } from "./shapes/spline"
-import { sendSelectedShape } from "./streamlit-utils"
+import { requestShapes, sendSelectedShape, sendShapeDelta } from "./streamlit-utils"
 import {displayAttributes} from "./shapes/shape-attributes"
 
 const StreamlitImgLabel = (props: ComponentProps) => {
     const [mode, setMode] = useState<string>("light")
     const [labels, setLabels] = useState<string[]>([])
     const [canvas, setCanvas] = useState(new fabric.Canvas(""))
-    const {canvasWidth, canvasHeight, shapes, shapeColor, imageData}: PythonArgs = props.args
-    const [newBBoxIndex, setNewBBoxIndex] = useState<number>(shapes.length)
+    const {canvasWidth, canvasHeight, shapes, shapesVersion, shapeColor, imageData}: PythonArgs = props.args
+    const [newBBoxIndex, setNewBBoxIndex] = useState<number>(shapes ? shapes.length : 0)
     const [opacity, setOpacity] = useState<number>(0.5);
     const [isInteractingWithBox, setIsInteractingWithBox] = useState(false);
     const [selectedShape, setSelectedShape] = useState<ShapeProps | null>(null);
     const [verificationResult, setVerificationResult] = useState<VerificationResult | null>(selectedShape?.verification_result || { error_code: '', comment: '' });
 
-    const [shapesInternal, setShapesInternal] = useState<ShapeProps[]>(shapes);
+    const [shapesInternal, setShapesInternal] = useState<ShapeProps[]>(shapes ?? []);
     const [checkedClassLabels, setCheckedClassLabels] = useState<string[]>([]);
     const [selectAllClassLabels, setSelectAllClassLabels] = useState(false);
     const [expandedLabels, setExpandedLabels] = useState<string[]>([]);
@@ -42,6 +42,17 @@ const StreamlitImgLabel = (props: ComponentProps) => {
          (shape.label === 'spline') || (shape.label === 'VP'))
         .map((shape) => `${shape.label}-${shape.shape_id}`));
 
+    // python sends the shapes only if they are newer than what the frontend has
+    useEffect(() => {
+        if (shapes) {
+            setShapesInternal(shapes);
+            setNewBBoxIndex(shapes.length);
+        } else if (shapesInternal.length === 0) {
+            requestShapes();
+        }
+        // eslint-disable-next-line react-hooks/exhaustive-deps
+    }, [shapes, shapesVersion])
+
     const updateShapes = (newShapes: ShapeProps[]) => {
         setLabels(newShapes.map((shape) => shape.label));
         // Update any other relevant state variables
@@ -232,7 +243,9 @@ const StreamlitImgLabel = (props: ComponentProps) => {
               verification_result: verificationResult
             }
             setSelectedShape(updatedShape);
-            sendSelectedShape(updatedShape);
+            setShapesInternal(shapesInternal.map((shape) =>
+                shape.shape_id === updatedShape.shape_id ? updatedShape : shape));
+            sendShapeDelta(updatedShape, "changed", shapesVersion);
             if (canvas) {
                 canvas.renderAll();
             }
@@ -282,8 +295,10 @@ const StreamlitImgLabel = (props: ComponentProps) => {
             
                 console.log("sending ");
                 console.log(box);
-                sendSelectedShape(box);
-                shapesInternal.push(box);
+                sendShapeDelta(box, "added", shapesVersion);
+                if (!shapesInternal.includes(box)) {
+                    shapesInternal.push(box);
+                }
                 handleClassLabelToggle("Untagged");
                 setIsInteractingWithBox(true);
             });
@@ -308,7 +323,8 @@ const StreamlitImgLabel = (props: ComponentProps) => {
                 selectedShape["attributes"] = {"status": "DELETED"};
             }
             console.log(selectedShape);
-            sendSelectedShape(selectedShape);
+            sendShapeDelta(selectedShape, "removed", shapesVersion);
+            setShapesInternal(shapesInternal.filter((shape) => shape.shape_id !== selectedShape.shape_id));
 
             if (canvas) {
                 canvas.remove(selectedObject);
@@ -341,7 +357,7 @@ const StreamlitImgLabel = (props: ComponentProps) => {
 
     // Remove all the bounding boxes
     const clearHandler = () => {
-        setNewBBoxIndex(shapes.length)
+        setNewBBoxIndex(shapesInternal.length)
         canvas.getObjects().forEach((rect) => canvas.remove(rect))
     }
 
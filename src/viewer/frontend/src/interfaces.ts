@@ -62,11 +62,22 @@ export interface ShapeRenderProps {
   onSelectHandler?: (shape: ShapeProps, fabricsShape: fabric.Object) => void;
 }
 
+// changes made in the frontend since the shapes of version were received
+export interface ShapeDelta {
+  seq: number;
+  version: number;
+  changed: ShapeProps[];
+  added: ShapeProps[];
+  removed: number[];
+}
+
 // interface between python and frontend
+// shapes is null if the frontend already has the shapes of shapesVersion
 export interface PythonArgs {
   canvasWidth: number
   canvasHeight: number
-  shapes: ShapeProps[]
+  shapes: ShapeProps[] | null
+  shapesVersion: number
   shapeColor: string
   imageData: Uint8ClampedArray
 }
@@ -1,10 +1,36 @@
-
-import { ShapeProps } from "./interfaces"
+import { ShapeDelta, ShapeProps } from "./interfaces"
 import {
     Streamlit,
 } from "streamlit-component-lib"
 
+// sequence number of the last delta; based on the clock so that it keeps increasing after a re-mount
+let lastDeltaSeq = 0
+
+const nextDeltaSeq = (): number => {
+    lastDeltaSeq = Math.max(Date.now(), lastDeltaSeq + 1)
+    return lastDeltaSeq
+}
+
 // send the selected shape to Streamlit python component.
 export const sendSelectedShape = (shape: ShapeProps) => {
     Streamlit.setComponentValue({ shape })
 }
+
+// send the changed shape together with the delta against the shapes version received from python.
+export const sendShapeDelta = (shape: ShapeProps,
+                               change: "changed" | "added" | "removed",
+                               version: number) => {
+    const delta: ShapeDelta = {
+        seq: nextDeltaSeq(),
+        version: version,
+        changed: change === "changed" ? [shape] : [],
+        added: change === "added" ? [shape] : [],
+        removed: change === "removed" ? [shape.shape_id] : [],
+    }
+    Streamlit.setComponentValue({ shape, delta })
+}
+
+// ask python to send all the shapes again (e.g., after the component was re-mounted)
+export const requestShapes = () => {
+    Streamlit.setComponentValue({ resync: true })
+}
@@ -1,14 +1,18 @@
 import copy
 import os.path
 
-import numpy as np
 from PIL import Image
 
 from src.models.data_labels import DataLabels
 from src.common.logger import get_logger
+from src.common.profiler import NULL_PROFILER, RerunProfiler
+from src.common.utils import crop_image
 
 logger = get_logger(__name__)
 
+# size of the preview around shapes without an extent (e.g., keypoints)
+PREVIEW_POINT_SIZE = 64
+
 """
 .. module:: streamlit_img_label
    :synopsis: manages the current image and shapes (labels)
@@ -40,16 +44,33 @@ class ImageManager:
     Args:
         image_filename(str): the image filename.
         data_label_image(DataLabels.Image): parsed image labels object
+        image(PIL.Image): already decoded image to share (e.g., when comparing tasks on the same image)
+        profiler(RerunProfiler): times the decode, resize and downscale stages
     """
 
-    def __init__(self, image_filename: str, data_label_image: DataLabels.Image):
+    def __init__(self, image_filename: str, data_label_image: DataLabels.Image, image: Image = None,
+                 profiler: RerunProfiler = NULL_PROFILER):
         """initiate module"""
+        self.profiler = profiler
         self._data_label_image = data_label_image
-        self._image = None
-        if os.path.exists(image_filename):
-            self._image = Image.open(image_filename)
+        self._image = image
+        if self._image is None and os.path.exists(image_filename):
+            with self.profiler.stage("decode"):
+                self._image = Image.open(image_filename)
+                # decode now rather than lazily on the first resize so that the stages can be told apart
+                self._image.load()
         # NB: note that the shapes should be all in the ShapeProps format defined in interfaces.tsx in the frontend
         self._shapes = []
+        # shape_id -> index into self._shapes so that lookups do not scan the whole list
+        self._shape_index = dict()
+        # shape_id -> downscaled (frontend) shape; invalidated per shape when it changes
+        self._downscaled_shapes = dict()
+        # bumped whenever the shapes change so the frontend knows whether its copy is current
+        self._version = 0
+        # sequence number of the last delta received from the frontend to ignore replays on reruns
+        self._last_delta_seq = -1
+        # geometry hash -> preview thumbnail
+        self._thumbnails = dict()
         self._load_shapes()
         self._resized_ratio_w = 1
         self._resized_ratio_h = 1
@@ -62,18 +83,79 @@ class ImageManager:
         """
         return self._image
 
+    @property
+    def version(self) -> int:
+        """the version of the shapes; increases every time a shape is added, changed or removed"""
+        return self._version
+
     def get_shape_by_id(self, shape_id: int) -> dict:
-        for shape in self._shapes:
-            if shape['shape_id'] == shape_id:
-                return shape
+        index = self._shape_index.get(shape_id)
+        if index is not None:
+            return self._shapes[index]
 
     def add_shape(self, scaled_shape: dict):
+        self._shape_index[scaled_shape['shape_id']] = len(self._shapes)
         self._shapes.append(scaled_shape)
+        self._touch(scaled_shape['shape_id'])
+
+    def update_shape(self, scaled_shape: dict):
+        """
+        replaces the shape with the same shape_id in place or adds it if it does not exist yet
+        :param scaled_shape: shape in image coordinates
+        """
+        index = self._shape_index.get(scaled_shape['shape_id'])
+        if index is None:
+            self.add_shape(scaled_shape)
+        else:
+            self._shapes[index] = scaled_shape
+            self._touch(scaled_shape['shape_id'])
 
     def remove_shape(self, shape):
-        shape_to_remove = self.get_shape_by_id(shape['shape_id'])
-        if shape_to_remove:
-            self._shapes.remove(shape_to_remove)
+        index = self._shape_index.pop(shape['shape_id'], None)
+        if index is not None:
+            del self._shapes[index]
+            # only the shapes after the removed one moved
+            for moved_index in range(index, len(self._shapes)):
+                self._shape_index[self._shapes[moved_index]['shape_id']] = moved_index
+            self._touch(shape['shape_id'])
+
+    def _touch(self, shape_id: int):
+        self._downscaled_shapes.pop(shape_id, None)
+        self._version += 1
+
+    def apply_shape_delta(self, delta: dict) -> bool:
+        """
+        patches the shapes in place with the changes reported by the frontend.
+        The delta is in frontend (canvas) coordinates and has the following keys:
+            seq: sequence number of the delta; deltas that were already applied are ignored
+            changed: list of shapes that were modified
+            added: list of shapes that were newly created (e.g., untagged boxes)
+            removed: list of shape_ids that were deleted
+        :param delta: delta dictionary sent by the frontend
+        :return: True if the delta was applied; False if it was already applied before
+        """
+        if not delta:
+            return False
+
+        seq = delta.get('seq', -1)
+        if seq <= self._last_delta_seq:
+            return False
+        self._last_delta_seq = seq
+
+        for shape in delta.get('added') or []:
+            self.update_shape(self.upscale_shape(shape))
+
+        for shape in delta.get('changed') or []:
+            attributes = shape.get('attributes')
+            if attributes and attributes.get('status') == 'DELETED':
+                self.remove_shape(shape)
+            else:
+                self.update_shape(self.upscale_shape(shape))
+
+        for shape_id in delta.get('removed') or []:
+            self.remove_shape({'shape_id': shape_id})
+
+        return True
 
     def _load_shapes(self):
         """
@@ -140,6 +222,8 @@ class ImageManager:
             converted_shapes.append(shape)
 
         self._shapes = converted_shapes
+        self._shape_index = {shape['shape_id']: index for index, shape in enumerate(self._shapes)}
+        self._downscaled_shapes = dict()
 
     @staticmethod
     def to_data_labels_object(shape: dict) -> DataLabels.Object:
@@ -212,6 +296,10 @@ class ImageManager:
         if not self._image:
             return
 
+        with self.profiler.stage("resize"):
+            return self._resize(min_width, min_height, max_height, max_width)
+
+    def _resize(self, min_width, min_height, max_height, max_width):
         resized_img = self._image.copy()
         if resized_img.width > max_width:
             ratio = min(max_height / resized_img.height, max_width / resized_img.width)
@@ -224,11 +312,33 @@ class ImageManager:
                 (int(resized_img.width * ratio), int(resized_img.height * ratio))
             )
 
-        self._resized_ratio_w = self._image.width / resized_img.width
-        self._resized_ratio_h = self._image.height / resized_img.height
+        resized_ratio_w = self._image.width / resized_img.width
+        resized_ratio_h = self._image.height / resized_img.height
+        if resized_ratio_w != self._resized_ratio_w or resized_ratio_h != self._resized_ratio_h:
+            # the cached frontend shapes are only valid for the previous canvas size
+            self._downscaled_shapes = dict()
+        self._resized_ratio_w = resized_ratio_w
+        self._resized_ratio_h = resized_ratio_h
 
         return resized_img
 
+    def set_resized_size(self, width: int, height: int):
+        """use the size of an image resized elsewhere (e.g., by another ImageManager of the same image)
+
+        Args:
+            width(int): the width of the resized image.
+            height(int): the height of the resized image.
+        """
+        if not self._image:
+            return
+
+        resized_ratio_w = self._image.width / width
+        resized_ratio_h = self._image.height / height
+        if resized_ratio_w != self._resized_ratio_w or resized_ratio_h != self._resized_ratio_h:
+            self._downscaled_shapes = dict()
+        self._resized_ratio_w = resized_ratio_w
+        self._resized_ratio_h = resized_ratio_h
+
     def upscale_shape(self, shape):
         scaled_shape = copy.deepcopy(shape)
         scaled_points = []
@@ -324,66 +434,69 @@ class ImageManager:
     def get_downscaled_shapes(self):
         """get the resized shape according to the resized image.
 
+        Only the shapes that changed since the last call are rescaled.
+
         Returns:
             resized_shapes(list): the resized shapes.
         """
-        return [self.downscale_shape(shape) for shape in self._shapes]
+        with self.profiler.stage("downscale_shapes"):
+            return self._downscale_shapes()
+
+    def _downscale_shapes(self):
+        resized_shapes = []
+        for shape in self._shapes:
+            resized_shape = self._downscaled_shapes.get(shape['shape_id'])
+            if resized_shape is None:
+                resized_shape = self.downscale_shape(shape)
+                self._downscaled_shapes[shape['shape_id']] = resized_shape
+            resized_shapes.append(resized_shape)
+
+        return resized_shapes
+
+    @staticmethod
+    def get_geometry_hash(shape: dict) -> int:
+        """
+        hash of the shape type and the points of the shape (but not of its label or attributes)
+        :param shape: shape in the ShapeProps format
+        :return: hash value
+        """
+        return hash((shape['shapeType'],
+                     tuple(tuple(sorted(point.items())) for point in shape['points'])))
 
     def get_preview_thumbnail(self, shape: dict) -> Image:
-        """init annotation for current shapes.
+        """crop the shape out of the image.
+
+        Only the bounding rectangle of the shape is cropped and the thumbnails are cached by the shape geometry.
 
         Args:
-            shape(dict): the bounding boxes of the image.
+            shape(dict): the shape in image coordinates.
         Returns:
-            prev_img: PIL image of the preview thumbnail.
+            prev_img: PIL image of the preview thumbnail or None if the shape is outside of the image.
         """
-        raw_image = np.asarray(self._image).astype("uint8")
-        width, height, alpha = raw_image.shape
-        width = max(width, 1)
-        height = max(height, 1)
-        prev_img = np.zeros((width, height, alpha), dtype="uint8")
-
-        if shape:
-            if shape['shapeType'] == 'box':
-                point_dict = shape['points'][0]
-                x, y, w, h = (
-                    int(point_dict.get('x', 0)),
-                    int(point_dict.get('y', 0)),
-                    int(point_dict.get('w', 1)),
-                    int(point_dict.get('h', 1))
-                )
-                x = max(x, 0)
-                y = max(y, 0)
-                w = max(w, 1)
-                h = max(h, 1)
-
-                x_end = min(x + w, height)
-                y_end = min(y + h, width)
-
-                prev_img[y:y_end, x:x_end] = raw_image[y:y_end, x:x_end]
-                prev_img = prev_img[y:y_end, x:x_end]
-            elif shape['shapeType'] == 'spline' or shape['shapeType'] == 'boundary' or shape['shapeType'] == 'polygon':
-                bounding_rectangle = ImageManager.get_bounding_rectangle(shape)
-                if bounding_rectangle:
-                    min_x, min_y, max_x, max_y = bounding_rectangle
-                    min_x = max(min_x, 0)
-                    min_y = max(min_y, 0)
-                    max_x = min(max_x, self._image.width)
-                    max_y = min(max_y, self._image.height)
-
-                    prev_img[min_y:max_y, min_x:max_x] = raw_image[min_y:max_y, min_x:max_x]
-                    prev_img = prev_img[min_y:max_y, min_x:max_x]
-
-            elif shape['shapeType'] == 'VP':
-                resized_points = []
-                for point in shape['points']:
-                    resized_point_dict = {
-                        'x': point.get('x', 0) * self._resized_ratio_w,
-                        'y': point.get('y', 0) * self._resized_ratio_h
-                    }
-                    resized_points.append(resized_point_dict)
-
-        return Image.fromarray(prev_img)
+        if not shape or not self._image or not shape.get('points'):
+            return None
+
+        geometry_hash = ImageManager.get_geometry_hash(shape)
+        if geometry_hash in self._thumbnails:
+            return self._thumbnails[geometry_hash]
+
+        if shape['shapeType'] == 'box':
+            point_dict = shape['points'][0]
+            x, y = point_dict.get('x', 0), point_dict.get('y', 0)
+            w, h = max(point_dict.get('w', 1), 1), max(point_dict.get('h', 1), 1)
+            bounding_rectangle = [x, y, x + w, y + h]
+        else:
+            # spline, boundary, polygon, segmentation, VP and keypoint
+            bounding_rectangle = ImageManager.get_bounding_rectangle(shape)
+
+        prev_img = None
+        if bounding_rectangle:
+            # keypoints and vanishing points have no extent, so show their surroundings
+            min_size = PREVIEW_POINT_SIZE if shape['shapeType'] in ('keypoint', 'VP') else 1
+            prev_img = crop_image(self._image, bounding_rectangle, min_size=min_size)
+
+        self._thumbnails[geometry_hash] = prev_img
+        return prev_img
 
     def set_review(self, shape_id, error_code, comment):
         """set the review label and comment.
@@ -399,4 +512,7 @@ class ImageManager:
             verification_result['error_code'] = error_code
             verification_result['comment'] = comment
 
-        self._shapes[shape_id]['verification_result'] = verification_result
+        shape = self.get_shape_by_id(shape_id)
+        if shape is not None:
+            shape['verification_result'] = verification_result
+            self._touch(shape_id)
@@ -0,0 +1,38 @@
+from src.models.report_engine import (
+    POLYGON_PAIRS_CHUNK_SIZE,
+    calculate_polygon_overlap_percents,
+)
+
+
+def square(x: float, y: float, size: float = 10) -> list:
+    return [[x, y], [x + size, y], [x + size, y + size], [x, y + size]]
+
+
+def test_polygon_overlap_percents() -> None:
+    overlap_percents, is_sampled = calculate_polygon_overlap_percents(
+        [square(0, 0), square(5, 0), square(100, 100)]
+    )
+    assert not is_sampled
+    assert overlap_percents.tolist() == [50.0]
+
+
+def test_polygon_overlap_percents_without_time_budget() -> None:
+    overlap_percents, is_sampled = calculate_polygon_overlap_percents(
+        [square(0, 0), square(5, 0)], time_budget=0
+    )
+    assert is_sampled
+    assert len(overlap_percents) == 0
+
+
+def test_polygon_overlap_percents_sample_keeps_all_pairs() -> None:
+    # all the squares overlap each other; max_pairs stops after the first chunk
+    count = 300
+    points_list = [square(i * 0.01, 0) for i in range(count)]
+    overlap_percents, is_sampled = calculate_polygon_overlap_percents(
+        points_list, max_pairs=1
+    )
+    assert is_sampled
+    # each pair with at least one polygon of the chunk, once
+    skipped = count - POLYGON_PAIRS_CHUNK_SIZE
+    expected = count * (count - 1) // 2 - skipped * (skipped - 1) // 2
+    assert len(overlap_percents) == expected